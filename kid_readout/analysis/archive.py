@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 import os
+import functools
+import multiprocessing
 try:
     import pwd
 except ImportError:
@@ -135,26 +137,50 @@ def compute_reconstructed_power(df,calibration):
 
 
 
+def fit_response_mcmc(x, make_plots=False, mcmc_length=500, mcmc_burn_in=400):
+    x['f_0_max'] = x.f_0.max()
+    x['frac_f0'] = 1-x.f_0/x.f_0_max
+    mask = (x.sweep_primary_load_temperature<5) & (x.zbd_power > 0)
+    fit = kid_response.MCMCKidResponseFitter(x[mask]['frac_f0'],x[mask]['zbd_power'],
+                                             errors = np.where(x[mask]['zbd_power']>1e-7,
+                                                               x[mask]['zbd_power']*1e-2,
+                                                               1e-8))
+    fit.run(burn_in=mcmc_burn_in,length=mcmc_length)
+    if make_plots:
+        blah = fit.triangle()
+    x['response_break_point']=fit.mcmc_params['break_point'].value
+    x['response_scale']=fit.mcmc_params['scale'].value
+    x['response_break_point_err']=fit.mcmc_params['break_point'].stderr
+    x['response_scale_err']=fit.mcmc_params['scale'].stderr
+    #x['watts_to_ppm'] = (2*pp[0]*x['noise_on_frac_f0']+pp[1])
+    x['reconstructed_power'] = fit.to_power(x['frac_f0'])
+    return x
+
+
 def build_response_fit_function(make_plots=False, mcmc_length=500, mcmc_burn_in=400):
-    def fit_response_mcmc(x):
-        x['f_0_max'] = x.f_0.max()
-        x['frac_f0'] = 1-x.f_0/x.f_0_max
-        mask = (x.sweep_primary_load_temperature<5) & (x.zbd_power > 0)
-        fit = kid_readout.analysis.kid_response.MCMCKidResponseFitter(x[mask]['frac_f0'],x[mask]['zbd_power'],
-                                                                      errors = np.where(x[mask]['zbd_power']>1e-7,
-                                                                                        x[mask]['zbd_power']*1e-2,
-                                                                                        1e-8))
-        fit.run(burn_in=mcmc_burn_in,length=mcmc_length)
-        if make_plots:
-            blah = fit.triangle()
-        x['response_break_point']=fit.mcmc_params['break_point'].value
-        x['response_scale']=fit.mcmc_params['scale'].value
-        x['response_break_point_err']=fit.mcmc_params['break_point'].stderr
-        x['response_scale_err']=fit.mcmc_params['scale'].stderr
-        #x['watts_to_ppm'] = (2*pp[0]*x['noise_on_frac_f0']+pp[1])
-        x['reconstructed_power'] = fit.to_power(x['frac_f0'])
-        return x
-    return fit_response_mcmc
+    # A partial of a module-level function can be pickled, so the result can be used with apply_by_group().
+    return functools.partial(fit_response_mcmc, make_plots=make_plots, mcmc_length=mcmc_length,
+                             mcmc_burn_in=mcmc_burn_in)
+
+
+def apply_by_group(df, function, by, processes=None):
+    """
+    Apply the function to each group of rows of df with the same values of the given columns and return the
+    concatenated results, like df.groupby(by).apply(function).reset_index(drop=True). If processes is greater than 1,
+    the groups are processed in a pool of that many processes, and the function must be picklable; for example,
+    apply_by_group(df, build_response_fit_function(), 'resonator_id', processes=8) fits every resonator in parallel.
+    """
+    groups = [group for key, group in df.groupby(by)]
+    if processes is None or processes <= 1:
+        results = [function(group) for group in groups]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(function, groups)
+        finally:
+            pool.close()
+            pool.join()
+    return pd.concat(results).reset_index(drop=True)
 
 def normalize_f0(x):
     x['f_0_max'] = x[x.sweep_primary_package_temperature < 0.3]['f_0'].max()
@@ -1,7 +1,6 @@
 from __future__ import division
 import numpy as np
 import lmfit
-import scipy.optimize
 
 
 # todo: rewrite these to use params.valuesdict()
@@ -185,25 +184,20 @@ class Fitter(object):
     def inverse(self, y, params=None, guess=None):
         """
         Find the modeled x-values that correspond to the given y-values.
+
+        All of the y-values are inverted at once using a Gauss-Newton iteration. If guess is None, the iteration for
+        each y-value starts at the x-value of the closest data point; otherwise, guess is a float or an array that
+        broadcasts to the shape of y.
         """
+        # This module is imported by the resonator package, so import the inversion module here.
+        from kid_readout.analysis.resonator import inversion
         if params is None:
             params = self.result.params
-
-        def resid(x, y):
-            return np.abs(y - self._model(params, x))
-
         isscalar = np.isscalar(y)
-        if isscalar:
-            y = np.array([y])
-
-        def _find_inverse(y):
-            if guess is None:
-                x0 = self.x_data[np.argmin(np.abs(y - self.y_data))]
-            else:
-                x0 = guess
-            return scipy.optimize.fsolve(resid, x0, args=(y,))
-
-        result = np.vectorize(_find_inverse)(y)
+        y = np.atleast_1d(y)
+        if guess is None:
+            guess = inversion.nearest(self.x_data, self.y_data, y)
+        result = inversion.newton(lambda x: self._model(params, x), y, guess)
         if isscalar:
             result = result[0]
         return result
@@ -1,7 +1,18 @@
+"""
+This module contains classes that use emcee to sample the posterior distribution of fit parameters.
+
+Each emcee step evaluates the log-probability of every walker. The classes here compute it with a single call for all
+of the walkers, using LogProbability or ResidualLogProbability, which take an array of parameter vectors and return an
+array of log-probabilities. WalkerPool passes all of the walker positions to such a function at once, optionally
+splitting them among processes. LogProbability evaluates the model using ParameterValues instead of lmfit.Parameters,
+which are slow to create; a model that uses only numpy operations on the parameter values is evaluated once for all
+walkers by broadcasting.
+"""
+import multiprocessing
+
 import numpy as np
 from scipy.misc import logsumexp
 import emcee
-import corner
 import lmfit
 from kid_readout.analysis.fitter import Fitter
 from kid_readout.analysis.resonator.legacy_resonator import Resonator
@@ -27,6 +38,187 @@ def convert_to_lmfit_params(raw_params,base_params,raw_param_list=parameter_list
             lm_params.add(name,value=param.value)
     return lm_params
 
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class ParameterValues(dict):
+    """
+    This class maps parameter names to objects with a value attribute, so a model function written for lmfit.Parameters
+    can use it in their place. A value may be an array with shape (number of parameter vectors, 1), in which case a
+    model that broadcasts the values against the independent variable returns one row for each parameter vector.
+    """
+
+    def __init__(self, names, values, fixed=None):
+        """
+        Parameters
+        ----------
+        names : list of str
+            The names of the parameters.
+        values : iterable
+            The corresponding values.
+        fixed : dict or None
+            A dict that maps the names of any other parameters to their float values.
+        """
+        super(ParameterValues, self).__init__()
+        if fixed is not None:
+            for name, value in fixed.items():
+                self[name] = _Value(value)
+        for name, value in zip(names, values):
+            self[name] = _Value(value)
+
+
+def _bounds(params, names):
+    mins = np.array([-np.inf if params[name].min is None else params[name].min for name in names], dtype=np.float64)
+    maxs = np.array([np.inf if params[name].max is None else params[name].max for name in names], dtype=np.float64)
+    return mins, maxs
+
+
+class LogProbability(object):
+    """
+    The log-probability of a model with uniform priors and independent Gaussian errors, as a function of an array of
+    parameter vectors. Instances can be pickled if the model function can, so they can be used in a process pool.
+    """
+
+    def __init__(self, model, x, y, errors, names, mins, maxs, fixed=None, vectorize=True):
+        """
+        Parameters
+        ----------
+        model : callable
+            A function y(params, x) that uses only the value attribute of each parameter.
+        x : ndarray
+            The independent variable.
+        y : ndarray (real or complex)
+            The data.
+        errors : ndarray or None
+            The errors of the data; None means that all errors are 1.
+        names : list of str
+            The names of the parameters that are sampled, in the order of the parameter vectors.
+        mins : ndarray (float)
+            The lower bounds of the uniform priors.
+        maxs : ndarray (float)
+            The upper bounds of the uniform priors.
+        fixed : dict or None
+            A dict that maps the names of the parameters that are not sampled to their values.
+        vectorize : bool
+            If True, the model is evaluated once with parameter values that are arrays, as described in
+            ParameterValues; if False, it is evaluated once for each parameter vector.
+        """
+        self.model = model
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        if errors is None:
+            errors = np.ones(self.y.shape)
+        self.errors = np.asarray(errors)
+        self.names = list(names)
+        self.mins = np.asarray(mins, dtype=np.float64)
+        self.maxs = np.asarray(maxs, dtype=np.float64)
+        self.fixed = {} if fixed is None else dict(fixed)
+        self.vectorize = vectorize
+        self._normalization = -np.sum(np.log(np.abs(self.errors)))
+
+    def log_prior(self, values):
+        """
+        Return an array that is 0 for each parameter vector inside the bounds and -inf for the others.
+        """
+        values = np.atleast_2d(values)
+        inside = np.all((self.mins <= values) & (values <= self.maxs), axis=1)
+        return np.where(inside, 0., -np.inf)
+
+    def log_likelihood(self, values):
+        """
+        Return the log-likelihood of each of the given parameter vectors, which are the rows of values.
+        """
+        values = np.atleast_2d(values)
+        if self.vectorize:
+            model = self.model(ParameterValues(self.names, values.T[:, :, np.newaxis], self.fixed), self.x)
+        else:
+            model = np.array([self.model(ParameterValues(self.names, row, self.fixed), self.x) for row in values])
+        return self._normalization - 0.5 * np.sum(np.abs((self.y - model) / self.errors) ** 2, axis=-1)
+
+    def __call__(self, values):
+        """
+        Return the log-probability of each of the given parameter vectors, which are the rows of values. The model is
+        not evaluated for vectors outside the bounds.
+        """
+        values = np.atleast_2d(values)
+        result = self.log_prior(values)
+        inside = np.isfinite(result)
+        if np.any(inside):
+            result[inside] += self.log_likelihood(values[inside])
+        return result
+
+
+class ResidualLogProbability(object):
+    """
+    The log-probability of a fitter with uniform priors, calculated from its residual() method, as a function of an
+    array of parameter vectors. The fitter must have a residual() method that returns the residual and the errors, or
+    None, using the values in fitter.result.params; the likelihood is calculated for one parameter vector at a time.
+    """
+
+    def __init__(self, fitter, names, mins, maxs):
+        self.fitter = fitter
+        self.names = list(names)
+        self.mins = np.asarray(mins, dtype=np.float64)
+        self.maxs = np.asarray(maxs, dtype=np.float64)
+
+    def __call__(self, values):
+        values = np.atleast_2d(values)
+        result = np.where(np.all((self.mins <= values) & (values <= self.maxs), axis=1), 0., -np.inf)
+        for index in np.flatnonzero(np.isfinite(result)):
+            for name, value in zip(self.names, values[index]):
+                self.fitter.result.params[name].value = value
+            residual, errors = self.fitter.residual()
+            if errors is None:
+                errors = np.ones(residual.shape[0])
+            result[index] += np.sum(-np.log(np.abs(errors)) - 0.5 * abs(residual / errors) ** 2)
+        return result
+
+
+class WalkerPool(object):
+    """
+    This class is passed as the pool of an emcee.EnsembleSampler. The sampler calls map() with the positions of all
+    of the walkers, and it evaluates the given log-probability function for all of them with one call or, if processes
+    is greater than 1, with one call in each process; the function emcee passes to map() is not used.
+    """
+
+    def __init__(self, log_probability, processes=None):
+        """
+        Parameters
+        ----------
+        log_probability : callable
+            A function that takes an array of parameter vectors and returns an array of log-probabilities, such as a
+            LogProbability instance; it must be picklable if processes is greater than 1.
+        processes : int or None
+            The number of processes in which to evaluate the function; None or 1 means use the current process.
+        """
+        self.log_probability = log_probability
+        self.processes = processes
+        self._pool = None
+
+    def map(self, function, positions):
+        positions = np.array(positions)
+        if self.processes is None or self.processes <= 1:
+            return list(self.log_probability(positions))
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        chunks = [chunk for chunk in np.array_split(positions, self.processes) if chunk.size]
+        return list(np.concatenate(self._pool.map(self.log_probability, chunks)))
+
+    def close(self):
+        """
+        Stop the worker processes, if any.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
 class GeneralMCMC():
     def __init__(self, fitter):
         self.fitter = fitter
@@ -76,7 +268,13 @@ class GeneralMCMC():
             return -np.inf
         return np.sum(self.basic_loglikelihood(params))
 
-    def setup_sampler(self,nwalkers=32,error_factor=None):
+    def log_probability(self):
+        """
+        Return a ResidualLogProbability for the parameters that vary.
+        """
+        return ResidualLogProbability(self.fitter, self.parameter_list, self.parameter_mins, self.parameter_maxs)
+
+    def setup_sampler(self,nwalkers=32,error_factor=None,processes=None):
         self.update_parameter_list()
         ndim = len(self.parameter_list)
         self.ndim = ndim
@@ -84,28 +282,35 @@ class GeneralMCMC():
         for dim in range(ndim):
             min,max = self.parameter_mins[dim], self.parameter_maxs[dim]
             self.initial[:,dim] = np.random.uniform(min,max,size=nwalkers)
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob,threads=4)
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob,
+                                             pool=WalkerPool(self.log_probability(),processes=processes))
 
-    def run(self,length=500,burn_in=100,nwalkers=32):
-        self.setup_sampler(nwalkers=nwalkers)
-        self.sampler.run_mcmc(self.initial,length)
+    def run(self,length=500,burn_in=100,nwalkers=32,processes=None):
+        self.setup_sampler(nwalkers=nwalkers,processes=processes)
+        try:
+            self.sampler.run_mcmc(self.initial,length)
+        finally:
+            self.sampler.pool.close()
         self.samples = self.sampler.chain[:,burn_in:,:].reshape((-1,self.ndim))
         for dim,name in enumerate(self.parameter_list):
             self.fitter.params[name].value = self.samples[:,dim].mean()
             self.fitter.params[name].stderr = self.samples[:,dim].std()
 
     def triangle(self,*args,**kwargs):
-        import triangle
+        import corner
         kwargs['labels'] = self.parameter_list
-        triangle.corner(self.samples,*args,**kwargs)
+        corner.corner(self.samples,*args,**kwargs)
 
 
 class MCMCFitter(Fitter):
+    # If True, the model broadcasts parameter values that are arrays; see ParameterValues.
+    vectorize = True
+
     def __init__(self,*args,**kwargs):
         super(MCMCFitter,self).__init__(*args,**kwargs)
-        self.parameter_list = self.result.params.keys()
+        self.parameter_list = [name for name, param in self.result.params.items() if param.vary]
     def get_param_bounds_by_index(self,index,error_factor=None):
-        parameter_list = self.parameter_list # need to set this up, something like self.reseult.params.keys() but ommitting non varying params
+        parameter_list = self.parameter_list
         name = parameter_list[index]
         if not self.result.params[name].vary:
             raise Exception("Non varying parameter found %s" % name)
@@ -128,46 +333,59 @@ class MCMCFitter(Fitter):
             if value > max or value < min:
                 return -np.inf
         return 0.
-    
+
+    def log_probability(self):
+        """
+        Return a LogProbability for the parameters in self.parameter_list, using the data where the mask is True and
+        the current values of the other parameters.
+        """
+        mins, maxs = _bounds(self.result.params, self.parameter_list)
+        fixed = dict((name, param.value) for name, param in self.result.params.items()
+                     if name not in self.parameter_list)
+        errors = None if self.errors is None else self.errors[self.mask]
+        return LogProbability(self._model, self.x_data[self.mask], self.y_data[self.mask], errors, self.parameter_list,
+                              mins, maxs, fixed=fixed, vectorize=self.vectorize)
+
     def basic_loglikelihood(self,params):
-        model = self.model(params = convert_to_lmfit_params(params,self.result.params,self.result.params.keys()))
-        return (-np.log(np.abs(self.errors))
-                - 0.5*abs((self.y_data-model)/self.errors)**2)
+        return self.log_probability().log_likelihood(params)[0]
     def basic_logprob(self,params):
-        if np.isinf(self.uniform_logprior(params)):
-            return -np.inf
-        return np.sum(self.basic_loglikelihood(params))
+        return self.log_probability()(params)[0]
 
-    def run(self,length=500,burn_in=100,nwalkers=32):
-        self.setup_sampler(nwalkers=nwalkers)
-        self.sampler.run_mcmc(self.initial,length)
+    def run(self,length=500,burn_in=100,nwalkers=32,processes=None):
+        self.setup_sampler(nwalkers=nwalkers,processes=processes)
+        try:
+            self.sampler.run_mcmc(self.initial,length)
+        finally:
+            self.sampler.pool.close()
         self.samples = self.sampler.chain[:,burn_in:,:].reshape((-1,self.ndim))
         self.mcmc_params = self.result.params.copy()
         for dim in range(self.ndim):
-            self.mcmc_params[self.mcmc_params.keys()[dim]].value = self.samples[:,dim].mean()
-            self.mcmc_params[self.mcmc_params.keys()[dim]].stderr = self.samples[:,dim].std()
+            self.mcmc_params[self.parameter_list[dim]].value = self.samples[:,dim].mean()
+            self.mcmc_params[self.parameter_list[dim]].stderr = self.samples[:,dim].std()
 
     def triangle(self,*args,**kwargs):
-        import triangle
+        import corner
         kwargs['labels'] = self.parameter_list
-        triangle.corner(self.samples,*args,**kwargs)
+        corner.corner(self.samples,*args,**kwargs)
 
-    def setup_sampler(self,nwalkers=32,error_factor=None):
-        ndim = len(self.result.params)
+    def setup_sampler(self,nwalkers=32,error_factor=None,processes=None):
+        ndim = len(self.parameter_list)
         self.ndim = ndim
         self.initial = np.zeros((nwalkers,ndim))
         for dim in range(ndim):
             min,max = self.get_param_bounds_by_index(dim,error_factor=error_factor)
             self.initial[:,dim] = np.random.uniform(min,max,size=nwalkers)
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob)
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob,
+                                             pool=WalkerPool(self.log_probability(),processes=processes))
 
 
 class MCMCResonator(Resonator,MCMCFitter):
-    def setup_sampler(self,nwalkers=32):
-        self.parameter_list = parameter_list
+    # The bifurcation model interpolates, so it must be evaluated for one parameter vector at a time.
+    vectorize = False
+
+    def setup_sampler(self,nwalkers=32,processes=None):
+        self.parameter_list = [name for name in parameter_list if name in self.result.params]
         ndim = len(self.parameter_list)
-        if not 'a' in self.result.params:
-            ndim -= 1
         self.ndim = ndim
         self.initial = np.zeros((nwalkers,ndim))
         for dim in range(ndim):
@@ -177,19 +395,5 @@ class MCMCResonator(Resonator,MCMCFitter):
             vals[vals > max] = max
             vals[vals < min] = min
             self.initial[:,dim] = vals
-        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob)
-
-    def basic_loglikelihood(self,params):
-        model = self.model(params = convert_to_lmfit_params(params,self.result.params))
-        return (-np.log(np.abs(self.errors))
-                - 0.5*abs((self.y_data-model)/self.errors)**2)
-
-
-    def uniform_logprior(self,params):
-        for k in range(len(params)):
-            value = params[k]
-            min,max = self.get_param_bounds_by_index(k)
-
-            if value > max or value < min:
-                return -np.inf
-        return 0.
+        self.sampler = emcee.EnsembleSampler(nwalkers,ndim,self.basic_logprob,
+                                             pool=WalkerPool(self.log_probability(),processes=processes))
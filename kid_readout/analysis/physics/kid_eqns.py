@@ -3,6 +3,8 @@ import scipy.special
 
 import lmfit
 
+from kid_readout.analysis.physics import mbint
+
 h = 6.626e-34 # J/s
 hbar = 1.054571e-34 #J/s
 kB = 1.38065e-23 #J/K
@@ -276,6 +278,24 @@ class DarkKIDModel(KIDModel):
                 (1 - (self.nqp(T)/(2*self.N0*self.Delta))*(1+np.sqrt((2*self.Delta)/(np.pi*kBeV*T))*
                                                            np.exp(-xi)*scipy.special.i0(xi))))
 
+class MattisBardeenKIDModel(KIDModel):
+    """
+    This model uses the full Mattis-Bardeen conductivities of thermal quasiparticles, interpolated from the tables in
+    mbint, instead of the low-temperature approximations. The gap is assumed not to depend on temperature, and the
+    nqp0 parameter is not used. The table is an mbint.ConductivityTable, or None to use mbint.get_table().
+    """
+    def __init__(self, table=None, **kwargs):
+        super(MattisBardeenKIDModel, self).__init__(**kwargs)
+        self.table = table
+
+    def sigma1(self,T):
+        sigman = self.params['sigman'].value
+        return sigman*mbint.sigma1(self.Delta, kBeV*T, h*self.f0_nom/qC, table=self.table)
+
+    def sigma2(self,T):
+        sigman = self.params['sigman'].value
+        return sigman*mbint.sigma2(self.Delta, kBeV*T, h*self.f0_nom/qC, table=self.table)
+
 class DarkKIDModelFractional(DarkKIDModel):
     def __init__(self,Tc=1.46, nqp0=0, f0_nom=100e6,
                  sigman=5e5, alpha=.66,
@@ -1,5 +1,14 @@
+import os
+import logging
+import tempfile
+
 import numpy as np
 import scipy.integrate
+import scipy.interpolate
+
+from kid_readout import settings
+
+logger = logging.getLogger(__name__)
 
 def trapz2(func, a, b, eps, npoints, args):
     eps = (b-a)*eps
@@ -38,4 +47,182 @@ def mb_integrand_2(eps,delta,kbt,hf):
             (np.sqrt(delta**2-eps**2)*np.sqrt((eps+hf)**2-delta**2)))
 
 def _mb2(delta, kbt, hf):
-    return trapz2(mb_integrand_2, delta - hf, delta, 1e-10, 6000, args=(delta,kbt,hf))/hf
\ No newline at end of file
+    return trapz2(mb_integrand_2, delta - hf, delta, 1e-10, 6000, args=(delta,kbt,hf))/hf
+
+# The integrals above are slow, so the functions below interpolate tables of their values. Because sigma / sigma_N
+# depends only on the reduced temperature kT / Delta and the reduced frequency hf / Delta, one table serves every
+# superconductor and resonance frequency. The tables interpolate the logarithm of the conductivities, which varies
+# smoothly; sigma_1 is exponentially small at low temperature.
+
+# The default grid spans the reduced temperatures and the reduced frequencies below the pair-breaking threshold that
+# are relevant for KIDs; values outside the grid are calculated by direct integration.
+DEFAULT_REDUCED_TEMPERATURE = np.logspace(np.log10(0.005), 0, 200)
+DEFAULT_REDUCED_FREQUENCY = np.logspace(-5, 0, 60)
+
+
+class ConductivityTable(object):
+    """
+    Interpolate sigma_1 / sigma_N and sigma_2 / sigma_N, as calculated by _mb1() and _mb2(), on a grid of reduced
+    temperature and reduced frequency, using bicubic splines of their logarithms.
+    """
+
+    def __init__(self, reduced_temperature=DEFAULT_REDUCED_TEMPERATURE, reduced_frequency=DEFAULT_REDUCED_FREQUENCY,
+                 sigma1=None, sigma2=None):
+        """
+        Parameters
+        ----------
+        reduced_temperature : ndarray (float)
+            The increasing grid values of kT / Delta.
+        reduced_frequency : ndarray (float)
+            The increasing grid values of hf / Delta, which must be less than 2.
+        sigma1 : ndarray (float) or None
+            The values of sigma_1 / sigma_N on the grid, with shape (temperature, frequency); if None, they are
+            calculated, which takes a few seconds for the default grid.
+        sigma2 : ndarray (float) or None
+            The values of sigma_2 / sigma_N on the grid; see sigma1.
+        """
+        self.reduced_temperature = np.asarray(reduced_temperature, dtype=np.float64)
+        self.reduced_frequency = np.asarray(reduced_frequency, dtype=np.float64)
+        if sigma1 is None or sigma2 is None:
+            sigma1, sigma2 = self._calculate(self.reduced_temperature, self.reduced_frequency)
+        self.sigma1_grid = np.asarray(sigma1)
+        self.sigma2_grid = np.asarray(sigma2)
+        log_t = np.log(self.reduced_temperature)
+        log_nu = np.log(self.reduced_frequency)
+        self._log_sigma1 = scipy.interpolate.RectBivariateSpline(log_t, log_nu, np.log(self.sigma1_grid))
+        self._log_sigma2 = scipy.interpolate.RectBivariateSpline(log_t, log_nu, np.log(self.sigma2_grid))
+
+    @staticmethod
+    def _calculate(reduced_temperature, reduced_frequency):
+        sigma1 = np.empty((reduced_temperature.size, reduced_frequency.size))
+        sigma2 = np.empty_like(sigma1)
+        # The integrands broadcast over a column of temperatures, so each frequency requires one call.
+        column = reduced_temperature[:, np.newaxis]
+        with np.errstate(over='ignore'):
+            for k, nu in enumerate(reduced_frequency):
+                sigma1[:, k] = _mb1(1., column, nu)
+                sigma2[:, k] = _mb2(1., column, nu)
+        return sigma1, sigma2
+
+    def contains(self, reduced_temperature, reduced_frequency):
+        """
+        Return a boolean array that is True where the given values are within the grid.
+        """
+        return ((self.reduced_temperature[0] <= reduced_temperature) &
+                (reduced_temperature <= self.reduced_temperature[-1]) &
+                (self.reduced_frequency[0] <= reduced_frequency) &
+                (reduced_frequency <= self.reduced_frequency[-1]))
+
+    def sigma1(self, reduced_temperature, reduced_frequency):
+        """
+        Return the interpolated values of sigma_1 / sigma_N; the arguments are broadcast together.
+        """
+        t, nu = np.broadcast_arrays(reduced_temperature, reduced_frequency)
+        return np.exp(self._log_sigma1.ev(np.log(t), np.log(nu)))
+
+    def sigma2(self, reduced_temperature, reduced_frequency):
+        """
+        Return the interpolated values of sigma_2 / sigma_N; the arguments are broadcast together.
+        """
+        t, nu = np.broadcast_arrays(reduced_temperature, reduced_frequency)
+        return np.exp(self._log_sigma2.ev(np.log(t), np.log(nu)))
+
+    def save(self, path):
+        """
+        Save the table to the given .npz file, writing to a temporary file first so that a partially-written table is
+        never read.
+        """
+        handle, temporary_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            # mkstemp() creates the file readable only by its owner; give it the permissions of an ordinary file.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary_path, 0o666 & ~umask)
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, reduced_temperature=self.reduced_temperature, reduced_frequency=self.reduced_frequency,
+                         sigma1=self.sigma1_grid, sigma2=self.sigma2_grid)
+            os.rename(temporary_path, path)
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the table saved in the given .npz file.
+        """
+        with np.load(path) as data:
+            return cls(**dict((key, data[key]) for key in ('reduced_temperature', 'reduced_frequency', 'sigma1',
+                                                           'sigma2')))
+
+
+_default_table = None
+
+
+def get_table(path=None):
+    """
+    Return the table on the default grid. The first call loads it from the given path, which defaults to
+    settings.MATTIS_BARDEEN_TABLE_PATH, or, if that fails, calculates it and saves it there; if the path is None, the
+    table is calculated and not saved. Later calls return the same table.
+    """
+    global _default_table
+    if _default_table is not None:
+        return _default_table
+    if path is None:
+        path = settings.MATTIS_BARDEEN_TABLE_PATH
+    table = None
+    if path is not None and os.path.exists(path):
+        try:
+            table = ConductivityTable.load(path)
+        except (IOError, OSError, ValueError, KeyError):
+            logger.warning("Recalculating unreadable Mattis-Bardeen table {}".format(path))
+        else:
+            if not (np.array_equal(table.reduced_temperature, DEFAULT_REDUCED_TEMPERATURE) and
+                    np.array_equal(table.reduced_frequency, DEFAULT_REDUCED_FREQUENCY)):
+                logger.info("Recalculating Mattis-Bardeen table {} with a different grid".format(path))
+                table = None
+    if table is None:
+        table = ConductivityTable()
+        if path is not None:
+            try:
+                table.save(path)
+            except (IOError, OSError):
+                logger.warning("Could not save Mattis-Bardeen table to {}".format(path))
+    _default_table = table
+    return table
+
+
+def _evaluate(interpolate, integrate, delta, kbt, hf, table):
+    delta, kbt, hf = np.broadcast_arrays(np.asarray(delta, dtype=np.float64), kbt, hf)
+    t = kbt / delta
+    nu = hf / delta
+    result = np.empty(t.shape)
+    inside = table.contains(t, nu)
+    result[inside] = interpolate(t[inside], nu[inside])
+    outside = ~inside
+    if np.any(outside):
+        result[outside] = [integrate(d, k, f) for d, k, f in zip(delta[outside], kbt[outside], hf[outside])]
+    if result.ndim == 0:
+        return result[()]
+    return result
+
+
+def sigma1(delta, kbt, hf, table=None):
+    """
+    Return sigma_1 / sigma_N for the given gap, thermal energy, and photon energy, which are in the same units and are
+    broadcast together. Values inside the grid of the given table, or the default table if None, are interpolated and
+    the others are integrated directly with _mb1().
+    """
+    if table is None:
+        table = get_table()
+    return _evaluate(table.sigma1, _mb1, delta, kbt, hf, table)
+
+
+def sigma2(delta, kbt, hf, table=None):
+    """
+    Return sigma_2 / sigma_N; see sigma1().
+    """
+    if table is None:
+        table = get_table()
+    return _evaluate(table.sigma2, _mb2, delta, kbt, hf, table)
@@ -0,0 +1,340 @@
+"""
+Fit many resonators at once.
+
+The classes in lmfit_resonator fit one resonator at a time, and lmfit calls the model from Python once per iteration
+for each resonator. The class in this module fits a stacked block of sweeps with shape (num_resonators, num_points),
+such as the data in a SweepArray, using a Levenberg-Marquardt algorithm in which each iteration is a single vectorized
+calculation over every resonator that has not yet converged. The model, its parameters, and the initial guesses are the
+same as those of lmfit_resonator.LinearLossResonatorWithCable, and resonator() creates one of those on demand.
+"""
+from __future__ import division
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+
+from kid_readout.analysis.resonator import equations, lmfit_resonator
+
+
+class LinearLossResonatorWithCableBatch(object):
+    """
+    Fit equations.general_cable * equations.linear_loss_resonator to many resonators.
+
+    After fitting, the best-fit value and standard error of each parameter are available as arrays of length
+    num_resonators through attribute access, as in FitterWithAttributeAccess: for example, batch.f_0 and
+    batch.f_0_error.
+    """
+
+    # These are the parameter names used by lmfit_resonator.LinearLossResonatorWithCable, in the order they are stored.
+    # The parameter f_min is fixed at the lowest frequency of each sweep and is not varied.
+    param_names = ('delay', 'phi', 'A_mag', 'A_slope', 'f_0', 'loss_i', 'loss_c', 'asymmetry', 'f_min')
+    num_varied = 8
+
+    def __init__(self, frequency, s21, errors=None, max_iterations=200, tolerance=1e-10):
+        """
+        Fit all of the resonators.
+
+        Points where the frequency, s21, or errors are not finite are excluded from the fit, as in BaseResonator.
+
+        Parameters
+        ----------
+        frequency : numpy.ndarray(float)
+            The frequencies, with shape (num_resonators, num_points); each row must be sorted in ascending order.
+        s21 : numpy.ndarray(complex)
+            The s21 data, with the same shape as frequency.
+        errors : numpy.ndarray(complex) or None
+            The errors on the real and imaginary parts of s21, with the same shape; None means use no errors.
+        max_iterations : int
+            The maximum number of Levenberg-Marquardt iterations for each resonator.
+        tolerance : float
+            A resonator has converged when an iteration reduces its chi-squared by less than this fraction.
+        """
+        frequency = np.atleast_2d(np.asarray(frequency, dtype=np.float))
+        s21 = np.atleast_2d(s21)
+        if not np.iscomplexobj(s21):
+            raise TypeError("Resonator s21 must be complex.")
+        if errors is not None:
+            errors = np.atleast_2d(errors)
+            if not np.iscomplexobj(errors):
+                raise TypeError("Resonator s21 errors must be complex.")
+        if frequency.shape != s21.shape or (errors is not None and errors.shape != s21.shape):
+            raise ValueError("The frequency, s21, and errors arrays must have the same shape.")
+        self.frequency = frequency
+        self.s21 = s21
+        self.errors = errors
+        mask = np.isfinite(frequency) & np.isfinite(s21)
+        if errors is None:
+            weights_real = weights_imag = np.ones(s21.shape)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                weights_real = 1 / errors.real
+                weights_imag = 1 / errors.imag
+            mask &= np.isfinite(weights_real) & np.isfinite(weights_imag)
+        if not np.all(np.any(mask, axis=1)):
+            raise ValueError("After masking NaNs, there is no data left to fit for some resonators!")
+        self.mask = mask
+        self._weights_real = np.where(mask, weights_real, 0)
+        self._weights_imag = np.where(mask, weights_imag, 0)
+        # Masked points have zero weight, so their values only need to be finite.
+        self._f = np.where(mask, frequency, np.nanmean(np.where(mask, frequency, np.nan), axis=1)[:, np.newaxis])
+        self._s21 = np.where(mask, s21, 0)
+        self.f_min = np.min(np.where(mask, frequency, np.inf), axis=1)
+        self._lower, self._upper = self._bounds()
+        self.initial_values = self.guess()
+        self.values = np.clip(self.initial_values, self._lower, self._upper)
+        self.chi_squared, self.num_iterations, self.success = self._fit(max_iterations, tolerance)
+        self.values[:, 1] = np.angle(np.exp(1j * self.values[:, 1]))  # Wrap phi into [-pi, pi].
+        self.num_data = 2 * np.sum(mask, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.redchi = self.chi_squared / (self.num_data - self.num_varied)
+        self.stderr = self._standard_errors()
+
+    def __getattr__(self, attr):
+        param_names = type(self).param_names
+        try:
+            if attr in param_names[:-1]:
+                return self.__dict__['values'][:, param_names.index(attr)]
+            elif attr.endswith('_error') and attr[:-len('_error')] in param_names[:-1]:
+                return self.__dict__['stderr'][:, param_names.index(attr[:-len('_error')])]
+        except KeyError:
+            pass
+        raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, attr))
+
+    @property
+    def num_resonators(self):
+        return self.s21.shape[0]
+
+    @property
+    def params(self):
+        """OrderedDict: the best-fit value of each parameter, as arrays of length num_resonators."""
+        return OrderedDict((name, getattr(self, name)) for name in self.param_names)
+
+    # These properties match those of LinearLossResonatorWithCable.
+
+    @property
+    def Q(self):
+        return 1 / (self.loss_i + self.loss_c)
+
+    @property
+    def Q_e(self):
+        return 1 / (self.loss_c * (1 + 1j * self.asymmetry))
+
+    @property
+    def Q_i(self):
+        return 1 / self.loss_i
+
+    def eval(self, frequency=None, values=None):
+        """
+        Evaluate the model for every resonator.
+
+        Parameters
+        ----------
+        frequency : numpy.ndarray(float)
+            The frequencies at which to evaluate the model, with shape (num_resonators, num_points); the default is the
+            data frequencies.
+        values : numpy.ndarray(float)
+            The parameter values, with shape (num_resonators, 8) in the order of param_names; the default is the fit.
+
+        Returns
+        -------
+        numpy.ndarray(complex)
+        """
+        if frequency is None:
+            frequency = self.frequency
+        if values is None:
+            values = self.values
+        return self._model(frequency, self.f_min, values)[0]
+
+    def resonator(self, number, **kwargs):
+        """
+        Return a LinearLossResonatorWithCable fit to the data for the given resonator, starting from the batch fit
+        values, so that lmfit should converge almost immediately.
+
+        Parameters
+        ----------
+        number : int
+            The index of the resonator.
+        kwargs
+            Passed to LinearLossResonatorWithCable; these override the starting values.
+
+        Returns
+        -------
+        lmfit_resonator.LinearLossResonatorWithCable
+        """
+        start = dict((name, float(getattr(self, name)[number])) for name in self.param_names)
+        start.update(kwargs)
+        errors = None if self.errors is None else self.errors[number]
+        return lmfit_resonator.LinearLossResonatorWithCable(frequency=self.frequency[number], s21=self.s21[number],
+                                                            errors=errors, **start)
+
+    def guess(self):
+        """
+        Return initial values with shape (num_resonators, 8), calculated as in GeneralCableModel.guess() and
+        LinearLossResonatorModel.guess() but for all resonators at once.
+        """
+        f = self._f
+        s21 = self._interpolate_masked(self._s21)
+        df = f - self.f_min[:, np.newaxis]
+        weights = self.mask.astype(np.float)
+        A_slope, A_mag = _linear_fit(df, np.abs(s21), weights)
+        phi_slope, phi = _linear_fit(df, np.unwrap(np.angle(s21), axis=1), weights)
+        delay = -phi_slope / (2 * np.pi)
+        A_slope = A_slope / A_mag
+        magnitude = np.abs(s21 / equations.general_cable(f, delay[:, np.newaxis], phi[:, np.newaxis],
+                                                         self.f_min[:, np.newaxis], A_mag[:, np.newaxis],
+                                                         A_slope[:, np.newaxis]))
+        magnitude = np.where(self.mask, magnitude, np.inf)
+        rows = np.arange(f.shape[0])
+        f_0 = f[rows, np.argmin(magnitude, axis=1)]
+        magnitude_min = np.min(magnitude, axis=1)
+        magnitude = self._interpolate_masked(np.where(self.mask, magnitude, np.nan))
+        width = f.shape[1] // 10
+        if width > 0:
+            gaussian = np.exp(-np.linspace(-4, 4, width) ** 2)
+            smoothed = ndimage.convolve1d(magnitude, gaussian / np.sum(gaussian), axis=1, mode='constant')
+            derivative = np.diff(smoothed, axis=1)[:, width - 1:-width]
+            linewidth = 1 / 2 * (f[rows, np.argmax(derivative, axis=1) + width] -
+                                 f[rows, np.argmin(derivative, axis=1) + width])
+        else:
+            linewidth = np.zeros(f.shape[0])
+        # Fall back to a linewidth equal to the point spacing if the smoothed derivative does not find the resonance.
+        spacing = (np.max(f, axis=1) - self.f_min) / max(1, f.shape[1] - 1)
+        linewidth = np.where(linewidth > 0, linewidth, spacing)
+        i_plus_c = linewidth / f_0
+        with np.errstate(divide='ignore'):
+            i_over_c = np.clip(1 / (1 / magnitude_min - 1), 0, np.inf)
+        loss_c = i_plus_c / (1 + i_over_c)
+        loss_i = np.where(np.isfinite(i_over_c), i_plus_c * i_over_c / (1 + i_over_c), i_plus_c)
+        return np.column_stack((delay, phi, A_mag, A_slope, f_0, loss_i, loss_c, np.zeros(f.shape[0])))
+
+    # Private methods
+
+    def _bounds(self):
+        num_resonators = self.s21.shape[0]
+        lower = np.tile([-np.inf, -np.inf, 0, -np.inf, 0, 0, 0, -10], (num_resonators, 1))
+        upper = np.tile([np.inf, np.inf, np.inf, np.inf, 0, 1, 1, 10], (num_resonators, 1))
+        lower[:, 4] = self.f_min
+        upper[:, 4] = np.max(np.where(self.mask, self.frequency, -np.inf), axis=1)
+        return lower, upper
+
+    def _interpolate_masked(self, array):
+        array = array.copy()
+        for row in np.flatnonzero(~np.all(self.mask, axis=1)):
+            good = self.mask[row]
+            if np.iscomplexobj(array):
+                array[row, ~good] = (np.interp(self._f[row, ~good], self._f[row, good], array[row, good].real) +
+                                     1j * np.interp(self._f[row, ~good], self._f[row, good], array[row, good].imag))
+            else:
+                array[row, ~good] = np.interp(self._f[row, ~good], self._f[row, good], array[row, good])
+        return array
+
+    @staticmethod
+    def _model(f, f_min, values, jacobian=False):
+        delay, phi, A_mag, A_slope, f_0, loss_i, loss_c, asymmetry = [values[:, k, np.newaxis] for k in range(8)]
+        f_min = f_min[:, np.newaxis]
+        cable = equations.general_cable(f, delay, phi, f_min, A_mag, A_slope)
+        resonator = equations.linear_loss_resonator(f, f_0, loss_i, loss_c, asymmetry)
+        model = cable * resonator
+        if not jacobian:
+            return model, None
+        df = f - f_min
+        phase = equations.cable_delay(f, delay, phi, f_min)
+        coupling = 1 + 1j * asymmetry
+        g = loss_c + loss_i + 2j * (f / f_0 - 1)
+        cable_over_g_squared = cable / g ** 2
+        derivatives = np.empty(model.shape + (8,), dtype=model.dtype)
+        derivatives[..., 0] = -2j * np.pi * df * model
+        derivatives[..., 1] = 1j * model
+        derivatives[..., 2] = (df * A_slope + 1) * phase * resonator
+        derivatives[..., 3] = A_mag * df * phase * resonator
+        derivatives[..., 4] = -2j * coupling * loss_c * cable_over_g_squared * f / f_0 ** 2
+        derivatives[..., 5] = coupling * loss_c * cable_over_g_squared
+        derivatives[..., 6] = -coupling * (g - loss_c) * cable_over_g_squared
+        derivatives[..., 7] = -1j * loss_c * cable / g
+        return model, derivatives
+
+    def _residual(self, rows, values, jacobian=False):
+        # Trial steps that reach a bound can produce NaN values; these steps are rejected.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            model, derivatives = self._model(self._f[rows], self.f_min[rows], values, jacobian=jacobian)
+        weights_real = self._weights_real[rows]
+        weights_imag = self._weights_imag[rows]
+        difference = model - self._s21[rows]
+        residual = np.concatenate((difference.real * weights_real, difference.imag * weights_imag), axis=1)
+        if not jacobian:
+            return residual, None
+        jacobian = np.concatenate((derivatives.real * weights_real[..., np.newaxis],
+                                   derivatives.imag * weights_imag[..., np.newaxis]), axis=1)
+        return residual, jacobian
+
+    @staticmethod
+    def _chi_squared(residual):
+        chi_squared = np.sum(residual ** 2, axis=1)
+        return np.where(np.isfinite(chi_squared), chi_squared, np.inf)
+
+    def _normal_equations(self, rows):
+        residual, jacobian = self._residual(rows, self.values[rows], jacobian=True)
+        curvature = np.einsum('nmp,nmq->npq', jacobian, jacobian)
+        gradient = np.einsum('nmp,nm->np', jacobian, residual)
+        # Scaling by the diagonal makes the problem dimensionless: the parameters differ by many orders of magnitude.
+        scale = np.sqrt(np.einsum('npp->np', curvature))
+        scale[~(scale > 0)] = 1
+        curvature /= scale[:, :, np.newaxis] * scale[:, np.newaxis, :]
+        gradient /= scale
+        return curvature, gradient, scale
+
+    def _fit(self, max_iterations, tolerance):
+        num_resonators = self.values.shape[0]
+        chi_squared = self._chi_squared(self._residual(np.arange(num_resonators), self.values)[0])
+        damping = np.full(num_resonators, 1e-3)
+        num_iterations = np.zeros(num_resonators, dtype=np.int)
+        active = np.ones(num_resonators, dtype=np.bool)
+        success = np.zeros(num_resonators, dtype=np.bool)
+        identity = np.eye(self.num_varied)
+        for iteration in range(max_iterations):
+            rows = np.flatnonzero(active)
+            if not rows.size:
+                break
+            curvature, gradient, scale = self._normal_equations(rows)
+            try:
+                step = np.linalg.solve(curvature + damping[rows, np.newaxis, np.newaxis] * identity,
+                                       -gradient[..., np.newaxis])[..., 0] / scale
+            except np.linalg.LinAlgError:
+                step = np.array([np.linalg.lstsq(c + d * identity, -g, rcond=None)[0] / s
+                                 for c, d, g, s in zip(curvature, damping[rows], gradient, scale)])
+            trial = np.clip(self.values[rows] + step, self._lower[rows], self._upper[rows])
+            trial_chi_squared = self._chi_squared(self._residual(rows, trial)[0])
+            improved = trial_chi_squared < chi_squared[rows]
+            converged = improved & (chi_squared[rows] - trial_chi_squared <= tolerance * chi_squared[rows])
+            self.values[rows[improved]] = trial[improved]
+            chi_squared[rows[improved]] = trial_chi_squared[improved]
+            damping[rows] = np.where(improved, damping[rows] / 10, damping[rows] * 10)
+            num_iterations[rows] += 1
+            # A resonator whose damping grows this large is at a minimum to within the numerical precision.
+            stalled = damping[rows] > 1e16
+            success[rows[converged | stalled]] = True
+            active[rows[converged | stalled]] = False
+        return chi_squared, num_iterations, success
+
+    def _standard_errors(self):
+        curvature, gradient, scale = self._normal_equations(np.arange(self.values.shape[0]))
+        stderr = np.full(self.values.shape, np.nan)
+        for row in range(curvature.shape[0]):
+            try:
+                covariance = np.linalg.inv(curvature[row]) / np.outer(scale[row], scale[row]) * self.redchi[row]
+            except np.linalg.LinAlgError:
+                continue
+            with np.errstate(invalid='ignore'):
+                stderr[row] = np.sqrt(np.diag(covariance))
+        return stderr
+
+
+def _linear_fit(x, y, weights):
+    """Return the slope and intercept of a weighted least-squares line fit along the last axis of each row."""
+    total = np.sum(weights, axis=1)
+    x_mean = np.sum(weights * x, axis=1) / total
+    y_mean = np.sum(weights * y, axis=1) / total
+    x_centered = x - x_mean[:, np.newaxis]
+    slope = (np.sum(weights * x_centered * (y - y_mean[:, np.newaxis]), axis=1) /
+             np.sum(weights * x_centered ** 2, axis=1))
+    return slope, y_mean - slope * x_mean
@@ -0,0 +1,128 @@
+"""
+This module contains vectorized functions that invert resonator models, converting s21 data to resonator parameters.
+
+The Khalil model and the Swenson nonlinear model can be inverted in closed form using detuning(). Other models can be
+inverted using newton(), which applies a Gauss-Newton iteration to every element of an array at once; it should be
+seeded with the closed-form solution of a similar model or with the nearest data point, as returned by nearest().
+"""
+from __future__ import division
+
+import numpy as np
+
+
+def detuning(s21_normalized, Q, Q_e, a=0):
+    """
+    Return the fractional frequency detuning and the inverse internal quality factor that correspond to the given s21
+    data, using the Khalil resonator model with the Swenson nonlinearity.
+
+    The model is s21 = 1 - (Q / Q_e) / (1 + 2j y), where y is the solution of y = y_0 + a / (1 + 4 y^2) and
+    y_0 = Q x is the generator detuning. Because y can be calculated directly from the data, the inverse exists in
+    closed form even when the resonator is bifurcated and the forward model is multivalued.
+
+    Parameters
+    ----------
+    s21_normalized : ndarray (complex)
+        The s21 data, normalized to 1 off-resonance.
+    Q : float
+        The loaded quality factor.
+    Q_e : complex
+        The complex coupling quality factor.
+    a : float
+        The nonlinearity parameter; the default of 0 is the linear model.
+
+    Returns
+    -------
+    ndarray (real)
+        The fractional frequency detuning x = f / f_0 - 1.
+    ndarray (real)
+        The inverse internal quality factor q = 1 / Q_i.
+    """
+    c = 1 / Q_e  # c is the inverse of the complex coupling quality factor.
+    z = c / (1 - s21_normalized)  # z = 1 / Q + 2j y / Q on the model
+    x = z.imag / 2  # This factor of two means S_xx = S_qq / 4 when amplifier-noise dominated.
+    if a:
+        y = Q * x
+        x = x - a / (Q * (1 + 4 * y ** 2))
+    q = z.real - np.real(c)
+    return x, q
+
+
+def newton(function, target, x0, relative_step=1e-9, xtol=1e-12, max_iterations=50):
+    """
+    Return the real values x that minimize abs(function(x) - target) for each element of target.
+
+    Each iteration is a Gauss-Newton step applied to all elements that have not yet converged, with the derivative
+    estimated by central differences, so the function is evaluated three times per iteration on a single array.
+
+    Parameters
+    ----------
+    function : callable
+        A function of a 1-D array of real values that returns an array of real or complex values of the same shape,
+        computed elementwise.
+    target : ndarray (real or complex)
+        The values to invert.
+    x0 : float or ndarray (real)
+        The starting values, broadcast to the shape of target.
+    relative_step : float
+        The step used to estimate the derivative, relative to abs(x).
+    xtol : float
+        An element has converged when its step is smaller than xtol * max(abs(x), 1).
+    max_iterations : int
+        The maximum number of iterations.
+
+    Returns
+    -------
+    ndarray (real)
+        The values of x, with the shape of target; elements that are not finite in either target or x0 are NaN.
+    """
+    target = np.asarray(target)
+    x = np.array(np.broadcast_to(x0, target.shape), dtype=np.float64)
+    flat_x = x.reshape(-1)
+    flat_target = target.reshape(-1)
+    finite = np.isfinite(flat_x) & np.isfinite(flat_target)
+    flat_x[~finite] = np.nan
+    active = np.flatnonzero(finite)
+    for iteration in range(max_iterations):
+        if not active.size:
+            break
+        x_active = flat_x[active]
+        h = relative_step * np.where(x_active == 0, 1, np.abs(x_active))
+        residual = function(x_active) - flat_target[active]
+        derivative = (function(x_active + h) - function(x_active - h)) / (2 * h)
+        step = np.real(np.conj(derivative) * residual) / np.abs(derivative) ** 2
+        flat_x[active] = x_active - step
+        # A step that is not finite also ends the iteration for that element.
+        active = active[np.abs(step) > xtol * np.maximum(np.abs(x_active), 1)]
+    return x
+
+
+def nearest(x_data, y_data, y, max_elements=2 ** 22):
+    """
+    Return the value of x_data at the point in y_data that is closest to each element of y.
+
+    Parameters
+    ----------
+    x_data : ndarray
+        The x-values of the data.
+    y_data : ndarray
+        The y-values of the data.
+    y : ndarray
+        The values for which to find the closest data point.
+    max_elements : int
+        The maximum number of distances to calculate at once, which limits memory use when y is large.
+
+    Returns
+    -------
+    ndarray
+        The values of x_data, with the shape of y.
+    """
+    x_data = np.asarray(x_data).reshape(-1)
+    y_data = np.asarray(y_data).reshape(-1)
+    y = np.asarray(y)
+    flat_y = y.reshape(-1)
+    indices = np.empty(flat_y.shape, dtype=np.intp)
+    chunk_size = max(1, max_elements // y_data.size)
+    for start in range(0, flat_y.size, chunk_size):
+        chunk = flat_y[start:start + chunk_size]
+        indices[start:start + chunk_size] = np.argmin(np.abs(chunk[:, np.newaxis] - y_data[np.newaxis, :]), axis=1)
+    return x_data[indices].reshape(y.shape)
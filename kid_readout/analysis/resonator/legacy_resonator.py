@@ -1,8 +1,8 @@
 from __future__ import division
-import warnings
 import numpy as np
 import scipy.stats
 from kid_readout.analysis import fitter
+from kid_readout.analysis.resonator import inversion
 
 # To use different defaults, change these three import statements.
 from kid_readout.analysis.resonator.khalil import delayed_generic_s21 as default_model
@@ -79,12 +79,7 @@ def fit_best_resonator(*args, **kwargs):
 
 # todo: move this elsewhere
 def normalized_s21_to_detuning(s21, resonator):
-    if 'a' in resonator.result.params:
-        warnings.warn("warning: inverse not yet defined for bifurcation model, proceeding anyway")
-    Q = resonator.Q
-    Qe = resonator.Q_e
-    x = 1j * (Qe * (s21 - 1) + Q) / (2 * Qe * Q * (s21 - 1))
-    return x.real
+    return resonator.invert(s21)[0]
 
 
 class Resonator(fitter.Fitter):
@@ -203,6 +198,34 @@ class Resonator(fitter.Fitter):
         gradient = y1 - y  # division by 1 Hz is implied.
         return gradient
 
+    def invert(self, s21_normalized):
+        """
+        Invert the resonator model in closed form and return the fractional frequency detuning x and the inverse
+        internal quality factor q that correspond to the given s21 data, which should be normalized to equal 1 far from
+        the resonance. If the model has a bifurcation parameter, the nonlinearity is included.
+
+        s21_normalized : complex or array of complex
+            normalized s21 data, such as the output of normalize()
+
+        returns : x, q as arrays of floats
+        """
+        if 'a' in self.result.params:
+            a = self.result.params['a'].value
+        else:
+            a = 0
+        return inversion.detuning(s21_normalized, Q=self.Q, Q_e=self.Q_e, a=a)
+
+    def inverse(self, y, params=None, guess=None):
+        """
+        Find the frequencies at which the model is closest to the given raw s21 values.
+
+        If guess is None and the fit parameters are used, the iteration starts at the closed-form solution from
+        invert(), with the data normalized at the resonance frequency.
+        """
+        if guess is None and params is None:
+            guess = self.f_0 * (1 + self.invert(self.normalize(self.f_0, y))[0])
+        return super(Resonator, self).inverse(y, params=params, guess=guess)
+
     def project_s21_to_delta_freq(self, freq, s21, use_data_mean=True, s21_already_normalized=False):
         """
         Project s21 data onto the orthogonal vectors tangent and perpendicular to the resonance circle at the 
@@ -5,7 +5,7 @@ import lmfit
 import numpy as np
 
 from kid_readout.analysis.lmfit_fitter import FitterWithAttributeAccess
-from kid_readout.analysis.resonator import lmfit_models
+from kid_readout.analysis.resonator import inversion, lmfit_models
 
 
 # This is a simple format for extracted resonator data, useful for plotting.
@@ -308,11 +308,29 @@ class LinearResonatorWithCable(BaseResonator):
                                                        model=_linear_resonator_with_cable, **kwargs)
 
     def invert(self, s21_normalized):
-        c = 1 / self.Q_e  # c is the inverse of the complex couping quality factor.
-        z = c / (1 - s21_normalized)
-        q = z.real - c.real
-        x = z.imag / 2  # This factor of two means S_xx = S_qq / 4 when amplifier-noise dominated.
-        return x, q
+        return inversion.detuning(s21_normalized, Q=self.Q, Q_e=self.Q_e)
+
+
+_nonlinear_resonator_model = lmfit_models.NonlinearResonatorModel()
+_nonlinear_resonator_with_cable = (_general_cable_model * _nonlinear_resonator_model)
+
+
+def _nonlinear_resonator_with_cable_guess(data, f=None, **kwargs):
+    params = _linear_resonator_with_cable_guess(data=data, f=f, **kwargs)
+    params.add('a', value=0, min=0, max=0.8)
+    return params
+
+
+_nonlinear_resonator_with_cable.guess = _nonlinear_resonator_with_cable_guess
+
+
+class NonlinearResonatorWithCable(BaseResonator):
+    def __init__(self, frequency, s21, errors, **kwargs):
+        super(NonlinearResonatorWithCable, self).__init__(frequency=frequency, s21=s21, errors=errors,
+                                                          model=_nonlinear_resonator_with_cable, **kwargs)
+
+    def invert(self, s21_normalized):
+        return inversion.detuning(s21_normalized, Q=self.Q, Q_e=self.Q_e, a=self.a)
 
 
 _background_resonator_model = lmfit_models.LinearResonatorModel(prefix='bg_')
@@ -384,10 +402,7 @@ class LinearLossResonatorWithCable(BaseResonator):
                                                            **kwargs)
 
     def invert(self, s21_normalized):
-        z = self.loss_c * (1j * self.asymmetry + s21_normalized) / (1 - s21_normalized)
-        x = z.imag / 2
-        q = z.real
-        return x, q
+        return inversion.detuning(s21_normalized, Q=self.Q, Q_e=self.Q_e)
 
     def guess(self):
         params = self.model.left.guess(data=self.s21, f=self.frequency)
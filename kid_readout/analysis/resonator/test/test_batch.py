@@ -0,0 +1,49 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import batch, equations, lmfit_resonator
+
+
+def fake_resonators(num_resonators=8, num_points=101, seed=123):
+    np.random.seed(seed)
+    f_0 = 1e8 * (1 + np.random.rand(num_resonators))
+    loss_i = 10 ** np.random.uniform(-5.5, -4.5, num_resonators)
+    loss_c = 10 ** np.random.uniform(-5.5, -4.5, num_resonators)
+    asymmetry = np.random.uniform(-0.3, 0.3, num_resonators)
+    span = 10 * (loss_i + loss_c) * f_0
+    f = f_0[:, np.newaxis] + span[:, np.newaxis] * np.linspace(-0.5, 0.5, num_points)
+    phi = np.random.uniform(-3, 3, num_resonators)
+    A_mag = np.random.uniform(0.5, 2, num_resonators)
+    s21 = (equations.general_cable(f, 30e-9, phi[:, np.newaxis], f.min(axis=1)[:, np.newaxis],
+                                   A_mag[:, np.newaxis], 0) *
+           equations.linear_loss_resonator(f, f_0[:, np.newaxis], loss_i[:, np.newaxis], loss_c[:, np.newaxis],
+                                           asymmetry[:, np.newaxis]))
+    sigma = 0.01 * A_mag[:, np.newaxis]
+    s21 += sigma * (np.random.randn(*f.shape) + 1j * np.random.randn(*f.shape))
+    errors = sigma * (1 + 1j) * np.ones(f.shape)
+    return f, s21, errors, f_0, loss_i, loss_c
+
+
+def test_batch_fit():
+    f, s21, errors, f_0, loss_i, loss_c = fake_resonators()
+    s21[2, 10] = np.nan
+    fit = batch.LinearLossResonatorWithCableBatch(frequency=f, s21=s21, errors=errors)
+    assert np.all(fit.success)
+    assert np.all(np.abs(fit.f_0 - f_0) < 5 * fit.f_0_error)
+    assert np.all(np.abs(fit.loss_i - loss_i) < 5 * fit.loss_i_error)
+    assert np.all(np.abs(fit.loss_c - loss_c) < 5 * fit.loss_c_error)
+    assert fit.eval().shape == s21.shape
+    for number in range(f.shape[0]):
+        mask = np.isfinite(s21[number])
+        single = lmfit_resonator.LinearLossResonatorWithCable(frequency=f[number, mask], s21=s21[number, mask],
+                                                              errors=errors[number, mask])
+        for name in ['f_0', 'loss_i', 'loss_c', 'asymmetry']:
+            error = getattr(fit, name + '_error')[number]
+            assert np.abs(getattr(single, name) - getattr(fit, name)[number]) < 0.5 * error
+            # lmfit cannot always estimate the errors, for example when phi is at one of its bounds.
+            if single.current_result.errorbars:
+                np.testing.assert_allclose(getattr(fit, name + '_error')[number], getattr(single, name + '_error'),
+                                           rtol=0.1)
+        # The batch fit should find a minimum at least as good as the one lmfit finds.
+        assert fit.chi_squared[number] <= single.current_result.chisqr * (1 + 1e-9)
+    resonator = fit.resonator(0)
+    assert np.abs(resonator.f_0 - fit.f_0[0]) < 0.1 * fit.f_0_error[0]
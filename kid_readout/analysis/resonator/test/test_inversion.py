@@ -0,0 +1,59 @@
+import numpy as np
+
+from kid_readout.analysis.resonator import equations, inversion, khalil, legacy_resonator, lmfit_resonator
+
+
+def test_detuning():
+    f_0, Q, Q_e = 100., 2e4, 3e4 + 1e4j
+    f = np.linspace(99.99, 100.01, 1001)
+    for a in [0, 0.3, 0.7]:
+        s21 = equations.nonlinear_resonator(f, f_0=f_0, Q=Q, Q_e_real=Q_e.real, Q_e_imag=Q_e.imag, a=a)
+        x, q = inversion.detuning(s21, Q=Q, Q_e=Q_e, a=a)
+        assert np.allclose(x, f / f_0 - 1, rtol=0, atol=1e-12)
+        assert np.allclose(q, 1 / Q - np.real(1 / Q_e), rtol=0, atol=1e-12)
+
+
+def test_newton():
+    params = khalil.create_model(f_0=100., Q=2e4, Q_e=3e4 + 1e4j, A=0.5 + 0.5j, delay=0.1, a=0.3)
+    f = np.linspace(99.99, 100.01, 1000)
+    s21 = khalil.bifurcation_s21(params, f)
+    s21_normalized = s21 / (khalil.cable_delay(params, f) * params['A_mag'].value)
+    seed = 100. * (1 + inversion.detuning(s21_normalized, Q=2e4, Q_e=3e4 + 1e4j)[0])
+    assert np.abs(seed - f).max() > 1e-4
+    inverse = inversion.newton(lambda x: khalil.bifurcation_s21(params, x), s21, seed)
+    assert np.abs(inverse - f).max() < 1e-9
+    s21[0] = np.nan
+    assert np.isnan(inversion.newton(lambda x: khalil.bifurcation_s21(params, x), s21, seed)[0])
+
+
+def test_nearest():
+    x_data = np.linspace(0, 1, 11)
+    y_data = x_data ** 2 + 1j * x_data
+    indices = np.array([[3, 0], [10, 7]])
+    y = y_data[indices] + 0.01
+    assert np.all(inversion.nearest(x_data, y_data, y, max_elements=20) == x_data[indices])
+
+
+def test_legacy_resonator():
+    params = khalil.create_model(f_0=100., Q=2e4, Q_e=3e4, A=1., delay=0.1)
+    params['f_phi'].value = 99.99
+    f = np.linspace(99.99, 100.01, 201)
+    np.random.seed(123)
+    s21 = khalil.delayed_generic_s21(params, f) + 1e-3 * (np.random.randn(f.size) + 1j * np.random.randn(f.size))
+    r = legacy_resonator.Resonator(f, s21)
+    f_stream = np.linspace(99.998, 100.002, 1000)
+    s21_stream = r.model(x=f_stream)
+    x, q = r.invert(r.normalize(f_stream, s21_stream))
+    assert np.allclose(x, f_stream / r.f_0 - 1, rtol=0, atol=1e-12)
+    assert np.allclose(legacy_resonator.normalized_s21_to_detuning(r.normalize(f_stream, s21_stream), r), x)
+    assert np.allclose(r.inverse(s21_stream), f_stream, rtol=0, atol=1e-9)
+
+
+def test_nonlinear_resonator_with_cable():
+    f = np.linspace(99.99, 100.01, 201)
+    s21 = (equations.general_cable(f, delay=0.1, phi=0.5, f_min=f.min(), A_mag=1., A_slope=0.) *
+           equations.nonlinear_resonator(f, f_0=100., Q=2e4, Q_e_real=3e4, Q_e_imag=0, a=0.3))
+    r = lmfit_resonator.NonlinearResonatorWithCable(frequency=f, s21=s21, errors=None)
+    assert 0 < r.a <= 0.8
+    x, q = r.invert_raw(f, r.eval(f))
+    assert np.allclose(x, f / r.f_0 - 1, rtol=0, atol=1e-10)
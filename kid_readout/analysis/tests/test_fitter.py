@@ -49,6 +49,17 @@ def test_dtype_agreement():
                 except TypeError:
                     pass
 
+def test_inverse():
+    x_data = np.linspace(100, 110, 10)
+    y_data = 2 * x_data + 1 + 1j * (x_data - 100) ** 2
+    f = kid_readout.analysis.fitter.Fitter(x_data=x_data, y_data=y_data, model=complex_dummy_model,
+                                           guess=complex_dummy_guess)
+    x = np.linspace(99, 111, 1000).reshape((10, 100))
+    assert np.allclose(f.inverse(f.model(x=x)), x)
+    assert np.allclose(f.inverse(f.model(x=x), guess=105), x)
+    assert np.isscalar(f.inverse(f.model(x=101.5))) and np.isclose(f.inverse(f.model(x=101.5)), 101.5)
+
+
 if __name__ == "__main__":
     test_dtype_agreement()
 
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.analysis.physics import kid_eqns, mbint
+
+
+def test_conductivity_table():
+    table = mbint.ConductivityTable(reduced_temperature=np.logspace(-2, 0, 60),
+                                    reduced_frequency=np.logspace(-4, 0, 30))
+    np.random.seed(123)
+    t = np.exp(np.random.uniform(np.log(0.01), 0, 20))
+    nu = np.exp(np.random.uniform(np.log(1e-4), 0, 20))
+    delta = 2e-4
+    with np.errstate(over='ignore'):
+        integrated1 = np.array([mbint._mb1(delta, delta * a, delta * b) for a, b in zip(t, nu)])
+        integrated2 = np.array([mbint._mb2(delta, delta * a, delta * b) for a, b in zip(t, nu)])
+        assert np.allclose(mbint.sigma1(delta, delta * t, delta * nu, table=table), integrated1, rtol=1e-3, atol=0)
+        assert np.allclose(mbint.sigma2(delta, delta * t, delta * nu, table=table), integrated2, rtol=1e-3, atol=0)
+        # Values outside the grid are integrated directly.
+        assert mbint.sigma1(delta, delta * 0.005, delta * 0.1, table=table) == mbint._mb1(delta, delta * 0.005,
+                                                                                          delta * 0.1)
+    with TempDirectory() as directory:
+        path = os.path.join(directory.path, 'table.npz')
+        table.save(path)
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(path).st_mode & 0o777 == 0o666 & ~umask
+        loaded = mbint.ConductivityTable.load(path)
+        assert np.all(loaded.sigma1_grid == table.sigma1_grid) and np.all(loaded.sigma2_grid == table.sigma2_grid)
+        assert np.all(loaded.sigma1(t, nu) == table.sigma1(t, nu))
+
+
+def test_mattis_bardeen_kid_model():
+    # At low temperature the conductivities approach the approximations used by KIDModel.
+    T = np.linspace(0.1, 0.3, 5)
+    approximate = kid_eqns.KIDModel(nqp0=0)
+    exact = kid_eqns.MattisBardeenKIDModel(table=mbint.ConductivityTable(), nqp0=0)
+    assert np.allclose(exact.sigma1(T), approximate.sigma1(T), rtol=0.02)
+    assert np.allclose(exact.sigma2(T), approximate.sigma2(T), rtol=1e-3)
+    assert exact.Qi(T).shape == T.shape
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from kid_readout.analysis import archive, kid_response, mcfit
+
+
+def _fake_response(num_points=20, break_point=1e-4, scale=1e-3):
+    np.random.seed(123)
+    frac_f0 = np.linspace(1e-6, 5e-4, num_points)
+    power = kid_response.fractional_freq_to_power(frac_f0, break_point, scale)
+    errors = 1e-2 * power + 1e-8
+    return frac_f0, power + errors * np.random.randn(num_points), errors
+
+
+def test_log_probability():
+    frac_f0, power, errors = _fake_response()
+    fit = kid_response.MCMCKidResponseFitter(frac_f0, power, errors=errors)
+    assert fit.parameter_list == ['break_point', 'scale']
+    log_probability = fit.log_probability()
+    values = np.array([[fit.break_point, fit.scale], [5e-5, 1e-3], [2e-4, 2e-3], [fit.break_point, 2]])
+    vectorized = log_probability(values)
+    log_probability.vectorize = False
+    assert np.allclose(log_probability(values), vectorized)
+    assert np.isinf(vectorized[-1])  # scale is outside its bounds.
+    for row, value in zip(values[:-1], vectorized[:-1]):
+        model = fit.model(params=mcfit.convert_to_lmfit_params(row, fit.result.params, fit.parameter_list))
+        assert np.isclose(value, np.sum(-np.log(errors) - 0.5 * ((power - model) / errors) ** 2))
+        assert np.isclose(fit.basic_logprob(row), value)
+
+
+def test_walker_pool():
+    frac_f0, power, errors = _fake_response()
+    log_probability = kid_response.MCMCKidResponseFitter(frac_f0, power, errors=errors).log_probability()
+    positions = [np.array([1e-4, 1e-3]) * (1 + 0.1 * k) for k in range(5)]
+    expected = list(log_probability(np.array(positions)))
+    pool = mcfit.WalkerPool(log_probability, processes=2)
+    try:
+        assert np.allclose(pool.map(None, positions), expected)
+    finally:
+        pool.close()
+    assert np.allclose(mcfit.WalkerPool(log_probability).map(None, positions), expected)
+
+
+def test_run():
+    frac_f0, power, errors = _fake_response()
+    for processes in [None, 2]:
+        np.random.seed(123)
+        fit = kid_response.MCMCKidResponseFitter(frac_f0, power, errors=errors)
+        fit.run(length=500, burn_in=400, processes=processes)
+        assert fit.samples.shape == (32 * 100, 2)
+        assert np.abs(fit.mcmc_params['break_point'].value / 1e-4 - 1) < 0.1
+        assert np.abs(fit.mcmc_params['scale'].value / 1e-3 - 1) < 0.1
+
+
+def _fake_response_row(resonator_id):
+    frac_f0, power, errors = _fake_response(break_point=1e-4 * (1 + resonator_id))
+    return pd.DataFrame({'resonator_id': resonator_id, 'f_0': 100 * (1 - frac_f0), 'zbd_power': power,
+                         'sweep_primary_load_temperature': 4.})
+
+
+def test_apply_by_group():
+    df = pd.concat([_fake_response_row(resonator_id) for resonator_id in range(2)], ignore_index=True)
+    function = archive.build_response_fit_function(mcmc_length=500, mcmc_burn_in=400)
+    for processes in [None, 2]:
+        fits = archive.apply_by_group(df, function, 'resonator_id', processes=processes)
+        assert fits.shape[0] == df.shape[0]
+        assert list(fits.resonator_id.unique()) == [0, 1]
+        break_points = fits.groupby('resonator_id').response_break_point.first()
+        assert break_points[1] > 1.5 * break_points[0]
@@ -2,9 +2,15 @@
 This module contains functions for binning spectral densities.
 """
 from __future__ import division
+import hashlib
+from collections import OrderedDict
 
 import numpy as np
 
+# The number of (frequency, bins_per_decade) combinations for which the bin assignments are cached; see _log_bins().
+LOG_BIN_CACHE_SIZE = 16
+_log_bin_cache = OrderedDict()
+
 
 def log_bin_edges(frequency, bins_per_decade, ensure_none_empty):
     """
@@ -69,7 +75,8 @@ def log_bin(frequency, bins_per_decade, *data):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data : ndarrays
-        The data arrays.
+        The data arrays, which may be complex. The last axis of each array corresponds to frequency, so a 2-D array
+        with shape (num_channels, frequency.size) bins the spectra of all channels at once.
 
     Returns
     -------
@@ -80,7 +87,8 @@ def log_bin(frequency, bins_per_decade, *data):
     ndarray(float)
         Each element is the mean of all the frequency points that lie in the corresponding bin.
     list of ndarray
-        The binned data arrays, where each array element is the mean of all data in the corresponding bin.
+        The binned data arrays, where each array element is the mean of all data in the corresponding bin; the last
+        axis has one element per bin.
 
     Examples
     --------
@@ -90,13 +98,9 @@ def log_bin(frequency, bins_per_decade, *data):
     Unpacking multiple data arrays:
     edges, counts, f_mean, [binned_data1, binned_data2] = log_bin(f, 10, data1, data2)
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
-    binned_data = [np.array([np.mean(d[bin_indices == n]) for n in indices_used]) for d in data]
-    return edges, counts, mean_frequency, binned_data
+    edges, bin_number, counts, mean_frequency = _log_bins(frequency, bins_per_decade)
+    binned_data = [_bin_sum(bin_number, counts.size, d) / counts for d in data]
+    return edges.copy(), counts.copy(), mean_frequency.copy(), binned_data
 
 
 def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
@@ -114,7 +118,8 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     bins_per_decade : int
         The number of histogram bins per decade of frequency.
     data_and_variance : (ndarray, ndarray)
-        Tuples containing arrays of the data and corresponding variance.
+        Tuples containing arrays of the data and corresponding variance; as for log_bin(), the last axis of each array
+        corresponds to frequency.
 
     Returns
     -------
@@ -135,16 +140,49 @@ def log_bin_with_variance(frequency, bins_per_decade, *data_and_variance):
     Unpacking multiple pairs:
     edges, counts, f_mean, [(bd1, bv1), (bd2, bv2)] = log_bin_with_variance(f, 10, (d1, v1), (d2, v2))
     """
-    edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
-    bin_indices = np.digitize(frequency, edges)
-    indices_used = np.unique(bin_indices)
-    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
-    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
+    edges, bin_number, counts, mean_frequency = _log_bins(frequency, bins_per_decade)
     binned_dv = []
     for d, v in data_and_variance:
-        binned_dv.append((np.array([np.mean(d[bin_indices == n]) for n in indices_used]),
-                          np.array([np.mean(v[bin_indices == n]) / c for n, c in zip(indices_used, counts)])))
-    return edges, counts, mean_frequency, binned_dv
+        binned_dv.append((_bin_sum(bin_number, counts.size, d) / counts,
+                          _bin_sum(bin_number, counts.size, v) / counts ** 2))
+    return edges.copy(), counts.copy(), mean_frequency.copy(), binned_dv
+
+
+def _log_bins(frequency, bins_per_decade):
+    """
+    Return the bin edges, the index of the used bin that contains each frequency, the number of frequencies in each
+    used bin, and the mean frequency in each used bin. The results are cached, because the spectra of many channels
+    are usually binned using the same frequencies; the cached arrays must not be modified.
+    """
+    frequency = np.ascontiguousarray(frequency)
+    key = (bins_per_decade, frequency.dtype.str, frequency.shape, hashlib.sha1(frequency).hexdigest())
+    try:
+        result = _log_bin_cache.pop(key)
+    except KeyError:
+        edges = log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
+        indices_used, bin_number = np.unique(np.digitize(frequency, edges), return_inverse=True)
+        counts = np.bincount(bin_number, minlength=indices_used.size)
+        mean_frequency = np.bincount(bin_number, weights=frequency, minlength=indices_used.size) / counts
+        result = (edges, bin_number, counts, mean_frequency)
+        while len(_log_bin_cache) >= LOG_BIN_CACHE_SIZE:
+            _log_bin_cache.popitem(last=False)
+    _log_bin_cache[key] = result  # The most recently used entry is last.
+    return result
+
+
+def _bin_sum(bin_number, num_bins, data):
+    """
+    Return the sum of the data in each bin along the last axis, in one pass through the data.
+    """
+    data = np.asarray(data)
+    if np.iscomplexobj(data):
+        return _bin_sum(bin_number, num_bins, data.real) + 1j * _bin_sum(bin_number, num_bins, data.imag)
+    leading_shape = data.shape[:-1]
+    num_rows = int(np.prod(leading_shape))
+    # Offset the bins of each row so that all rows are summed by a single call.
+    row_bin_number = (bin_number + num_bins * np.arange(num_rows)[:, np.newaxis]).ravel()
+    sums = np.bincount(row_bin_number, weights=data.reshape((num_rows, -1)).ravel(), minlength=num_rows * num_bins)
+    return sums.reshape(leading_shape + (num_bins,))
 
 
 # These are the left bin edges: they stop before the highest frequency.
@@ -1,6 +1,7 @@
 import random
 import numpy as np
 from matplotlib import pyplot as plt
+from scipy import ndimage
 from scipy.ndimage import filters
 import scipy.signal
 from kid_readout.analysis.timeseries.fftfilt import fftfilt
@@ -97,39 +98,132 @@ def deglitch_mask_block_mad(ts,thresh=5,mask_extend=50,debug=False):
 
 
 def deglitch_mask_mad(ts,thresh=5,mask_extend=50,window_length=2**8):
-    full_mask = np.zeros(ts.shape,dtype='bool')
+    """
+    Return a boolean mask that is True for samples that deviate from the median by more than thresh times the median
+    absolute deviation (MAD), extended by mask_extend - 1 samples on each side.
+
+    The median and MAD are calculated in windows of length window_length that overlap by half, and each half-window of
+    the mask comes from the window that starts with it, except that the last window is used in full; any samples
+    beyond the last complete half-window are not masked. This is the same as applying deglitch_mask_block_mad() to
+    each window in turn, but all windows are processed at once using a strided view.
+
+    Parameters
+    ----------
+    ts : ndarray(real)
+        The time series; if it has more than one dimension, each series along the last axis is processed separately,
+        so all channels of a StreamArray can be deglitched at once.
+    thresh : float
+        The threshold in units of the MAD.
+    mask_extend : int
+        The mask is extended by this number of samples minus one on either side of each glitch.
+    window_length : int
+        The number of samples in each window.
+
+    Returns
+    -------
+    ndarray(bool)
+        The mask, with the same shape as ts.
+    """
+    ts = np.asarray(ts)
+    length = ts.shape[-1]
     step = window_length//2
-    if step > ts.shape[0]:
-        step = ts.shape[0]
-    nstep = ts.shape[0]//step
-    for k in xrange(nstep):
-        start = k-1
-        if start < 0:
-            start = 0
-        chunk = ts[start*step:(k+1)*step]
-        mask = deglitch_mask_block_mad(chunk,thresh=thresh,mask_extend=mask_extend)
-        full_mask[start*step:((start+1)*step)] |= mask[:step]
-    full_mask[start*step:start*step+len(mask)] |= mask
+    if step > length:
+        step = length
+    nstep = length//step
+    full_mask = np.zeros(ts.shape,dtype='bool')
+    # The first window contains only one half-window.
+    full_mask[..., :step] = _mad_mask(ts[..., np.newaxis, :step], thresh, mask_extend)[..., 0, :]
+    if nstep > 1:
+        mask = _mad_mask(_windows(ts, step, nstep - 1), thresh, mask_extend)
+        halves = full_mask[..., :(nstep - 1) * step].reshape(ts.shape[:-1] + (nstep - 1, step))
+        halves |= mask[..., :step]
+        full_mask[..., :(nstep - 1) * step] = halves.reshape(ts.shape[:-1] + ((nstep - 1) * step,))
+        full_mask[..., (nstep - 2) * step:nstep * step] |= mask[..., -1, :]
     return full_mask
 
+
 def mask_glitches(ts_list,mask,window_length):
+    """
+    Return copies of the given time series in which each masked sample is replaced by an unmasked sample drawn at
+    random from a nearby window.
+
+    The windows are the same as those used by deglitch_mask_mad(): a masked sample in a half-window is replaced by a
+    sample from the window that starts with that half-window, or from the last window for samples in the last
+    half-window. Unlike in deglitch_mask_mad(), the window length is not reduced for short series, so if a series is
+    shorter than half of window_length then no samples are replaced. The same replacement samples are used for every
+    series, so that series derived from the same data, such as x and q, remain consistent.
+
+    Parameters
+    ----------
+    ts_list : ndarray or list of ndarray
+        The time series, all with the same shape; as in deglitch_mask_mad(), each series along the last axis is
+        processed separately.
+    mask : ndarray(bool)
+        The mask, with the same shape as the time series.
+    window_length : int
+        The number of samples in each window.
+
+    Returns
+    -------
+    list of ndarray
+        The cleaned time series.
+
+    Raises
+    ------
+    ValueError
+        If every sample in a window that contains masked samples is masked.
+    """
     if type(ts_list) is np.ndarray:
         ts_list = [ts_list]
+    mask = np.asarray(mask, dtype='bool')
+    length = ts_list[0].shape[-1]
     step = window_length//2
-    nstep = ts_list[0].shape[0]//step
-    clean_ts = [ts.copy() for ts in ts_list]
-    for k in xrange(nstep):
-        start = k-1
-        if start < 0:
-            start = 0
-        local_mask = mask[start*step:(k+1)*step]
-        for clean in clean_ts:
-            chunk = clean[start*step:(k+1)*step]
-            nmask = local_mask.sum()
-            if nmask:
-                chunk[local_mask] = np.random.choice(chunk[~local_mask],nmask)
+    nstep = length//step
+    clean_ts = [np.array(ts, copy=True) for ts in ts_list]
+    if not nstep:
+        return clean_ts
+    rows = mask.reshape((-1, length))
+    if nstep > 1:
+        num_windows = nstep - 1
+        window_mask = _windows(rows, step, num_windows)
+    else:
+        num_windows = 1
+        window_mask = rows[:, np.newaxis, :step]
+    row, position = np.nonzero(rows[:, :nstep * step])
+    window = np.minimum(position // step, num_windows - 1)
+    unmasked = ~window_mask.reshape((-1, window_mask.shape[-1]))
+    counts = unmasked.sum(axis=1)
+    row_window = row * num_windows + window
+    if np.any(counts[row_window] == 0):
+        raise ValueError("All samples in a window are masked.")
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    choice = (np.random.random_sample(row.size) * counts[row_window]).astype(int)
+    source = np.flatnonzero(unmasked)[offsets[row_window] + choice] % unmasked.shape[1] + window * step
+    for clean in clean_ts:
+        clean_rows = clean.reshape((-1, length))
+        clean_rows[row, position] = clean_rows[row, source]
     return clean_ts
 
+
+def _windows(ts, step, num_windows):
+    """Return a read-only strided view of ts with shape ts.shape[:-1] + (num_windows, 2 * step)."""
+    return np.lib.stride_tricks.as_strided(ts, shape=ts.shape[:-1] + (num_windows, 2 * step),
+                                           strides=ts.strides[:-1] + (step * ts.strides[-1], ts.strides[-1]),
+                                           writeable=False)
+
+
+def _mad_mask(windows, thresh, mask_extend):
+    """Apply deglitch_mask_block_mad() to each window along the last axis of the given array."""
+    median = np.median(windows, axis=-1)
+    deviations = np.abs(windows - median[..., np.newaxis])
+    mad = np.median(deviations, axis=-1)
+    mask = deviations > (mad[..., np.newaxis]*thresh)
+    if mask_extend > 1:
+        structure = np.ones((1,) * (mask.ndim - 1) + (2 * mask_extend - 1,), dtype='bool')
+        mask = ndimage.binary_dilation(mask, structure=structure)
+    return mask
+
+
 def deglitch_new(ts,thresh=6,mask_extend=50,window_length=2**16):
     clean,mask = deglitch_mask_mad(np.abs(ts),thresh=thresh,mask_extend=mask_extend,window_length=window_length)
     clean = ts.copy()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from kid_readout.analysis.timeseries import binning
+
+
+def _reference_log_bin(frequency, bins_per_decade, data):
+    # This is the original implementation, which is O(num_bins * frequency.size).
+    edges = binning.log_bin_edges(frequency, bins_per_decade=bins_per_decade, ensure_none_empty=True)
+    bin_indices = np.digitize(frequency, edges)
+    indices_used = np.unique(bin_indices)
+    counts = np.array([np.sum([bin_indices == n]) for n in indices_used])
+    mean_frequency = np.array([np.mean(frequency[bin_indices == n]) for n in indices_used])
+    binned_data = np.array([np.mean(data[bin_indices == n]) for n in indices_used])
+    return edges, counts, mean_frequency, binned_data
+
+
+def test_log_bin():
+    random_state = np.random.RandomState(0)
+    for frequency in [np.linspace(0, 1e4, 2 ** 12 + 1), np.linspace(0, 1e4, 2 ** 12 + 1)[1:]]:
+        data = random_state.standard_normal(frequency.size) + 1j * random_state.standard_normal(frequency.size)
+        edges, counts, mean_frequency, binned = _reference_log_bin(frequency, 10, data)
+        for k in range(2):  # The second call uses the cached bins.
+            e, c, f, [b] = binning.log_bin(frequency, 10, data)
+            assert np.all(e == edges) and np.all(c == counts)
+            assert np.allclose(f, mean_frequency) and np.allclose(b, binned)
+        variance = data.real ** 2
+        e, c, f, [(b, v)] = binning.log_bin_with_variance(frequency, 10, (data, variance))
+        assert np.allclose(b, binned)
+        assert np.allclose(v, _reference_log_bin(frequency, 10, variance)[3] / counts)
+
+
+def test_log_bin_many_channels():
+    frequency = np.linspace(0, 1e3, 2 ** 10 + 1)
+    data = np.random.standard_normal((3, 4, frequency.size))
+    edges, counts, mean_frequency, [binned] = binning.log_bin(frequency, 30, data)
+    assert binned.shape == (3, 4, counts.size)
+    for index in np.ndindex(3, 4):
+        assert np.allclose(binned[index], binning.log_bin(frequency, 30, data[index])[3][0])
+    binning.log_bin(frequency, 30, data)[1][:] = 0  # The returned arrays are not the cached arrays.
+    assert np.all(binning.log_bin(frequency, 30, data)[1] == counts)
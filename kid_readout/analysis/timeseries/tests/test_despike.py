@@ -0,0 +1,65 @@
+import numpy as np
+from kid_readout.analysis.timeseries import despike
+
+
+def looped_deglitch_mask_mad(ts, thresh, mask_extend, window_length):
+    full_mask = np.zeros(ts.shape, dtype='bool')
+    step = min(window_length // 2, ts.shape[0])
+    nstep = ts.shape[0] // step
+    for k in xrange(nstep):
+        start = max(k - 1, 0)
+        mask = despike.deglitch_mask_block_mad(ts[start * step:(k + 1) * step], thresh=thresh,
+                                               mask_extend=mask_extend)
+        full_mask[start * step:((start + 1) * step)] |= mask[:step]
+    full_mask[start * step:start * step + len(mask)] |= mask
+    return full_mask
+
+
+def glitchy(num_channels, num_samples):
+    ts = np.random.randn(num_channels, num_samples)
+    for channel in range(num_channels):
+        glitches = np.random.randint(0, num_samples, size=5)
+        ts[channel, glitches] += 30 * np.random.randn(glitches.size)
+    return ts
+
+
+def test_deglitch_mask_mad():
+    np.random.seed(123)
+    ts = glitchy(3, 5000)
+    for window_length in [2 ** 6, 2 ** 8, 2 ** 10, 2 ** 16]:
+        for mask_extend in [1, 2, 50]:
+            mask = despike.deglitch_mask_mad(ts, thresh=5, mask_extend=mask_extend, window_length=window_length)
+            assert mask.shape == ts.shape
+            for channel in range(ts.shape[0]):
+                expected = looped_deglitch_mask_mad(ts[channel], 5, mask_extend, window_length)
+                assert np.all(despike.deglitch_mask_mad(ts[channel], thresh=5, mask_extend=mask_extend,
+                                                        window_length=window_length) == expected)
+                assert np.all(mask[channel] == expected)
+
+
+def test_mask_glitches():
+    np.random.seed(123)
+    window_length = 2 ** 8
+    step = window_length // 2
+    x = glitchy(2, 4000)
+    q = 2 * x
+    mask = despike.deglitch_mask_mad(x, thresh=5, mask_extend=10, window_length=window_length)
+    assert mask.any()
+    clean_x, clean_q = despike.mask_glitches([x, q], mask=mask, window_length=window_length)
+    assert np.all(clean_x[~mask] == x[~mask])
+    assert np.all(clean_q == 2 * clean_x)
+    num_windows = x.shape[1] // step - 1
+    for channel, position in zip(*np.nonzero(mask)):
+        window = min(position // step, num_windows - 1)
+        source = x[channel, window * step:(window + 2) * step][~mask[channel, window * step:(window + 2) * step]]
+        assert clean_x[channel, position] in source
+    # The last few samples are in no complete half-window and are left alone.
+    tail = mask.copy()
+    tail[:, :-1] = False
+    tail[:, -1] = True
+    assert np.all(despike.mask_glitches(x, mask=tail, window_length=window_length)[0] == x)
+    try:
+        despike.mask_glitches(x, mask=np.ones(x.shape, dtype='bool'), window_length=window_length)
+        assert False
+    except ValueError:
+        pass
@@ -0,0 +1,33 @@
+import numpy as np
+from matplotlib import mlab
+
+from kid_readout.analysis.timeseries import welch
+
+
+def check_against_mlab(a, b, chunk_size, **kwds):
+    accumulator = welch.CrossSpectralDensityAccumulator(sample_rate=1e3, **kwds)
+    for start in range(0, a.size, chunk_size):
+        accumulator.update(a[start:start + chunk_size], b[start:start + chunk_size])
+    f, S_aa, S_bb, S_ab = accumulator.spectra()
+    mlab_kwds = dict(kwds)
+    mlab_kwds.setdefault('noverlap', kwds['NFFT'] // 2)
+    mlab_kwds.setdefault('window', mlab.window_none)
+    S_aa_mlab, f_mlab = mlab.psd(a, Fs=1e3, **mlab_kwds)
+    S_bb_mlab, f_mlab = mlab.psd(b, Fs=1e3, **mlab_kwds)
+    S_ab_mlab, f_mlab = mlab.csd(a, b, Fs=1e3, **mlab_kwds)
+    assert np.all(f == f_mlab)
+    np.testing.assert_allclose(S_aa, S_aa_mlab, rtol=1e-12)
+    np.testing.assert_allclose(S_bb, S_bb_mlab, rtol=1e-12)
+    np.testing.assert_allclose(S_ab, S_ab_mlab, rtol=1e-12, atol=1e-12 * np.abs(S_ab_mlab).max())
+    assert accumulator.num_samples == a.size
+
+
+def test_cross_spectral_density_accumulator():
+    np.random.seed(0)
+    a = np.random.randn(10000)
+    b = 0.5 * a + np.random.randn(a.size)
+    for chunk_size in [a.size, 1000, 333, 7]:
+        check_against_mlab(a, b, chunk_size, NFFT=256)
+    check_against_mlab(a, b, 1000, NFFT=255, noverlap=100, window=mlab.window_hanning, detrend=mlab.detrend_mean)
+    check_against_mlab(a, b, 1000, NFFT=256, noverlap=0, pad_to=300, scale_by_freq=False)
+    check_against_mlab(a[:100], b[:100], 30, NFFT=256)  # Fewer samples than NFFT are zero-padded.
@@ -0,0 +1,176 @@
+"""
+This module contains a Welch spectral density estimator that processes data in chunks.
+"""
+from __future__ import division
+
+import numpy as np
+from matplotlib import mlab
+
+
+class CrossSpectralDensityAccumulator(object):
+    """
+    Accumulate Welch estimates of the auto-spectral densities of two real time series a and b and of their
+    cross-spectral density, one chunk at a time.
+
+    The data can be supplied in chunks of any size, for example as they are read from disk or acquired, and only the
+    samples that belong to an incomplete segment are kept between calls to update(). Each segment is detrended,
+    windowed, and transformed once, and all three spectra are calculated from the same transforms. The results are
+    equal to those of mlab.psd(a), mlab.psd(b), and mlab.csd(a, b) called with the same arguments on the concatenated
+    data, up to rounding in the sum over segments.
+
+    Examples
+    --------
+    accumulator = CrossSpectralDensityAccumulator(NFFT=2**16, sample_rate=sample_rate)
+    for a_chunk, b_chunk in chunks:
+        accumulator.update(a_chunk, b_chunk)
+    f, S_aa, S_bb, S_ab = accumulator.spectra()
+    """
+
+    def __init__(self, NFFT, sample_rate, noverlap=None, window=mlab.window_none, detrend=mlab.detrend_none,
+                 pad_to=None, scale_by_freq=True, sides='default'):
+        """
+        Parameters
+        ----------
+        NFFT : int
+            The number of samples in each segment; should be a power of two for speed.
+        sample_rate : float
+            The sample rate of both time series.
+        noverlap : int or None
+            The number of samples by which consecutive segments overlap; if None, a value equal to half of NFFT is used.
+        window : callable or ndarray
+            A function that takes a time series as argument and returns a windowed time series, or an array of
+            window values with length NFFT.
+        detrend : callable
+            A function that takes a time series as argument and returns a detrended time series.
+        pad_to : int or None
+            The number of points to which each segment is zero-padded before the FFT; if None, NFFT is used.
+        scale_by_freq : bool
+            If True, return densities per unit frequency, as mlab.psd() does by default.
+        sides : str
+            Only one-sided spectra of real time series are supported, so this must be 'default' or 'onesided'.
+        """
+        if sides not in ('default', 'onesided', None):
+            raise ValueError("Only one-sided spectra of real time series are supported, not sides={!r}".format(sides))
+        if noverlap is None:
+            noverlap = NFFT // 2
+        if noverlap >= NFFT:
+            raise ValueError("noverlap must be less than NFFT.")
+        self.NFFT = int(NFFT)
+        self.noverlap = int(noverlap)
+        self.sample_rate = sample_rate
+        self.window = window
+        self.detrend = detrend
+        self.pad_to = self.NFFT if pad_to is None else int(pad_to)
+        self.scale_by_freq = True if scale_by_freq is None else scale_by_freq
+        self.num_samples = 0
+        self.num_segments = 0
+        self._buffer_a = np.empty(0)
+        self._buffer_b = np.empty(0)
+        self._sum_aa = self._sum_bb = self._sum_ab = 0
+
+    @property
+    def num_frequencies(self):
+        if self.pad_to % 2:
+            return (self.pad_to + 1) // 2
+        else:
+            return self.pad_to // 2 + 1
+
+    def update(self, a, b):
+        """
+        Add the next chunk of both time series; the chunks must have equal length.
+
+        Parameters
+        ----------
+        a : ndarray(real)
+            The next chunk of time series a.
+        b : ndarray(real)
+            The next chunk of time series b.
+        """
+        a = np.asarray(a)
+        b = np.asarray(b)
+        if a.shape != b.shape or a.ndim != 1:
+            raise ValueError("The chunks must be one-dimensional arrays with equal length.")
+        if np.iscomplexobj(a) or np.iscomplexobj(b):
+            raise ValueError("Only real time series are supported.")
+        self.num_samples += a.size
+        buffer_a = np.concatenate((self._buffer_a, a))
+        buffer_b = np.concatenate((self._buffer_b, b))
+        step = self.NFFT - self.noverlap
+        if buffer_a.size >= self.NFFT:
+            transform_a = self._transform(buffer_a)
+            transform_b = self._transform(buffer_b)
+            self._accumulate(transform_a, transform_b)
+            used = transform_a.shape[1] * step
+            buffer_a = buffer_a[used:]
+            buffer_b = buffer_b[used:]
+        self._buffer_a = buffer_a.copy()
+        self._buffer_b = buffer_b.copy()
+
+    def spectra(self):
+        """
+        Return the spectral densities of all of the data so far.
+
+        As in mlab, if fewer than NFFT samples have been supplied, they are zero-padded to form a single segment.
+
+        Returns
+        -------
+        f : ndarray(float)
+            The non-negative frequencies.
+        S_aa : ndarray(float)
+            The auto-spectral density of a, equal to mlab.psd(a).
+        S_bb : ndarray(float)
+            The auto-spectral density of b, equal to mlab.psd(b).
+        S_ab : ndarray(complex)
+            The cross-spectral density of a and b, equal to mlab.csd(a, b).
+        """
+        if self.num_segments:
+            sum_aa, sum_bb, sum_ab, num_segments = self._sum_aa, self._sum_bb, self._sum_ab, self.num_segments
+        elif self.num_samples:
+            padded_a = np.zeros(self.NFFT, dtype=self._buffer_a.dtype)
+            padded_a[:self._buffer_a.size] = self._buffer_a
+            padded_b = np.zeros(self.NFFT, dtype=self._buffer_b.dtype)
+            padded_b[:self._buffer_b.size] = self._buffer_b
+            transform_a = self._transform(padded_a)
+            transform_b = self._transform(padded_b)
+            sum_aa = np.sum(np.conj(transform_a) * transform_a, axis=1)
+            sum_bb = np.sum(np.conj(transform_b) * transform_b, axis=1)
+            sum_ab = np.sum(np.conj(transform_a) * transform_b, axis=1)
+            num_segments = 1
+        else:
+            raise ValueError("No data have been supplied.")
+        scale = np.ones(self.num_frequencies)
+        # The DC component and, for even NFFT, the NFFT/2 component are not doubled, as in mlab.
+        if not self.NFFT % 2:
+            scale[1:-1] = 2
+        else:
+            scale[1:] = 2
+        window_values = self._window_values()
+        if self.scale_by_freq:
+            scale /= self.sample_rate * np.sum(np.abs(window_values) ** 2)
+        else:
+            scale /= np.abs(window_values).sum() ** 2
+        f = np.fft.fftfreq(self.pad_to, 1 / self.sample_rate)[:self.num_frequencies]
+        if not self.pad_to % 2:
+            f[-1] *= -1
+        S_aa = (sum_aa * scale / num_segments).real
+        S_bb = (sum_bb * scale / num_segments).real
+        S_ab = sum_ab * scale / num_segments
+        return f, S_aa, S_bb, S_ab
+
+    def _window_values(self):
+        if callable(self.window):
+            return self.window(np.ones(self.NFFT, dtype=self._buffer_a.dtype))
+        return np.asarray(self.window)
+
+    def _transform(self, x):
+        """Return the FFTs of all complete segments of x, with shape (num_frequencies, num_segments)."""
+        segments = mlab.stride_windows(x, self.NFFT, self.noverlap, axis=0)
+        segments = mlab.detrend(segments, self.detrend, axis=0)
+        segments = mlab.apply_window(segments, self.window, axis=0)
+        return np.fft.fft(segments, n=self.pad_to, axis=0)[:self.num_frequencies, :]
+
+    def _accumulate(self, transform_a, transform_b):
+        self._sum_aa = self._sum_aa + np.sum(np.conj(transform_a) * transform_a, axis=1)
+        self._sum_bb = self._sum_bb + np.sum(np.conj(transform_b) * transform_b, axis=1)
+        self._sum_ab = self._sum_ab + np.sum(np.conj(transform_a) * transform_b, axis=1)
+        self.num_segments += transform_a.shape[1]
@@ -30,6 +30,8 @@ import time
 import inspect
 import subprocess
 import logging
+import threading
+import Queue
 
 import numpy as np
 
@@ -51,7 +53,7 @@ def load_heterodyne_sweep_tones(ri, tone_banks, num_tone_samples):
 
 
 def run_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, description='', verbose=False,
-              wait_for_sync=True, **kwargs):
+              wait_for_sync=True, pipeline=False, io=None, node_path=None, **kwargs):
     """
     Return a SweepArray acquired using the given tone banks.
 
@@ -73,7 +75,17 @@ def run_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, de
     verbose : bool
         If true, print progress messages.
     wait_for_sync : bool
-        If true, sleep for a short time to let the ROACH sync finish.
+        If true, let the ROACH sync finish before capturing data. Readouts that detect the sync from the packet
+        sequence numbers do this without delay; otherwise, sleep for a short time.
+    pipeline : bool
+        If true, demodulate the data from each tone bank and create its StreamArray in a separate thread while the
+        next tone bank is loaded and captured; see run_pipelined().
+    io : IO
+        If given, write the SweepArray to this IO before acquiring any data and write each StreamArray as soon as it
+        is acquired, so that the data acquired so far are on disk if the sweep is interrupted and the StreamArrays are
+        not held in memory; the returned SweepArray is read from the IO.
+    node_path : str
+        The node path of the SweepArray in io; the default is the next default name.
     kwargs
         Keyword arguments passed to ri.get_measurement().
 
@@ -81,24 +93,29 @@ def run_sweep(ri, tone_banks, num_tone_samples, length_seconds=0, state=None, de
     -------
     SweepArray
     """
-    stream_arrays = core.MeasurementList()
-    if verbose:
-        print("Measuring bank")
-    for n, tone_bank in enumerate(tone_banks):
+    def measurements():
         if verbose:
-            print n,
-            sys.stdout.flush()
-        ri.set_tone_freqs(tone_bank, nsamp=num_tone_samples)
-        ri.select_fft_bins(np.arange(tone_bank.size))
-        # we wait a bit here to let the roach2 sync catch up.  figuring this out still.
-        if wait_for_sync:
-            time.sleep(0.1)
-        stream_arrays.append(ri.get_measurement(num_seconds=length_seconds, **kwargs))
-    return basic.SweepArray(stream_arrays, state=state, description=description)
+            print("Measuring bank")
+        for n, tone_bank in enumerate(tone_banks):
+            if verbose:
+                print n,
+                sys.stdout.flush()
+            ri.set_tone_freqs(tone_bank, nsamp=num_tone_samples)
+            ri.select_fft_bins(np.arange(tone_bank.size))
+            # we wait a bit here to let the roach2 sync catch up.  figuring this out still.
+            # Readouts that detect the sync from sequence numbers wait in the next capture instead, until the packet
+            # counter restart is observed or the same delay has passed.
+            if wait_for_sync and not ri.SYNC_FROM_SEQUENCE_NUMBERS:
+                time.sleep(0.1)
+            yield _measure(ri, length_seconds, pipeline, kwargs)
+
+    sweep_array = _new_sweep_array(state, description, io, node_path)
+    _collect(measurements(), pipeline, sweep_array.stream_arrays)
+    return _written(sweep_array)
 
 
 def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank_indices=None, bin_indices=None,
-                     verbose=False, **kwargs):
+                     verbose=False, pipeline=False, io=None, node_path=None, **kwargs):
     """
     Return a SweepArray acquired using previously-loaded tones.
 
@@ -119,6 +136,15 @@ def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank
         The indices of the filterbank bins to read out; the default is to read out all bins.
     verbose : bool
         If true, print progress messages.
+    pipeline : bool
+        If true, demodulate the data from each tone bank and create its StreamArray in a separate thread while the
+        next tone bank is selected and captured; see run_pipelined().
+    io : IO
+        If given, write the SweepArray to this IO before acquiring any data and write each StreamArray as soon as it
+        is acquired, so that the data acquired so far are on disk if the sweep is interrupted and the StreamArrays are
+        not held in memory; the returned SweepArray is read from the IO.
+    node_path : str
+        The node path of the SweepArray in io; the default is the next default name.
     kwargs
         Keyword arguments passed to ri.get_measurement().
 
@@ -130,36 +156,238 @@ def run_loaded_sweep(ri, length_seconds=0, state=None, description='', tone_bank
         tone_bank_indices = np.arange(ri.tone_bins.shape[0])
     if bin_indices is None:
         bin_indices = np.arange(ri.tone_bins.shape[1])
-    stream_arrays = core.MeasurementList()
-    if verbose:
-        print "Measuring bank:",
-    for tone_bank_index in tone_bank_indices:
-        if verbose:
-            print tone_bank_index,
-            sys.stdout.flush()
-        ri.select_bank(tone_bank_index)
-        ri.select_fft_bins(bin_indices)
-        stream_arrays.append(ri.get_measurement(num_seconds=length_seconds, **kwargs))
-    return basic.SweepArray(stream_arrays, state=state, description=description)
-
-
-def run_multipart_sweep(ri, length_seconds=0, state=None, description='', num_tones_read_at_once=32, verbose=False,
-                        **kwargs):
-    num_tones = ri.tone_bins.shape[1]
-    num_steps = num_tones // num_tones_read_at_once
-    if num_steps == 0:
-        num_steps = 1
-    indices_to_read = range(num_tones)
-    parts = []
-    for step in range(num_steps):
+    sweep_array = _new_sweep_array(state, description, io, node_path)
+    _collect(_loaded_sweep_measurements(ri, length_seconds, tone_bank_indices, [bin_indices], verbose, pipeline,
+                                        kwargs), pipeline, sweep_array.stream_arrays)
+    return _written(sweep_array)
+
+
+def _loaded_sweep_measurements(ri, length_seconds, tone_bank_indices, groups, verbose, pipeline, kwargs):
+    for group in groups:
         if verbose:
-            print("running sweep step {} of {}.".format(step,num_steps))
-        parts.append(run_loaded_sweep(ri, length_seconds=length_seconds, state=state, description=description,
-                                      bin_indices=indices_to_read[step::num_steps], **kwargs))
-    stream_arrays = core.MeasurementList()
-    for part in parts:
-        stream_arrays.extend(list(part.stream_arrays))
-    return basic.SweepArray(stream_arrays, state=state, description=description)
+            print "Measuring bank:",
+        for tone_bank_index in tone_bank_indices:
+            if verbose:
+                print tone_bank_index,
+                sys.stdout.flush()
+            ri.select_bank(tone_bank_index)
+            ri.select_fft_bins(group)
+            yield _measure(ri, length_seconds, pipeline, kwargs)
+
+
+def run_pipelined(captures, max_pending=2, results=None):
+    """
+    Return a list of the results of calling each function yielded by captures, in order.
+
+    Each function is called in a worker thread while the iteration over captures continues in the calling thread, so
+    if the iteration captures data from the ROACH and each function demodulates the data and creates a StreamArray,
+    as with RoachInterface.capture_measurement(), the processing of one measurement overlaps the capture of the next.
+    If a function raises an exception, the iteration stops and the exception is raised in the calling thread.
+
+    Parameters
+    ----------
+    captures : iterable of callable
+        Functions with no arguments, such as those returned by RoachInterface.capture_measurement().
+    max_pending : int
+        The maximum number of functions waiting to be called; when this is reached, the iteration waits, which limits
+        the memory used by captured data.
+    results : list
+        If given, the return value of each function is appended to this list, which can be an IOList, as soon as it
+        is available; it is appended to from the worker thread.
+
+    Returns
+    -------
+    list
+        The return values of the functions.
+    """
+    pending = Queue.Queue(maxsize=max_pending)
+    if results is None:
+        results = []
+    errors = []
+
+    def work():
+        while True:
+            finish = pending.get()
+            if finish is None:
+                return
+            if not errors:
+                try:
+                    results.append(finish())
+                except Exception:
+                    errors.append(sys.exc_info())
+
+    worker = threading.Thread(target=work, name='run_pipelined')
+    worker.daemon = True
+    worker.start()
+    try:
+        for finish in captures:
+            if errors:
+                break
+            pending.put(finish)
+    finally:
+        pending.put(None)
+        worker.join()
+    if errors:
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+
+def _measure(ri, length_seconds, pipeline, kwargs):
+    if pipeline:
+        return ri.capture_measurement(num_seconds=length_seconds, **kwargs)
+    else:
+        return ri.get_measurement(num_seconds=length_seconds, **kwargs)
+
+
+def _collect(measurements, pipeline, stream_arrays):
+    if pipeline:
+        run_pipelined(measurements, results=stream_arrays)
+    else:
+        for stream_array in measurements:
+            stream_arrays.append(stream_array)
+
+
+def _new_sweep_array(state, description, io, node_path):
+    if io is None:
+        return basic.SweepArray(core.MeasurementList(), state=state, description=description)
+    sweep_array = basic.SweepArray(core.IOList(), state=state, description=description)
+    io.write(sweep_array, node_path)
+    return sweep_array
+
+
+def _written(sweep_array):
+    """
+    Return the given SweepArray, or if its StreamArrays were written directly to disk, the SweepArray read from disk.
+    """
+    if isinstance(sweep_array.stream_arrays, core.IOList):
+        return sweep_array._io.read(sweep_array._io_node_path)
+    return sweep_array
+
+
+def run_multipart_sweep(ri, length_seconds=0, state=None, description='', num_tones_read_at_once=None, verbose=False,
+                        pipeline=False, link_bytes_per_second=None, revisit_depth=None, revisit_num_waveforms=16,
+                        io=None, node_path=None, **kwargs):
+    """
+    Return a SweepArray acquired using previously-loaded tones, reading out the tones in interleaved groups that are as
+    large as the link allows, and optionally revisiting the tones that are near a resonance with a denser sweep.
+
+    The StreamArrays from each group are added to the same SweepArray, or written to disk, as they are acquired. If
+    revisit_depth is given, then after all groups have been read each tone whose smallest |S21| is less than
+    (1 - revisit_depth) times its median |S21| is swept again with revisit_num_waveforms frequencies spanning one
+    coarse step on either side of that minimum; this replaces the loaded tones. The SweepArray contains the StreamArrays
+    from both passes, and its properties return the values from all of them in ascending frequency order.
+
+    Parameters
+    ----------
+    ri : RoachInterface
+        An instance of a subclass.
+    length_seconds : float
+        The duration of each data stream; the default of 0 means the minimum unit of data that can be read out in the
+        current configuration.
+    state : dict
+        The non-roach state to pass to the SweepArray.
+    description : str
+        A human-readable description of the measurement.
+    num_tones_read_at_once : int
+        The maximum number of tones to read out at once; the default is ri.max_num_channels(link_bytes_per_second).
+        Before the default was derived from the link budget it was 32, so callers that relied on groups of 32 tones
+        should now pass num_tones_read_at_once=32.
+    verbose : bool
+        If true, print progress messages.
+    pipeline : bool
+        If true, demodulate the data in a separate thread while the next tone bank is captured; see run_pipelined().
+    link_bytes_per_second : float
+        The usable rate of the link used to calculate the default num_tones_read_at_once; the default is
+        ri.LINK_BYTES_PER_SECOND.
+    revisit_depth : float or None
+        The minimum fractional depth of the |S21| dip for a tone to be revisited; if None, do not revisit.
+    revisit_num_waveforms : int
+        The number of frequencies at which each revisited tone is measured; this is limited by the number of waveforms
+        that fit in the DRAM.
+    io : IO
+        If given, write the SweepArray to this IO before acquiring any data and write each StreamArray as soon as it
+        is acquired, so that the data acquired so far are on disk if the sweep is interrupted and the StreamArrays are
+        not held in memory; the returned SweepArray is read from the IO.
+    node_path : str
+        The node path of the SweepArray in io; the default is the next default name.
+    kwargs
+        Keyword arguments passed to ri.get_measurement().
+
+    Returns
+    -------
+    SweepArray
+    """
+    if num_tones_read_at_once is None:
+        num_tones_read_at_once = ri.max_num_channels(link_bytes_per_second)
+    tone_bank_indices = np.arange(ri.tone_bins.shape[0])
+    groups = interleaved_groups(ri.tone_bins.shape[1], num_tones_read_at_once)
+    if verbose:
+        print("Reading {} tones in {} groups.".format(ri.tone_bins.shape[1], len(groups)))
+    sweep_array = _new_sweep_array(state, description, io, node_path)
+    _collect(_loaded_sweep_measurements(ri, length_seconds, tone_bank_indices, groups, verbose, pipeline, kwargs),
+             pipeline, sweep_array.stream_arrays)
+    if revisit_depth is not None:
+        frequency = np.empty(ri.tone_bins.shape)
+        s21 = np.empty(ri.tone_bins.shape, dtype=np.complex)
+        for stream_array, tone_bank_index in zip(_written(sweep_array).stream_arrays,
+                                                 np.tile(tone_bank_indices, len(groups))):
+            frequency[tone_bank_index, stream_array.tone_index] = stream_array.frequency
+            s21[tone_bank_index, stream_array.tone_index] = stream_array.s21_point
+        if ri.DRAM_SIZE_BYTES is not None:
+            revisit_num_waveforms = min(revisit_num_waveforms, ri.max_num_waveforms(ri.tone_nsamp))
+        revisit_frequency = dense_revisit_frequencies(frequency, s21, revisit_depth, revisit_num_waveforms)
+        if revisit_frequency.shape[1]:
+            if verbose:
+                print("Revisiting {} tones.".format(revisit_frequency.shape[1]))
+            ri.set_tone_freqs(freqs=1e-6 * revisit_frequency, nsamp=ri.tone_nsamp)
+            groups = interleaved_groups(revisit_frequency.shape[1], num_tones_read_at_once)
+            _collect(_loaded_sweep_measurements(ri, length_seconds, np.arange(revisit_frequency.shape[0]), groups,
+                                                verbose, pipeline, kwargs), pipeline, sweep_array.stream_arrays)
+    return _written(sweep_array)
+
+
+def interleaved_groups(num_tones, max_group_size):
+    """
+    Return a list of the fewest arrays of tone indices, each with at most max_group_size indices, that together contain
+    each index in range(num_tones) once. Each group takes every len(groups)-th tone, so the tones in a group are as far
+    apart as possible.
+    """
+    num_groups = max(1, int(np.ceil(num_tones / max_group_size)))
+    return [np.arange(first, num_tones, num_groups) for first in range(num_groups)]
+
+
+def dense_revisit_frequencies(frequency, s21, depth, num_waveforms):
+    """
+    Return the frequencies for a denser sweep of the tones that are near a resonance.
+
+    Parameters
+    ----------
+    frequency : ndarray(float)
+        The frequencies of a sweep, with shape (num_waveforms, num_tones); each tone is swept in steps that are
+        assumed to be evenly spaced.
+    s21 : ndarray(complex)
+        The S21 values at these frequencies.
+    depth : float
+        A tone is near a resonance if its smallest |S21| is less than (1 - depth) times its median |S21|.
+    num_waveforms : int
+        The number of frequencies at which to measure each revisited tone.
+
+    Returns
+    -------
+    ndarray(float)
+        The frequencies with shape (num_waveforms, num_revisited_tones); for each tone, they span one step on either
+        side of the frequency with the smallest |S21|.
+    """
+    amplitude = np.abs(s21)
+    minimum = amplitude.argmin(axis=0)
+    tones = np.flatnonzero(amplitude.min(axis=0) < (1 - depth) * np.median(amplitude, axis=0))
+    if frequency.shape[0] > 1:
+        step = np.median(np.abs(np.diff(np.sort(frequency[:, tones], axis=0), axis=0)), axis=0)
+    else:
+        step = np.zeros(tones.size)
+    center = frequency[minimum[tones], tones]
+    return center + np.linspace(-1, 1, num_waveforms)[:, np.newaxis] * step
 
 
 # Metadata
@@ -5,6 +5,7 @@ from __future__ import division
 import time
 from collections import OrderedDict
 import logging
+import multiprocessing
 
 import numpy as np
 import pandas as pd
@@ -13,8 +14,8 @@ from scipy import signal
 from memoized_property import memoized_property
 
 from kid_readout.measurement import core
-from kid_readout.analysis.resonator import lmfit_resonator
-from kid_readout.analysis.timeseries import binning, despike, iqnoise, periodic
+from kid_readout.analysis.resonator import batch, lmfit_resonator
+from kid_readout.analysis.timeseries import binning, despike, iqnoise, periodic, welch
 from kid_readout.roach import calculate
 
 logger = logging.getLogger(__name__)
@@ -159,7 +160,12 @@ class RoachStream(RoachMeasurement):
         numpy.ndarray(complex)
            The mean of s21_raw for each channel.
         """
-        return np.nanmean(self.s21_raw, axis=-1)
+        s21_raw = self.s21_raw
+        if isinstance(s21_raw, core.LazyArray):
+            if s21_raw.nbytes > s21_raw.chunk_bytes:
+                return self._s21_raw_moments[1]
+            s21_raw = np.asarray(s21_raw)
+        return np.nanmean(s21_raw, axis=-1)
 
     @memoized_property
     def s21_raw_mean_error(self):
@@ -178,16 +184,32 @@ class RoachStream(RoachMeasurement):
         numpy.ndarray(complex)
             An estimate of the complex standard error of the mean of s21_raw.
         """
+        s21_raw = self.s21_raw
+        if isinstance(s21_raw, core.LazyArray):
+            if s21_raw.nbytes > s21_raw.chunk_bytes:
+                num_good_samples, mean, std = self._s21_raw_moments
+                num_good_samples = np.where(num_good_samples == 0, np.nan, num_good_samples)
+                return std / np.sqrt(num_good_samples)
+            s21_raw = np.asarray(s21_raw)
         # The float cast allows conversion to NaN.
-        num_good_samples = np.sum(~np.isnan(self.s21_raw), axis=-1).astype(np.float)
+        num_good_samples = np.sum(~np.isnan(s21_raw), axis=-1).astype(np.float)
         if isinstance(num_good_samples, np.ndarray):
             # Avoid a ZeroDivisionError if some of the channels have no good samples.
             num_good_samples[num_good_samples == 0] = np.nan
         elif num_good_samples == 0:  # num_good_samples is a scalar; avoid a ZeroDivisionError.
             num_good_samples = np.nan
-        return ((np.nanstd(self.s21_raw.real, axis=-1) + 1j * np.nanstd(self.s21_raw.imag, axis=-1)) /
+        return ((np.nanstd(s21_raw.real, axis=-1) + 1j * np.nanstd(s21_raw.imag, axis=-1)) /
                 np.sqrt(num_good_samples))
 
+    @memoized_property
+    def _s21_raw_moments(self):
+        """
+        Return (number of good samples, mean, complex standard deviation) of s21_raw for each channel, calculated
+        one chunk at a time so that a LazyArray larger than its chunk_bytes is never read into memory all at once. NaN
+        samples are excluded.
+        """
+        return chunked_nan_moments(self.s21_raw.iter_chunks())
+
     @property
     def s21_point(self):
         """
@@ -206,6 +228,33 @@ class RoachStream(RoachMeasurement):
         """
         return self.s21_raw_mean_error
 
+    def s21_raw_glitch_mask(self, threshold=8, window_in_seconds=1, mask_extend_samples=50):
+        """
+        Return a boolean array with the same shape as s21_raw that is True for samples in which either the real or the
+        imaginary part of s21_raw is a glitch, as detected by despike.deglitch_mask_mad(). All channels are processed
+        at once.
+
+        Parameters
+        ----------
+        threshold : float
+            The threshold in units of the median absolute deviation.
+        window_in_seconds : float
+            The approximate window length; the number of samples is rounded up to a power of two.
+        mask_extend_samples : int
+            The mask is extended by this number of samples minus one on either side of each glitch.
+
+        Returns
+        -------
+        numpy.ndarray(bool)
+            The glitch mask.
+        """
+        window_samples = int(2 ** np.ceil(np.log2(window_in_seconds * self.stream_sample_rate)))
+        s21_raw = np.asarray(self.s21_raw)
+        return (despike.deglitch_mask_mad(s21_raw.real, thresh=threshold, window_length=window_samples,
+                                          mask_extend=mask_extend_samples) |
+                despike.deglitch_mask_mad(s21_raw.imag, thresh=threshold, window_length=window_samples,
+                                          mask_extend=mask_extend_samples))
+
     def fold(self, array, period_samples=None, reduce=np.mean):
         if period_samples is None:
             period_samples = calculate.modulation_period_samples(self.roach_state)
@@ -593,6 +642,31 @@ class SweepArray(RoachMeasurement):
         return model(frequency=self.frequency[mask], s21=self.s21_point_foreground[mask],
                      errors=self.s21_point_error_foreground[mask])
 
+    def fit_resonators(self, **kwargs):
+        """
+        Fit a LinearLossResonatorWithCable to every channel at once and return the batch fit.
+
+        This is much faster than fitting each SingleSweep, and batch.resonator(number) returns a resonator for a single
+        channel that starts from the batch fit values.
+
+        Parameters
+        ----------
+        kwargs
+            Passed to batch.LinearLossResonatorWithCableBatch.
+
+        Returns
+        -------
+        batch.LinearLossResonatorWithCableBatch
+        """
+        frequency = np.column_stack([sa.frequency for sa in self.stream_arrays])
+        order = frequency.argsort(axis=1)
+        return batch.LinearLossResonatorWithCableBatch(
+            frequency=np.take_along_axis(frequency, order, axis=1),
+            s21=np.take_along_axis(np.column_stack([sa.s21_point for sa in self.stream_arrays]), order, axis=1),
+            errors=np.take_along_axis(np.column_stack([sa.s21_point_error for sa in self.stream_arrays]), order,
+                                      axis=1),
+            **kwargs)
+
     def to_dataframe(self, add_origin=True, one_sweep_per_row=True):
         """
 
@@ -828,6 +902,60 @@ class SweepStreamArray(RoachMeasurement):
             dataframes.append(self.sweep_stream(number).to_dataframe())
         return pd.concat(dataframes, ignore_index=True)
 
+    def analyze_all(self, processes=None, **kwargs):
+        """
+        Analyze every channel using a pool of processes and return the same rows as to_dataframe().
+
+        Each worker process opens the file or directory from which this measurement was read, using the same IO class
+        with lazy=True, and reads only the data for the channels it analyzes, so no arrays are sent between processes.
+        A measurement that was not read from disk, or that was read using an IO class that does not support lazy
+        loading, is analyzed in this process.
+
+        Parameters
+        ----------
+        processes : int or None
+            The number of worker processes; the default is the number of CPUs. If 1, no pool is created.
+        kwargs
+            Keyword arguments passed to SingleSweepStream.to_dataframe().
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per channel, in channel order.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = min(processes, self.num_channels)
+        if processes <= 1 or self._io is None or not self._io.SUPPORTS_LAZY:
+            if processes > 1:
+                logger.warning("This SweepStreamArray was not read from disk using an IO class that supports lazy "
+                               "loading, so it will be analyzed in one process.")
+            return pd.concat([self.sweep_stream(number).to_dataframe(**kwargs) for number in range(self.num_channels)],
+                             ignore_index=True)
+        pool = multiprocessing.Pool(processes=processes, initializer=_open_analysis_node,
+                                    initargs=(self._io.__class__, self._io.root_path, self._io_node_path))
+        try:
+            dataframes = pool.map(_analyze_sweep_stream, [(number, kwargs) for number in range(self.num_channels)],
+                                  chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return pd.concat(dataframes, ignore_index=True)
+
+
+# The node analyzed by each worker process created by SweepStreamArray.analyze_all().
+_analysis_node = None
+
+
+def _open_analysis_node(io_class, root_path, node_path):
+    global _analysis_node
+    _analysis_node = io_class(root_path, lazy=True).read(node_path)
+
+
+def _analyze_sweep_stream(number_and_kwargs):
+    number, kwargs = number_and_kwargs
+    return _analysis_node.sweep_stream(number).to_dataframe(**kwargs)
+
 
 class SingleSweepStream(RoachMeasurement):
 
@@ -1144,10 +1272,14 @@ class SingleSweepStream(RoachMeasurement):
         return self.S_qq_variance / 16
 
     def set_S(self, NFFT=None, window=mlab.window_none, detrend=mlab.detrend_none, noverlap=None, binned=True,
-              bins_per_decade=30, masking_function=None, **psd_kwds):
+              bins_per_decade=30, masking_function=None, accumulator=None, **psd_kwds):
         """
         Calculate the spectral density of self.x and self.q and set the related properties.
 
+        The spectra are calculated in a single pass using a welch.CrossSpectralDensityAccumulator. To calculate them
+        from data that are not held in memory, for example during acquisition, feed chunks of x and q to an accumulator
+        and pass it as the accumulator argument; in this case the spectral arguments are taken from the accumulator.
+
         Parameters
         ----------
         NFFT : int or None
@@ -1166,23 +1298,26 @@ class SingleSweepStream(RoachMeasurement):
         masking_function : callable
             A function that takes the frequency and all spectral densities as inputs and produces a boolean mask used
             to remove points from them.
+        accumulator : welch.CrossSpectralDensityAccumulator or None
+            If not None, an accumulator that has been fed x as its first time series and q as its second; if None,
+            one is created and fed self.x and self.q.
         psd_kwds : dict
-            Additional keywords to pass to mlab.psd and mlab.csd.
+            Additional keywords to pass to welch.CrossSpectralDensityAccumulator: pad_to, scale_by_freq, and sides,
+            which have the same meaning as in mlab.psd and mlab.csd.
 
         Returns
         -------
         None
         """
-        if NFFT is None:
-            NFFT = int(2**(np.floor(np.log2(self.stream.s21_raw.size)) - 3))
-        if noverlap is None:
-            noverlap = NFFT // 2
-        S_qq, f = mlab.psd(self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xx, f = mlab.psd(self.x, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
-        S_xq, f = mlab.csd(self.x, self.q, Fs=self.stream.stream_sample_rate, NFFT=NFFT, window=window, detrend=detrend,
-                           noverlap=noverlap, **psd_kwds)
+        if accumulator is None:
+            if NFFT is None:
+                NFFT = int(2**(np.floor(np.log2(self.stream.s21_raw.size)) - 3))
+            accumulator = welch.CrossSpectralDensityAccumulator(NFFT=NFFT, sample_rate=self.stream.stream_sample_rate,
+                                                                noverlap=noverlap, window=window, detrend=detrend,
+                                                                **psd_kwds)
+            accumulator.update(self.x, self.q)
+        NFFT = accumulator.NFFT
+        f, S_xx, S_qq, S_xq = accumulator.spectra()
         if masking_function is not None:
             mask = masking_function(f, S_xx, S_qq, S_xq)
             f = f[mask]
@@ -1200,7 +1335,7 @@ class SingleSweepStream(RoachMeasurement):
         # spectra that are averaged. Assume that the variance of the value in a bin is equal to the square of the value
         # in that bin divided by the number of degrees of freedom. Using nonzero overlap will complicate this, but let's
         # ignore that. It's also not clear that this is correct for the cross-spectrum.
-        ndof = 2 * self.x.size // NFFT
+        ndof = 2 * accumulator.num_samples // NFFT
         if binned:
             edges, counts, f_mean, d_and_v = binning.log_bin_with_variance(f, bins_per_decade,
                                                                            (S_xx, S_xx**2 / ndof),
@@ -1455,3 +1590,57 @@ class Scan(core.Measurement):
             sweep_arrays = core.MeasurementList(sweep_arrays)
         self.sweep_arrays = sweep_arrays
         super(Scan, self).__init__(state=state, description=description)
+
+
+def chunked_nan_moments(chunks):
+    """
+    Calculate the number of non-NaN values and their mean and standard deviation along the last axis of an array that
+    is supplied in chunks, without holding more than one chunk in memory.
+
+    The chunks are combined using the pairwise update of Chan, Golub, and LeVeque, which is numerically stable. The
+    results match those of numpy.nanmean() and numpy.nanstd() with ddof=0, and the standard deviation of complex data
+    is returned as std(real) + 1j * std(imag).
+
+    Parameters
+    ----------
+    chunks : iterable of numpy.ndarray
+        Consecutive chunks of the array along its last axis; all other dimensions must match.
+
+    Returns
+    -------
+    count : numpy.ndarray(float)
+        The number of non-NaN values.
+    mean : numpy.ndarray
+        The mean of the non-NaN values, or NaN if there are none.
+    std : numpy.ndarray
+        The standard deviation of the non-NaN values, or NaN if there are none.
+    """
+    count = mean = m2_real = m2_imag = None
+    for chunk in chunks:
+        good = ~np.isnan(chunk)
+        chunk_count = np.sum(good, axis=-1).astype(np.float)
+        chunk_sum = np.sum(np.where(good, chunk, 0), axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk_mean = np.where(chunk_count > 0, chunk_sum / chunk_count, 0)
+        deviation = np.where(good, chunk - chunk_mean[..., np.newaxis], 0)
+        chunk_m2_real = np.sum(deviation.real ** 2, axis=-1)
+        chunk_m2_imag = np.sum(deviation.imag ** 2, axis=-1)
+        if count is None:
+            count, mean, m2_real, m2_imag = chunk_count, chunk_mean, chunk_m2_real, chunk_m2_imag
+            continue
+        total = count + chunk_count
+        delta = chunk_mean - mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(total > 0, chunk_count / total, 0)
+        mean = mean + delta * weight
+        m2_real = m2_real + chunk_m2_real + np.real(delta) ** 2 * count * weight
+        m2_imag = m2_imag + chunk_m2_imag + np.imag(delta) ** 2 * count * weight
+        count = total
+    if count is None:
+        raise ValueError("No chunks to process.")
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, mean, np.nan)
+        std = np.sqrt(m2_real / count)
+        if np.iscomplexobj(mean):
+            std = std + 1j * np.sqrt(m2_imag / count)
+    return count, mean, std
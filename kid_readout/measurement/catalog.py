@@ -0,0 +1,431 @@
+"""
+This module contains a catalog of the measurements stored in data files, kept in a local SQLite database.
+
+Finding a measurement otherwise requires opening every file in the data directories. The catalog records, for every
+Measurement node in every NCFile and NumpyDirectory under the given directories, its class, node path, start and stop
+epochs, number of channels, tone frequency range, description, and the scalar values in its state and roach_state,
+along with the file location and the cryostat recorded in the file metadata. Updating the catalog re-indexes only files
+that have been modified since they were last indexed, and queries use only the database.
+
+Container measurements, such as a SweepStreamArray, have the epoch and frequency range of all of their contents, and the
+roach_state values that are shared by all of their contents, so they can be found using the roach_state of the streams
+they contain.
+
+Usage:
+  catalog = Catalog('/data/catalog.sqlite')
+  catalog.update(['/data/readout'])
+  entries = catalog.find(class_name='SweepStreamArray', start_epoch=start, stop_epoch=stop,
+                         roach_state={'dac_attenuation': 20})
+  sweep_stream_array = entries[0].read()
+"""
+from __future__ import division
+import os
+import sqlite3
+import logging
+from numbers import Number
+from collections import namedtuple
+
+import numpy as np
+
+from kid_readout import settings
+from kid_readout.roach import calculate
+from kid_readout.measurement import core, classes
+from kid_readout.measurement.io import nc, npy
+
+logger = logging.getLogger(__name__)
+
+# Each entry maps a file or directory extension to the name of the IO class that reads it.
+IO_CLASS_NAMES = {nc.NCFile.EXTENSION: nc.NCFile.__name__,
+                  npy.NumpyDirectory.EXTENSION: npy.NumpyDirectory.__name__}
+
+# The sources of the values stored for each node.
+ROACH_STATE = 'roach_state'
+STATE = 'state'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    root_path TEXT PRIMARY KEY,
+    io_class TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    cryostat TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    root_path TEXT NOT NULL,
+    node_path TEXT NOT NULL,
+    class_name TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    start_epoch REAL,
+    stop_epoch REAL,
+    num_channels INTEGER,
+    min_frequency REAL,
+    max_frequency REAL,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS node_values (
+    node_id INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    number REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_class_epoch ON nodes (class_name, start_epoch);
+CREATE INDEX IF NOT EXISTS nodes_root_path ON nodes (root_path);
+CREATE INDEX IF NOT EXISTS node_values_node_id ON node_values (node_id);
+CREATE INDEX IF NOT EXISTS node_values_key ON node_values (source, key, number);
+"""
+
+
+class CatalogEntry(namedtuple('CatalogEntry', ['root_path', 'io_class', 'node_path', 'class_name', 'start_epoch',
+                                               'stop_epoch', 'num_channels', 'min_frequency', 'max_frequency',
+                                               'description', 'cryostat'])):
+    """
+    A measurement node found in the catalog. The frequencies are in Hz.
+    """
+
+    def open(self, **kwargs):
+        """
+        Return an open IO for the file that contains this node; the keyword arguments are passed to the IO class.
+        """
+        return core.get_class(classes.full_name(self.io_class, None))(self.root_path, **kwargs)
+
+    def read(self, **kwargs):
+        """
+        Read this node and return the measurement; the keyword arguments, such as lazy=True, are passed to the IO
+        class, and the IO is left open.
+        """
+        return self.open(**kwargs).read(self.node_path)
+
+
+class Catalog(object):
+    """
+    An index of the measurements in the data files in one or more directories, stored in an SQLite database.
+    """
+
+    # The name of the database in settings.BASE_DATA_DIR used if settings.MEASUREMENT_CATALOG_PATH is None.
+    DEFAULT_DATABASE_FILENAME = 'measurement_catalog.sqlite'
+
+    def __init__(self, database_path=None):
+        """
+        Parameters
+        ----------
+        database_path : str
+            The path of the SQLite database, which is created if it does not exist; ':memory:' creates a temporary
+            database in memory. The default is settings.MEASUREMENT_CATALOG_PATH or, if that is None,
+            DEFAULT_DATABASE_FILENAME in settings.BASE_DATA_DIR.
+        """
+        if database_path is None:
+            database_path = settings.MEASUREMENT_CATALOG_PATH
+        if database_path is None:
+            database_path = os.path.join(settings.BASE_DATA_DIR, self.DEFAULT_DATABASE_FILENAME)
+        self.database_path = database_path
+        self._connection = sqlite3.connect(database_path)
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def update(self, directories=None):
+        """
+        Index every NCFile and NumpyDirectory under the given directories that is new or has been modified since it was
+        last indexed, and remove from the catalog every file under these directories that no longer exists.
+
+        Files that cannot be read are recorded with their error, so they are not read again until they are modified.
+
+        Parameters
+        ----------
+        directories : iterable(str)
+            The directories to search recursively; the default is [settings.BASE_DATA_DIR].
+
+        Returns
+        -------
+        dict
+            The number of files that were indexed, unchanged, removed, and failed.
+        """
+        if directories is None:
+            directories = [settings.BASE_DATA_DIR]
+        counts = {'indexed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+        for directory in directories:
+            directory = os.path.abspath(os.path.expanduser(directory))
+            prefix = os.path.join(directory, '')
+            known = dict((root_path, mtime) for root_path, mtime in self._connection.execute(
+                "SELECT root_path, mtime FROM files WHERE substr(root_path, 1, ?) = ?", (len(prefix), prefix)))
+            for root_path, io_class in find_roots(directory):
+                mtime = modification_time(root_path)
+                if known.pop(root_path, None) == mtime:
+                    counts['unchanged'] += 1
+                elif self._index(root_path, io_class, mtime):
+                    counts['indexed'] += 1
+                else:
+                    counts['failed'] += 1
+            with self._connection:
+                for root_path in known:
+                    self._remove(root_path)
+            counts['removed'] += len(known)
+        logger.info("Updated catalog {}: {}".format(self.database_path, counts))
+        return counts
+
+    def find(self, class_name=None, start_epoch=None, stop_epoch=None, frequency=None, num_channels=None,
+             roach_state=None, state=None, cryostat=None, root_path=None, top_level=False):
+        """
+        Return the catalog entries for the measurement nodes that match all of the given criteria, ordered by start
+        epoch. Criteria that are None are ignored.
+
+        Parameters
+        ----------
+        class_name : str or class
+            The measurement class, such as 'SweepStreamArray'.
+        start_epoch : float
+            Match measurements that end at or after this epoch.
+        stop_epoch : float
+            Match measurements that start at or before this epoch.
+        frequency : float
+            Match measurements whose tone frequency range, in Hz, includes this frequency.
+        num_channels : int
+            Match measurements with this number of channels.
+        roach_state : dict
+            Match measurements with these roach_state values; keys of nested dicts are joined with a period.
+        state : dict
+            Match measurements with these state values; keys of nested dicts are joined with a period.
+        cryostat : str
+            Match measurements in files with this cryostat in their metadata.
+        root_path : str
+            Match measurements in files whose path matches this SQL LIKE pattern, such as '%2017-05-%'.
+        top_level : bool
+            If True, match only measurements stored at the root level of their files.
+
+        Returns
+        -------
+        list(CatalogEntry)
+        """
+        clauses = []
+        parameters = []
+        if class_name is not None:
+            clauses.append("nodes.class_name = ?")
+            parameters.append(class_name if isinstance(class_name, basestring) else class_name.__name__)
+        if start_epoch is not None:
+            clauses.append("nodes.stop_epoch >= ?")
+            parameters.append(start_epoch)
+        if stop_epoch is not None:
+            clauses.append("nodes.start_epoch <= ?")
+            parameters.append(stop_epoch)
+        if frequency is not None:
+            clauses.append("nodes.min_frequency <= ? AND nodes.max_frequency >= ?")
+            parameters.extend([frequency, frequency])
+        if num_channels is not None:
+            clauses.append("nodes.num_channels = ?")
+            parameters.append(num_channels)
+        for source, values in [(ROACH_STATE, roach_state), (STATE, state)]:
+            for key, value in (values or {}).items():
+                number, text = _encode(value)
+                if number is None and text is None:
+                    raise ValueError("Cannot match {} {} to {!r}".format(source, key, value))
+                clauses.append("EXISTS (SELECT 1 FROM node_values WHERE node_values.node_id = nodes.id AND "
+                               "node_values.source = ? AND node_values.key = ? AND "
+                               "(abs(node_values.number - ?) <= 1e-9 * abs(?) OR node_values.text = ?))")
+                parameters.extend([source, key, number, number, text])
+        if cryostat is not None:
+            clauses.append("files.cryostat = ?")
+            parameters.append(cryostat)
+        if root_path is not None:
+            clauses.append("nodes.root_path LIKE ?")
+            parameters.append(root_path)
+        if top_level:
+            clauses.append("nodes.depth = 1")
+        query = ("SELECT nodes.root_path, files.io_class, nodes.node_path, nodes.class_name, nodes.start_epoch, "
+                 "nodes.stop_epoch, nodes.num_channels, nodes.min_frequency, nodes.max_frequency, nodes.description, "
+                 "files.cryostat FROM nodes JOIN files ON nodes.root_path = files.root_path")
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY nodes.start_epoch, nodes.root_path, nodes.node_path"
+        return [CatalogEntry(*row) for row in self._connection.execute(query, parameters)]
+
+    def values(self, entry, source=ROACH_STATE):
+        """
+        Return a dict containing the scalar roach_state or state values recorded for the given entry.
+        """
+        rows = self._connection.execute(
+            "SELECT node_values.key, node_values.number, node_values.text FROM node_values JOIN nodes ON "
+            "node_values.node_id = nodes.id WHERE nodes.root_path = ? AND nodes.node_path = ? AND "
+            "node_values.source = ?", (entry.root_path, entry.node_path, source))
+        return dict((key, text if number is None else number) for key, number, text in rows)
+
+    def errors(self):
+        """
+        Return a dict that maps the path of each file that could not be indexed to the error message.
+        """
+        return dict(self._connection.execute("SELECT root_path, error FROM files WHERE error IS NOT NULL"))
+
+    # Private methods
+
+    def _remove(self, root_path):
+        self._connection.execute("DELETE FROM node_values WHERE node_id IN (SELECT id FROM nodes WHERE root_path = ?)",
+                                 (root_path,))
+        self._connection.execute("DELETE FROM nodes WHERE root_path = ?", (root_path,))
+        self._connection.execute("DELETE FROM files WHERE root_path = ?", (root_path,))
+
+    def _index(self, root_path, io_class, mtime):
+        records = []
+        cryostat = error = None
+        try:
+            io = core.get_class(classes.full_name(io_class, None))(root_path, lazy=True)
+            try:
+                if io.metadata is not None:
+                    cryostat = io.metadata.get('cryostat')
+                for name in io.node_names('/'):
+                    try:
+                        _summarize(io, core.NODE_PATH_SEPARATOR + name, 1, records)
+                    except Exception as e:
+                        logger.warning("Could not index {} in {}: {}".format(name, root_path, e))
+            finally:
+                io.close()
+        except Exception as e:
+            logger.warning("Could not index {}: {}".format(root_path, e))
+            error = '{}: {}'.format(e.__class__.__name__, e)
+        with self._connection:
+            self._remove(root_path)
+            self._connection.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                                     (root_path, io_class, mtime, cryostat, error))
+            for node_path, class_name, depth, summary, description, values in records:
+                node_id = self._connection.execute(
+                    "INSERT INTO nodes (root_path, node_path, class_name, depth, start_epoch, stop_epoch, "
+                    "num_channels, min_frequency, max_frequency, description) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (root_path, node_path, class_name, depth, summary['start_epoch'], summary['stop_epoch'],
+                     summary['num_channels'], summary['min_frequency'], summary['max_frequency'],
+                     description)).lastrowid
+                self._connection.executemany("INSERT INTO node_values VALUES (?, ?, ?, ?, ?)",
+                                             [(node_id, source, key, number, text)
+                                              for (source, key), (number, text) in values.items()])
+        return error is None
+
+
+def find_roots(directory):
+    """
+    Yield (root path, IO class name) for each NCFile and NumpyDirectory under the given directory, identified by their
+    extensions; the contents of NumpyDirectories are not searched.
+    """
+    for path, directory_names, filenames in os.walk(directory):
+        for name in sorted(directory_names):
+            extension = os.path.splitext(name)[1]
+            if extension in IO_CLASS_NAMES and IO_CLASS_NAMES[extension] == npy.NumpyDirectory.__name__:
+                yield os.path.join(path, name), IO_CLASS_NAMES[extension]
+        directory_names[:] = [name for name in directory_names
+                              if os.path.splitext(name)[1] != npy.NumpyDirectory.EXTENSION]
+        for name in sorted(filenames):
+            extension = os.path.splitext(name)[1]
+            if extension in IO_CLASS_NAMES and IO_CLASS_NAMES[extension] != npy.NumpyDirectory.__name__:
+                yield os.path.join(path, name), IO_CLASS_NAMES[extension]
+
+
+def modification_time(root_path):
+    """
+    Return the latest modification time of the given file, or of the given directory and everything in it, so that
+    appending to an array in a NumpyDirectory counts as a modification.
+    """
+    if not os.path.isdir(root_path):
+        return os.path.getmtime(root_path)
+    mtime = os.path.getmtime(root_path)
+    for path, directory_names, filenames in os.walk(root_path):
+        for name in directory_names + filenames:
+            try:
+                mtime = max(mtime, os.path.getmtime(os.path.join(path, name)))
+            except OSError:  # The file was removed or renamed.
+                pass
+    return mtime
+
+
+def _summarize(io, node_path, depth, records):
+    """
+    Return a dict summarizing the node at node_path and all of its contents, and append a record for each Measurement
+    node to records. MeasurementList nodes are not recorded, but their contents are.
+    """
+    class_name = io.read_other(node_path, core.CLASS_NAME).rsplit('.', 1)[-1]
+    children = [_summarize(io, core.join(node_path, name), depth + 1, records)
+                for name in io.node_names(node_path)]
+    other_names = io.other_names(node_path)
+    summary = _merge(children)
+    values = {}
+    if ROACH_STATE in other_names:
+        roach_state = io.read_other(node_path, ROACH_STATE)
+        summary['roach_state'] = _flatten(roach_state)
+        summary.update(_channel_summary(io, node_path, core.StateDict(roach_state)))
+    duration = summary.pop('duration', 0)
+    if 'epoch' in other_names:
+        epoch = io.read_other(node_path, 'epoch')
+        summary['start_epoch'] = epoch
+        summary['stop_epoch'] = epoch + duration
+    if STATE in other_names:
+        values.update(((STATE, key), value) for key, value in _flatten(io.read_other(node_path, STATE)).items())
+    values.update(((ROACH_STATE, key), value) for key, value in summary['roach_state'].items())
+    if class_name != core.MeasurementList.__name__:
+        description = io.read_other(node_path, 'description') if 'description' in other_names else None
+        records.append((node_path, class_name, depth, summary, description, values))
+    return summary
+
+
+def _channel_summary(io, node_path, roach_state):
+    summary = {}
+    array_names = io.array_names(node_path)
+    try:
+        if 'tone_bin' in array_names and 'tone_index' in array_names:
+            tone_index = np.asarray(io.read_array(node_path, 'tone_index'))
+            frequency = calculate.frequency(roach_state, np.asarray(io.read_array(node_path, 'tone_bin'))[tone_index])
+            summary['num_channels'] = tone_index.size
+            if tone_index.size:
+                summary['min_frequency'] = float(np.min(frequency))
+                summary['max_frequency'] = float(np.max(frequency))
+        if 's21_raw' in array_names:
+            summary['duration'] = (io.read_array(node_path, 's21_raw').shape[-1] /
+                                   calculate.stream_sample_rate(roach_state))
+    except (KeyError, AttributeError, IndexError, ValueError) as e:
+        logger.debug("Could not calculate frequencies for {}: {}".format(node_path, e))
+    return summary
+
+
+def _merge(summaries):
+    """
+    Combine the summaries of the contents of a node: the epoch and frequency ranges span those of the contents, the
+    number of channels and the roach_state values are kept only if they are the same for all contents that have them.
+    """
+    merged = {'start_epoch': None, 'stop_epoch': None, 'num_channels': None, 'min_frequency': None,
+              'max_frequency': None, 'roach_state': {}}
+    for key, function in [('start_epoch', min), ('stop_epoch', max), ('min_frequency', min), ('max_frequency', max)]:
+        present = [s[key] for s in summaries if s[key] is not None]
+        if present:
+            merged[key] = function(present)
+    num_channels = set(s['num_channels'] for s in summaries if s['num_channels'] is not None)
+    if len(num_channels) == 1:
+        merged['num_channels'] = num_channels.pop()
+    roach_states = [s['roach_state'] for s in summaries if s['roach_state']]
+    if roach_states:
+        merged['roach_state'] = dict(item for item in roach_states[0].items()
+                                     if all(r.get(item[0]) == item[1] for r in roach_states[1:]))
+    return merged
+
+
+def _flatten(dictionary, prefix=''):
+    """
+    Return a dict that maps each key to an encoded (number, text) tuple for every scalar value in the given dict and
+    the dicts it contains, with the keys of contained dicts joined by periods.
+    """
+    flat = {}
+    for key, value in dictionary.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        else:
+            number, text = _encode(value)
+            if number is not None or text is not None:
+                flat[prefix + key] = (number, text)
+    return flat
+
+
+def _encode(value):
+    if isinstance(value, (bool, np.bool_)):
+        return int(value), None
+    elif isinstance(value, Number) and not isinstance(value, complex) and np.isfinite(value):
+        return float(value), None
+    elif isinstance(value, basestring):
+        return None, value
+    else:
+        return None, None
@@ -330,7 +330,9 @@ class Measurement(Node):
                     for meas_s, meas_o in zip(value_s, value_o):
                         assert meas_s.__eq__(meas_o)
                 # This allows arrays to contain NaN and be equal.
-                elif isinstance(value_s, np.ndarray) or isinstance(value_o, np.ndarray):
+                elif isinstance(value_s, (np.ndarray, LazyArray)) or isinstance(value_o, (np.ndarray, LazyArray)):
+                    value_s = np.asarray(value_s)
+                    value_o = np.asarray(value_o)
                     assert np.all(np.isnan(value_s) == np.isnan(value_o))
                     assert np.all(value_s[~np.isnan(value_s)] == value_o[~np.isnan(value_o)])
                 else:  # This will fail for NaN or sequences that contain any NaN values.
@@ -411,6 +413,7 @@ class IOList(MeasurementList):
 
     def append(self, item):
         self._io.write(item, join(self._io_node_path, str(len(self))))
+        self._io.flush()
         self._len += 1
 
     def extend(self, iterable):
@@ -459,6 +462,125 @@ class IOList(MeasurementList):
         return '{}({}, {})'.format(self.__class__.__name__, self._io, self._io_node_path)
 
 
+class _Unread(object):
+    """
+    A placeholder for a Measurement in a LazyMeasurementList that has not been read yet.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+
+class LazyMeasurementList(MeasurementList):
+    """
+    This class acts like a MeasurementList read from disk, but it reads each Measurement from disk only when it is first
+    accessed. IO objects created with lazy=True return instances of this class instead of MeasurementList, so reading a
+    measurement that contains many others, such as a SweepArray, does not read any of the contained measurements. Each
+    Measurement read this way has the usual _parent, _io, and _io_node_path attributes. Methods that need the whole
+    list, such as index() or comparison, read every Measurement. The IO must remain open until every Measurement that
+    is needed has been read.
+    """
+
+    @classmethod
+    def class_name(cls):
+        return cls.__base__.__name__
+
+    def __init__(self, io, node_path, names, translate, force):
+        """
+        Parameters
+        ----------
+        io : IO
+            The IO from which to read the Measurements.
+        node_path : str
+            The node path of the list.
+        names : iterable(str)
+            The node names of the Measurements in the list, in order.
+        translate : dict
+            Passed to IO.read().
+        force : bool
+            Passed to IO.read().
+        """
+        list.__init__(self, [_Unread(name) for name in names])
+        Node.__init__(self)
+        self._source_io = io
+        self._source_node_path = node_path
+        self._translate = translate
+        self._force = force
+
+    def _read(self, index):
+        item = list.__getitem__(self, index)
+        if isinstance(item, _Unread):
+            item = self._source_io._read_node(join(self._source_node_path, item.name), self._translate, self._force)
+            item._parent = self
+            list.__setitem__(self, index, item)
+        return item
+
+    def _read_all(self):
+        for index in range(len(self)):
+            self._read(index)
+
+    def _locate(self, node):
+        for index, value in enumerate(list.__iter__(self)):
+            if node is value:
+                return str(index)
+        raise AttributeError("Node {} is not contained in {}.".format(repr(Node), repr(self)))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._read(index) for index in range(*item.indices(len(self)))]
+        return self._read(item)
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(max(0, i), max(0, j)))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._read(index)
+
+    def __reversed__(self):
+        for index in reversed(range(len(self))):
+            yield self._read(index)
+
+    def __contains__(self, item):
+        self._read_all()
+        return super(LazyMeasurementList, self).__contains__(item)
+
+    def __eq__(self, other):
+        self._read_all()
+        return super(LazyMeasurementList, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __add__(self, other):
+        self._read_all()
+        return super(LazyMeasurementList, self).__add__(other)
+
+    def __repr__(self):
+        self._read_all()
+        return super(LazyMeasurementList, self).__repr__()
+
+    def index(self, value, *args):
+        self._read_all()
+        return super(LazyMeasurementList, self).index(value, *args)
+
+    def count(self, value):
+        self._read_all()
+        return super(LazyMeasurementList, self).count(value)
+
+    def remove(self, value):
+        self._read_all()
+        super(LazyMeasurementList, self).remove(value)
+
+    def pop(self, index=-1):
+        self._read(index)
+        return super(LazyMeasurementList, self).pop(index)
+
+    def sort(self, *args, **kwargs):
+        self._read_all()
+        super(LazyMeasurementList, self).sort(*args, **kwargs)
+
+
 class MeasurementError(Exception):
     """
     Raised for module-specific errors.
@@ -568,6 +690,161 @@ def pickle_state(s):
 copy_reg.pickle(StateDict, pickle_state)
 
 
+class LazyArray(object):
+    """
+    A read-only array stored on disk that reads data only when it is needed.
+
+    Indexing with integers, slices, and Ellipsis returns another LazyArray without reading anything, so selecting one
+    channel or a range of samples from a large array is free, and converting the result with numpy.asarray() reads only
+    the selected elements. Any other index, array attribute, or arithmetic operation reads the selected elements first
+    and then acts on the resulting numpy array. Use iter_chunks() to process an array that does not fit in memory.
+    """
+
+    # The default maximum size of the chunks returned by iter_chunks().
+    chunk_bytes = 2 ** 26
+
+    def __init__(self, source, dtype=None):
+        """
+        Parameters
+        ----------
+        source : array-like
+            An object with a shape attribute that returns numpy arrays when indexed with a tuple of integers and slices
+            with positive steps, such as a numpy.memmap or a netCDF4 Variable.
+        dtype : numpy.dtype
+            The dtype of the arrays returned by source; the default is source.dtype.
+        """
+        self._source = source
+        self.dtype = np.dtype(source.dtype if dtype is None else dtype)
+        # Each entry is either an int, for an axis of the source removed by indexing, or a tuple
+        # (start, step, length) describing the source elements selected along that axis.
+        self._axes = tuple((0, 1, n) for n in source.shape)
+
+    def _view(self, axes):
+        view = LazyArray.__new__(LazyArray)
+        view._source = self._source
+        view.dtype = self.dtype
+        view.chunk_bytes = self.chunk_bytes
+        view._axes = tuple(axes)
+        return view
+
+    @property
+    def shape(self):
+        return tuple(axis[2] for axis in self._axes if isinstance(axis, tuple))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'LazyArray(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not all(isinstance(k, (int, long, np.integer, slice)) or k is Ellipsis for k in key):
+            return np.asarray(self)[key]
+        if sum(k is Ellipsis for k in key) > 1:
+            raise IndexError("An index can only have a single Ellipsis.")
+        if any(k is Ellipsis for k in key):
+            e = [n for n, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:e] + (slice(None),) * (self.ndim - len(key) + 1) + key[e + 1:]
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices for array with shape {}.".format(self.shape))
+        key = iter(key + (slice(None),) * (self.ndim - len(key)))
+        axes = []
+        for axis in self._axes:
+            if not isinstance(axis, tuple):
+                axes.append(axis)
+                continue
+            start, step, length = axis
+            k = next(key)
+            if isinstance(k, slice):
+                first, stop, stride = k.indices(length)
+                axes.append((start + first * step, step * stride, len(xrange(first, stop, stride))))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += length
+                if not 0 <= k < length:
+                    raise IndexError("Index {} is out of bounds for axis with size {}.".format(k, length))
+                axes.append(start + k * step)
+        view = self._view(axes)
+        if view.ndim == 0:
+            return np.asarray(view)[()]
+        return view
+
+    def __array__(self, dtype=None):
+        if 0 in self.shape:
+            array = np.empty(self.shape, dtype=self.dtype)
+        else:
+            source_key = []
+            reverse = []
+            for axis in self._axes:
+                if not isinstance(axis, tuple):
+                    source_key.append(axis)
+                    continue
+                start, step, length = axis
+                if step > 0:
+                    source_key.append(slice(start, start + (length - 1) * step + 1, step))
+                    reverse.append(slice(None))
+                else:  # Read with a positive step and reverse afterward.
+                    source_key.append(slice(start + (length - 1) * step, start + 1, -step))
+                    reverse.append(slice(None, None, -1))
+            array = np.asarray(np.asarray(self._source[tuple(source_key)]).reshape(self.shape)[tuple(reverse)])
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def iter_chunks(self, chunk_bytes=None):
+        """
+        Yield numpy arrays containing consecutive chunks of this array along its last axis.
+
+        Parameters
+        ----------
+        chunk_bytes : int
+            The maximum size of each chunk in bytes, except that each chunk contains at least one element along the
+            last axis; the default is LazyArray.chunk_bytes.
+        """
+        if chunk_bytes is None:
+            chunk_bytes = self.chunk_bytes
+        length = self.shape[-1]
+        step = max(1, chunk_bytes // max(1, self.dtype.itemsize * int(np.prod(self.shape[:-1]))))
+        for start in range(0, length, step):
+            yield np.asarray(self[..., start:start + step])
+
+    def __getattr__(self, name):
+        # Attributes like real, imag, and T act on the data; private and special names are not delegated, which keeps
+        # copying and pickling from reading the array.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(np.asarray(self), name)
+
+
+def _delegate_to_array(name):
+    def method(self, *args):
+        return getattr(np.asarray(self), name)(*args)
+    method.__name__ = name
+    return method
+
+for _name in ['__add__', '__radd__', '__sub__', '__rsub__', '__mul__', '__rmul__', '__div__', '__rdiv__',
+              '__truediv__', '__rtruediv__', '__floordiv__', '__rfloordiv__', '__pow__', '__rpow__', '__neg__',
+              '__pos__', '__abs__', '__lt__', '__le__', '__eq__', '__ne__', '__gt__', '__ge__', '__iter__']:
+    setattr(LazyArray, _name, _delegate_to_array(_name))
+del _name
+LazyArray.__hash__ = None
+
+
 class IO(object):
     """
     This is an abstract class that specifies the IO interface.
@@ -586,6 +863,19 @@ class IO(object):
     # Subclasses can define a conventional extension for files or directories they create.
     EXTENSION = ''
 
+    # Subclasses that accept lazy=True return arrays with these names as LazyArray instances, and return
+    # MeasurementLists as LazyMeasurementList instances.
+    LAZY_ARRAY_NAMES = ('s21_raw',)
+
+    # Subclasses whose constructor accepts a lazy argument set this to True.
+    SUPPORTS_LAZY = False
+
+    # Subclasses set this to the value of their lazy argument; see _read_node().
+    lazy = False
+
+    # Arrays with these names are stored so that append_array() can extend them along their last axis.
+    APPENDABLE_ARRAY_NAMES = ('s21_raw',)
+
     def __init__(self, root_path, metadata=None):
         """
         Return a new IO object that will read to or write from the given root directory or file. If the root does not
@@ -740,6 +1030,19 @@ class IO(object):
         """
         pass
 
+    def append_array(self, node_path, key, value):
+        """
+        Append value, a numpy array, to the existing array key in node_path along the last axis; the existing array
+        must have a name in APPENDABLE_ARRAY_NAMES. Return the new shape of the array.
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Write any buffered data to disk, so that everything written so far can be read even if the process crashes.
+        """
+        pass
+
     def read_array(self, node_path, key):
         """
         Read array key from node_path.
@@ -830,7 +1133,9 @@ class IO(object):
         full_class_name = translate.get(saved_class_name, classes.full_name(saved_class_name, version))
         class_ = get_class(full_class_name)
         measurement_names = self.node_names(node_path)
-        if issubclass(class_, MeasurementList):
+        if self.lazy and class_ is MeasurementList:
+            node = LazyMeasurementList(self, node_path, sorted(measurement_names, key=int), translate, force)
+        elif issubclass(class_, MeasurementList):
             # Use the name of each measurement, which is an int, to restore the order in the sequence.
             contents = [self._read_node(join(node_path, measurement_name), translate, force)
                         for measurement_name in sorted(measurement_names, key=int)]
@@ -35,6 +35,8 @@ class NCFile(core.IO):
     # anywhere internally.
     EXTENSION = '.nc'
 
+    SUPPORTS_LAZY = True
+
     # These special strings are used to store None, True, and False as ncattrs.
     on_write = {None: '_None',
                 True: '_True',
@@ -55,15 +57,34 @@ class NCFile(core.IO):
     # that end with this string, and are returned on read as lists.
     is_list = '.list'
 
-    def __init__(self, root_path, metadata=None, cache_s21_raw=False):
+    # The maximum size in bytes of each chunk of an appendable array; see write_array().
+    append_chunk_bytes = 2 ** 18
+
+    def __init__(self, root_path, metadata=None, cache_s21_raw=False, lazy=False, append=False, compression=None):
+        """
+        Open the file at root_path, creating it if it does not exist.
+
+        If lazy is True, arrays with names in LAZY_ARRAY_NAMES, such as s21_raw, are returned as core.LazyArray
+        instances that read from the file only the slices that are used, and MeasurementLists are returned as
+        core.LazyMeasurementList instances that read each Measurement when it is first used; the file must remain open
+        while they are in use. An existing file is opened read-only unless append is True, in which case new nodes can
+        be written to it and existing arrays can be extended with append_array().
+
+        If compression is an integer from 1 to 9, arrays with names in APPENDABLE_ARRAY_NAMES, such as s21_raw, are
+        written with the shuffle filter and zlib compression at that level; level 1 is fastest and usually compresses
+        nearly as well as the higher levels. Compressed files are read without any special options.
+        """
+        self.append = append
+        self.compression = compression
         super(NCFile, self).__init__(root_path=os.path.expanduser(root_path), metadata=metadata)
         self.cache_s21_raw = cache_s21_raw
+        self.lazy = lazy
 
     def _root_path_exists(self, root_path):
         return os.path.isfile(root_path)
 
     def _open_existing(self, root_path):
-        return netCDF4.Dataset(self.root_path, mode='r', keepweakref=True)
+        return netCDF4.Dataset(self.root_path, mode='a' if self.append else 'r', keepweakref=True)
 
     def _create_new(self, root_path):
         return netCDF4.Dataset(root_path, mode='w', clobber=False)
@@ -105,6 +126,11 @@ class NCFile(core.IO):
         Measurement._validate_dimensions() to fail, this should not happen unless array sizes are modified after
         instantiation somehow.
 
+        The last dimension of an array with a name in APPENDABLE_ARRAY_NAMES is created unlimited so that
+        append_array() can extend it. Each chunk of the array on disk contains at most append_chunk_bytes of a single
+        channel, meaning one index along every other dimension, so reading one channel of s21_raw reads and decompresses
+        only the chunks of that channel.
+
         :param node_path: the node path as a string.
         :param name: the name of the variable.
         :param array: the array containing the data.
@@ -112,18 +138,67 @@ class NCFile(core.IO):
         :return: None.
         """
         node = self._get_node(node_path)
+        appendable = name in self.APPENDABLE_ARRAY_NAMES and len(dimensions) > 0
         for n, dimension in enumerate(dimensions):
             if dimension not in node.dimensions:
-                node.createDimension(dimension, array.shape[n])
+                if appendable and n == len(dimensions) - 1:
+                    node.createDimension(dimension, None)
+                else:
+                    node.createDimension(dimension, array.shape[n])
         try:
             npy_datatype = self.npy_to_netcdf[array.dtype]['datatype']
             netcdf_datatype = node.createCompoundType(self.npy_to_netcdf[array.dtype]['datatype'],
                                                       self.npy_to_netcdf[array.dtype]['name'])
         except KeyError:
             npy_datatype = netcdf_datatype = array.dtype
-        variable = node.createVariable(name, netcdf_datatype, dimensions)
+        if appendable:
+            # Uncompressed chunks are allocated in full, so chunks are no longer than the array unless it is empty.
+            chunk_length = max(1, self.append_chunk_bytes // array.dtype.itemsize)
+            if array.shape[-1]:
+                chunk_length = min(chunk_length, array.shape[-1])
+            chunksizes = [1] * (array.ndim - 1) + [chunk_length]
+            if self.compression:
+                variable = node.createVariable(name, netcdf_datatype, dimensions, chunksizes=chunksizes, zlib=True,
+                                               complevel=self.compression, shuffle=True)
+            else:
+                variable = node.createVariable(name, netcdf_datatype, dimensions, chunksizes=chunksizes)
+        else:
+            variable = node.createVariable(name, netcdf_datatype, dimensions)
         variable[:] = array.view(npy_datatype)
 
+    def append_array(self, node_path, name, array):
+        """
+        Append the given array to the existing array with the given name in the node at node_path, along the last
+        axis, and write it to disk. The existing array must have been written with an unlimited last dimension, as are
+        arrays with names in APPENDABLE_ARRAY_NAMES; other arrays that share this dimension are not extended.
+
+        :param node_path: the node path as a string.
+        :param name: the name of the variable.
+        :param array: the data to append; all dimensions except the last must match those of the existing array.
+        :return: the new shape of the array on disk.
+        """
+        node = self._get_node(node_path)
+        try:
+            variable = node.variables[name]
+        except KeyError:
+            raise ValueError("Array not found: {}".format(name))
+        if not node.dimensions[variable.dimensions[-1]].isunlimited():
+            raise ValueError("Cannot append to array {} because its last dimension is not unlimited".format(name))
+        array = np.asarray(array)
+        if array.shape[:-1] != variable.shape[:-1]:
+            raise ValueError("Cannot append array with shape {} to array with shape {}".format(array.shape,
+                                                                                              variable.shape))
+        dtype = np.dtype(variable.datatype.name)
+        npy_datatype = self.npy_to_netcdf.get(dtype, {'datatype': dtype})['datatype']
+        start = variable.shape[-1]
+        variable[..., start:start + array.shape[-1]] = array.astype(dtype).view(npy_datatype)
+        self.flush()
+        return variable.shape
+
+    def flush(self):
+        if not self.closed:
+            self._root.sync()
+
     def write_other(self, node_path, key, value):
         node = self._get_node(node_path)
         self._write_to_group(node, key, value)
@@ -133,6 +208,8 @@ class NCFile(core.IO):
         nc_variable = node.variables[name]
         if name == 's21_raw' and self.cache_s21_raw:  # hacktastic
             return nc_variable
+        elif self.lazy and name in self.LAZY_ARRAY_NAMES:
+            return core.LazyArray(NCVariable(nc_variable))
         else:
             return nc_variable[:].view(nc_variable.datatype.name)
 
@@ -3,7 +3,15 @@ This module implements reading and writing of Measurements using a directory hie
 
 Each node is a directory:
 Numpy arrays are stored as .npy files;
-Other values are stored using json.
+Nodes contained in the node are stored as subdirectories;
+Other values are stored together using json in a single file, NODE_FILENAME.
+
+Directories written before NODE_FILENAME was introduced stored each other value in a separate json file named after the
+value; these are still read, and values written to such a node are written in the same way.
+
+Reading a node requires one listing of its directory and one read of NODE_FILENAME, and both are cached: the listing is
+reused until the modification time of the directory changes, which happens when another node, array, or NODE_FILENAME
+is written to it, so a directory that is being written by another process is listed correctly.
 
 Limitations and issues:
 -Because json has only a single sequence type, all sequences that are not declared to be numpy arrays (i.e. passed to
@@ -11,6 +19,7 @@ Limitations and issues:
 -
 """
 import os
+import copy
 import json
 
 import numpy as np
@@ -27,14 +36,36 @@ class NumpyDirectory(core.IO):
     # enforced anywhere internally.
     EXTENSION = '.npd'
 
+    SUPPORTS_LAZY = True
+
+    # The other values in each node are stored in this file.
+    NODE_FILENAME = '_node.json'
+
+    def __init__(self, root_path, metadata=None, memmap=False, lazy=False):
+        """
+        Open the directory at root_path, creating it if it does not exist.
+
+        If memmap is True, all arrays are returned as read-only memmaps. If lazy is True, arrays with names in
+        LAZY_ARRAY_NAMES, such as s21_raw, are returned as core.LazyArray instances backed by a memmap, so that slicing
+        a single channel or a range of samples reads only those samples from disk, and MeasurementLists are returned as
+        core.LazyMeasurementList instances that read each Measurement when it is first used.
 
-    def __init__(self, root_path, metadata=None, memmap=False):
+        Directory listings are cached and reused while the modification time of the directory is unchanged. Nodes and
+        arrays written through this instance are always listed, but changes made through another instance or process
+        may not be listed until the modification time changes, which can take up to one tick of the filesystem's
+        timestamp resolution: one second or more on NFS or ext3. Call clear_cache() to discard the cache.
+        """
+        # The superclass constructor reads or writes the root metadata, which uses the caches.
+        self._values = {}
+        self._listings = {}
+        self._deferred = None
         super(NumpyDirectory, self).__init__(root_path=os.path.abspath(os.path.expanduser(root_path)),
                                              metadata=metadata)
         if memmap:
             self._mmap_mode = 'r'
         else:
             self._mmap_mode = None
+        self.lazy = lazy
 
     def _root_path_exists(self, root_path):
         return os.path.isdir(root_path)
@@ -53,58 +84,212 @@ class NumpyDirectory(core.IO):
         to me how to do that here.
         """
         self._root = None
+        self.clear_cache()
 
     @property
     def closed(self):
         return self._root is None
 
+    def clear_cache(self):
+        """
+        Discard the cached directory listings and values, which are otherwise kept until this instance is closed.
+        """
+        self._values = {}
+        self._listings = {}
+
     def create_node(self, node_path):
         existing, new = core.split(node_path)
         if not new:
             raise core.MeasurementError("Cannot create root node.")
-        os.mkdir(os.path.join(self._get_node(existing), new))
+        parent = self._get_node(existing)
+        directory = os.path.join(parent, new)
+        os.mkdir(directory)
+        self._values[directory] = {}
+        # Do not rely on the mtime of the parent, which may not change if it was listed in the same tick.
+        self._listings.pop(parent, None)
 
     def write_array(self, node_path, key, value, dimensions):
         node = self._get_node(node_path)
         filename = os.path.join(node, key + '.npy')
         with self._safe_open(filename) as f:
             np.save(f, value)
+        self._listings.pop(node, None)
+
+    def append_array(self, node_path, key, value):
+        """
+        Append the given array to the existing array key in the node at node_path, along the last axis.
+
+        The existing array must be stored so that its last axis varies slowest on disk: this is true of 1-D arrays,
+        of arrays in which every other dimension has length 1, and of Fortran-ordered arrays, such as the transposed
+        s21_raw arrays created by RoachInterface. The data are written before the header, so if writing is
+        interrupted the file still contains a valid array with the previous shape.
+
+        Parameters
+        ----------
+        node_path : str
+            The path to the node containing the array.
+        key : str
+            The name of the array.
+        value : numpy.ndarray
+            The data to append; all dimensions except the last must match those of the existing array.
+
+        Returns
+        -------
+        tuple
+            The new shape of the array on disk.
+        """
+        filename = os.path.join(self._get_node(node_path), key + '.npy')
+        if not os.path.isfile(filename):
+            raise ValueError("Array not found: {}".format(key))
+        with open(filename, 'rb') as f:
+            shape, fortran_order, dtype, data_offset = _read_npy_header(f)
+        value = np.asarray(value)
+        if value.ndim != len(shape) or value.shape[:-1] != shape[:-1]:
+            raise ValueError("Cannot append array with shape {} to array with shape {}".format(value.shape, shape))
+        if int(np.prod(shape)) == 0:  # An empty array can be stored in either order.
+            fortran_order = True
+        if not (fortran_order or int(np.prod(shape[:-1])) == 1):
+            raise ValueError("Cannot append along the last axis of a C-ordered array with shape {}".format(shape))
+        new_shape = shape[:-1] + (shape[-1] + value.shape[-1],)
+        header = _npy_header(new_shape, fortran_order, dtype)
+        if len(header) + 1 > data_offset - _NPY_PREAMBLE_LENGTH:
+            data_offset = _rewrite_with_header_space(filename, data_offset, len(header) + _NPY_HEADER_SPACE)
+        with open(filename, 'r+b') as f:
+            # Seek to the end of the existing data, not the end of the file, in case a previous append was interrupted.
+            f.seek(data_offset + int(np.prod(shape)) * dtype.itemsize)
+            f.write(value.astype(dtype).tobytes(order='F' if fortran_order else 'C'))
+            f.truncate()
+            f.seek(_NPY_PREAMBLE_LENGTH)
+            f.write(header.ljust(data_offset - _NPY_PREAMBLE_LENGTH - 1) + '\n')
+        return new_shape
 
     def write_other(self, node_path, key, value):
         node = self._get_node(node_path)
-        filename = os.path.join(node, key)
-        with self._safe_open(filename) as f:
-            try:
-                json.dump(value, f)
-            except TypeError as e:
-                raise ValueError("json.dump({}) of {} ({}) failed: {}".format(key, value, repr(value), e.message))
+        try:
+            encoded = json.dumps(value)
+        except TypeError as e:
+            raise ValueError("json.dump({}) of {} ({}) failed: {}".format(key, value, repr(value), e.message))
+        values = self._read_values(node)
+        if values is None:  # This node was written in the old format.
+            with self._safe_open(os.path.join(node, key)) as f:
+                f.write(encoded)
+            self._listings.pop(node, None)
+            return
+        if key in values:
+            raise RuntimeError("Value already exists: {}".format(os.path.join(node, key)))
+        values[key] = json.loads(encoded)  # Store exactly what will be read from disk.
+        self._values[node] = values
+        if self._deferred is None:
+            self._write_values(node)
+        else:
+            self._deferred.add(node)
 
     def read_array(self, node_path, name):
         full = os.path.join(self._get_node(node_path), name + '.npy')
+        if self.lazy and name in self.LAZY_ARRAY_NAMES:
+            return core.LazyArray(np.load(full, mmap_mode='r'))
         return np.load(full, mmap_mode=self._mmap_mode)
 
     def read_other(self, node_path, name):
-        full_name = os.path.join(self._get_node(node_path), name)
-        if not os.path.isfile(full_name):
+        node = self._get_node(node_path)
+        values = self._read_values(node)
+        if values is None:  # This node was written in the old format.
+            full_name = os.path.join(node, name)
+            if not os.path.isfile(full_name):
+                raise ValueError("Name not found: {}".format(name))
+            with open(full_name) as f:
+                return json.load(f)
+        try:
+            return copy.deepcopy(values[name])
+        except KeyError:
             raise ValueError("Name not found: {}".format(name))
-        with open(full_name) as f:
-            return json.load(f)
 
     def node_names(self, node_path='/'):
-        node = self._get_node(node_path)
-        return [f for f in os.listdir(node) if os.path.isdir(os.path.join(node, f))]
+        return list(self._list(self._get_node(node_path))[0])
 
     def array_names(self, node_path):
-        node = self._get_node(node_path)
-        return [os.path.splitext(f)[0] for f in os.listdir(node) if os.path.isfile(os.path.join(node, f))
-                and os.path.splitext(f)[1] == '.npy']
+        return list(self._list(self._get_node(node_path))[1])
 
     def other_names(self, node_path):
         node = self._get_node(node_path)
-        return [f for f in os.listdir(node)
-                if os.path.isfile(os.path.join(node, f)) and
-                not f.startswith('_') and
-                os.path.splitext(f)[1] != '.npy']
+        values = self._read_values(node)
+        if values is None:
+            return list(self._list(node)[2])
+        return [name for name in values if not name.startswith('_')]
+
+    def _write_node(self, node, node_path):
+        # Write the values of each node once, after all of them are known, instead of rewriting NODE_FILENAME each time
+        # a value is added.
+        if self._deferred is not None:
+            return super(NumpyDirectory, self)._write_node(node, node_path)
+        self._deferred = set()
+        try:
+            super(NumpyDirectory, self)._write_node(node, node_path)
+        finally:
+            deferred, self._deferred = self._deferred, None
+            for directory in deferred:
+                self._write_values(directory)
+                # The mtime of a directory may not change if it is written in the same tick as it was listed.
+                self._listings.pop(directory, None)
+                self._listings.pop(os.path.dirname(directory), None)
+
+    def _read_values(self, directory):
+        """
+        Return the dict of other values stored in the given node directory, or None if the node uses the old format.
+        """
+        try:
+            return self._values[directory]
+        except KeyError:
+            pass
+        try:
+            with open(os.path.join(directory, self.NODE_FILENAME)) as f:
+                values = json.load(f)
+        except IOError:
+            # The values of this node may not have been written yet, possibly by another process, so do not cache this.
+            if any(os.path.isfile(os.path.join(directory, name)) for name in (core.CLASS_NAME, core.METADATA)):
+                return None
+            return {}
+        self._values[directory] = values
+        return values
+
+    def _write_values(self, directory):
+        # Write to a temporary file and rename it so that a partially-written file is never read.
+        filename = os.path.join(directory, self.NODE_FILENAME)
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self._values[directory], f)
+        os.rename(temporary, filename)
+
+    def _list(self, directory):
+        """
+        Return a tuple (node names, array names, other names) for the given node directory, where the other names are
+        those stored in separate files in the old format.
+        """
+        mtime = os.stat(directory).st_mtime
+        try:
+            cached_mtime, listing = self._listings[directory]
+            if cached_mtime == mtime:
+                return listing
+        except KeyError:
+            pass
+        node_names = []
+        array_names = []
+        other_names = []
+        old_format = self._read_values(directory) is None
+        for f in os.listdir(directory):
+            base, extension = os.path.splitext(f)
+            if extension == '.npy':
+                array_names.append(base)
+            # Hidden files, such as the .nfsXXXX files that NFS leaves after a rename or delete, are never nodes.
+            elif extension or f.startswith(('_', '.')):
+                continue
+            elif os.path.isdir(os.path.join(directory, f)):
+                node_names.append(f)
+            elif old_format:
+                other_names.append(f)
+        listing = (tuple(node_names), tuple(array_names), tuple(other_names))
+        self._listings[directory] = (mtime, listing)
+        return listing
 
     def _get_node(self, node_path):
         if self.closed:
@@ -112,7 +297,7 @@ class NumpyDirectory(core.IO):
         if node_path != '':
             core.validate_node_path(node_path)
         full_path = os.path.join(self._root, *core.explode(node_path))
-        if not os.path.isdir(full_path):
+        if full_path not in self._values and not os.path.isdir(full_path):
             raise ValueError("Invalid path: {}".format(full_path))
         return full_path
 
@@ -121,3 +306,44 @@ class NumpyDirectory(core.IO):
         if os.path.exists(filename):
             raise RuntimeError("File already exists: {}".format(filename))
         return open(filename, 'w')
+
+
+# Appending to .npy files: the format is a 6-byte magic string, a 2-byte version, a 2-byte little-endian header
+# length, then the header, which is a Python dict literal padded with spaces and terminated by a newline. Appending
+# changes only the shape in the header, so the header is padded with enough extra space that it can be rewritten in
+# place many times; files written by np.save() are rewritten once to make room.
+_NPY_PREAMBLE_LENGTH = 10
+_NPY_HEADER_SPACE = 64
+_NPY_ALIGNMENT = 64
+
+
+def _read_npy_header(f):
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version != (1, 0):
+        raise ValueError("Appending is supported only for .npy format version 1.0, not {}".format(version))
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    return shape, fortran_order, dtype, f.tell()
+
+
+def _npy_header(shape, fortran_order, dtype):
+    return "{{'descr': {!r}, 'fortran_order': {!r}, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(dtype), bool(fortran_order), tuple(int(n) for n in shape))
+
+
+def _rewrite_with_header_space(filename, data_offset, header_length):
+    new_data_offset = _NPY_ALIGNMENT * (-(-(_NPY_PREAMBLE_LENGTH + header_length + 1) // _NPY_ALIGNMENT))
+    temporary = filename + '.tmp'
+    with open(filename, 'rb') as old, open(temporary, 'wb') as new:
+        new.write(old.read(_NPY_PREAMBLE_LENGTH - 2))
+        new.write(np.array(new_data_offset - _NPY_PREAMBLE_LENGTH, dtype='<u2').tobytes())
+        old.seek(_NPY_PREAMBLE_LENGTH)
+        new.write(old.read(data_offset - _NPY_PREAMBLE_LENGTH).rstrip().ljust(
+            new_data_offset - _NPY_PREAMBLE_LENGTH - 1) + '\n')
+        while True:
+            chunk = old.read(2 ** 24)
+            if not chunk:
+                break
+            new.write(chunk)
+    os.rename(temporary, filename)
+    return new_data_offset
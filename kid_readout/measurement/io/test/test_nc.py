@@ -3,6 +3,7 @@ import os
 import numpy as np
 from testfixtures import TempDirectory
 
+from kid_readout.measurement import core
 from kid_readout.measurement.test import utilities
 from kid_readout.measurement.io import nc
 
@@ -35,6 +36,7 @@ def test_read_write_streamarray():
         name = 'stream_array'
         io.write(original, name)
         assert original == io.read(name)
+        assert original.s21_raw.dtype == io.read(name).s21_raw.dtype == np.complex64
 
 
 def test_read_write_sweeparray():
@@ -77,6 +79,63 @@ def test_cached_stream_array():
         assert np.all(original.s21_raw == io.read(name).s21_raw)
 
 
+def test_lazy_stream_array():
+    with TempDirectory() as directory:
+        io = nc.NCFile(os.path.join(directory.path, 'test.nc'), lazy=True)
+        original = utilities.fake_stream_array()
+        original.s21_raw[1, 3] = np.nan * (1 + 1j)
+        name = 'measurement'
+        io.write(original, name)
+        lazy = io.read(name)
+        assert isinstance(lazy.s21_raw, core.LazyArray)
+        assert original == lazy
+        assert np.all(np.asarray(lazy.s21_raw[2, 10:-10:3]) == original.s21_raw[2, 10:-10:3])
+        assert np.all(np.asarray(lazy[3].s21_raw) == original.s21_raw[3])
+        lazy.s21_raw.chunk_bytes = 1000
+        assert np.allclose(lazy.s21_raw_mean, original.s21_raw_mean)
+        assert np.allclose(lazy.s21_raw_mean_error, original.s21_raw_mean_error)
+
+
+def test_append_array():
+    with TempDirectory() as directory:
+        filename = os.path.join(directory.path, 'test.nc')
+        io = nc.NCFile(filename)
+        original = utilities.fake_stream_array()
+        name = 'stream_array'
+        io.write(original, name)
+        block = original.s21_raw[:, :10]
+        s21_raw = np.concatenate((original.s21_raw, block), axis=1)
+        assert io.append_array(name, 's21_raw', block) == s21_raw.shape
+        try:
+            io.append_array(name, 'tone_bin', original.tone_bin)
+            assert False
+        except ValueError:
+            pass
+        io.close()
+        io = nc.NCFile(filename, append=True)
+        s21_raw = np.concatenate((s21_raw, block), axis=1)
+        assert io.append_array(name, 's21_raw', block) == s21_raw.shape
+        io.close()
+        assert np.all(nc.NCFile(filename).read_array(name, 's21_raw') == s21_raw)
+
+
+def test_compression():
+    with TempDirectory() as directory:
+        filename = os.path.join(directory.path, 'test.nc')
+        io = nc.NCFile(filename, compression=1)
+        original = utilities.fake_stream_array()
+        name = 'stream_array'
+        io.write(original, name)
+        variable = io._get_node(name).variables['s21_raw']
+        assert variable.filters()['zlib'] and variable.filters()['shuffle']
+        assert variable.chunking()[0] == 1
+        io.close()
+        io = nc.NCFile(filename, lazy=True)
+        lazy = io.read(name)
+        assert original == lazy
+        assert np.all(np.asarray(lazy.s21_raw[2]) == original.s21_raw[2])
+
+
 # TODO: implement me!
 
 """
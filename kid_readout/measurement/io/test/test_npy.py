@@ -1,5 +1,10 @@
+import os
+import json
+
+import numpy as np
 from testfixtures import TempDirectory
 
+from kid_readout.measurement import core
 from kid_readout.measurement.test import utilities
 from kid_readout.measurement.io import npy
 
@@ -29,6 +34,7 @@ def test_read_write_streamarray():
         name = 'stream_array'
         io.write(original, name)
         assert original == io.read(name)
+        assert original.s21_raw.dtype == io.read(name).s21_raw.dtype == np.complex64
 
 
 def test_read_write_sweeparray():
@@ -49,6 +55,98 @@ def test_read_write_sweepstreamarray():
         assert original == io.read(name)
 
 
+def _convert_to_old_format(path):
+    # Store each value in a separate file, as NumpyDirectory did before it used NODE_FILENAME.
+    for directory, subdirectories, filenames in os.walk(path):
+        if npy.NumpyDirectory.NODE_FILENAME in filenames:
+            filename = os.path.join(directory, npy.NumpyDirectory.NODE_FILENAME)
+            with open(filename) as f:
+                values = json.load(f)
+            os.remove(filename)
+            for key, value in values.items():
+                with open(os.path.join(directory, key), 'w') as f:
+                    json.dump(value, f)
+
+
+def test_old_format():
+    with TempDirectory() as directory:
+        root_path = os.path.join(directory.path, 'old' + npy.NumpyDirectory.EXTENSION)
+        io = npy.NumpyDirectory(root_path, metadata={'key': 'value'})
+        original = utilities.fake_sweep_stream_array()
+        io.write(original, 'sweep_stream_array')
+        io.close()
+        _convert_to_old_format(root_path)
+        io = npy.NumpyDirectory(root_path)
+        assert io.metadata == {'key': 'value'}
+        assert io.read('sweep_stream_array') == original
+        # New nodes written to an old directory are stored in the new format, and old nodes stay in the old format.
+        stream = utilities.fake_single_stream()
+        io.write(stream, 'stream')
+        io.write_other('sweep_stream_array', 'extra', 1)
+        assert os.path.isfile(os.path.join(root_path, 'stream', npy.NumpyDirectory.NODE_FILENAME))
+        assert os.path.isfile(os.path.join(root_path, 'sweep_stream_array', 'extra'))
+        assert sorted(io.node_names()) == ['stream', 'sweep_stream_array']
+        assert npy.NumpyDirectory(root_path).read('stream') == stream
+
+
+def test_listing_cache():
+    with TempDirectory() as directory:
+        writer = npy.NumpyDirectory(directory.path)
+        reader = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_single_stream()
+        writer.write(original, 'stream0')
+        assert reader.node_names() == ['stream0']
+        assert reader.read('stream0') == original
+        writer.write(original, 'stream1')
+        assert sorted(reader.node_names()) == ['stream0', 'stream1']
+        assert sorted(os.listdir(os.path.join(directory.path, 'stream1'))) == sorted(
+            [npy.NumpyDirectory.NODE_FILENAME] + [name + '.npy' for name in original.dimensions])
+        try:
+            writer.write_other('stream1', 'description', 'duplicate')
+            assert False
+        except RuntimeError:
+            pass
+
+
+def test_listing_cache_coarse_mtime():
+    # Nodes written through an instance are listed even if the directory mtime does not change, as happens when the
+    # filesystem timestamp resolution is coarse.
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.write(utilities.fake_single_stream(), 'stream0')
+        assert io.node_names() == ['stream0']
+        stat = os.stat(directory.path)
+        io.create_node('node')
+        os.utime(directory.path, (stat.st_atime, stat.st_mtime))
+        assert sorted(io.node_names()) == ['node', 'stream0']
+        io.write(utilities.fake_single_stream(), 'stream1')
+        os.utime(directory.path, (stat.st_atime, stat.st_mtime))
+        assert sorted(io.node_names()) == ['node', 'stream0', 'stream1']
+
+
+def test_values_written_later():
+    with TempDirectory() as directory:
+        writer = npy.NumpyDirectory(directory.path)
+        reader = npy.NumpyDirectory(directory.path)
+        writer.create_node('node')
+        assert reader.other_names('node') == []
+        writer.write_other('node', 'value', 1)
+        assert reader.other_names('node') == ['value']
+        assert reader.read_other('node', 'value') == 1
+
+
+def test_hidden_files_are_not_nodes():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.write(utilities.fake_single_stream(), 'stream')
+        for name in ('.nfs000000000001', '.DS_Store'):
+            with open(os.path.join(directory.path, name), 'w') as f:
+                f.write('not a node')
+        os.mkdir(os.path.join(directory.path, '.hidden'))
+        assert io.node_names() == ['stream']
+        assert npy.NumpyDirectory(directory.path).node_names() == ['stream']
+
+
 def test_memmap():
     with TempDirectory() as directory:
         io = npy.NumpyDirectory(directory.path, memmap=True)
@@ -56,3 +154,64 @@ def test_memmap():
         name = 'stream'
         io.write(original, name)
         assert original == io.read(name)
+
+
+def test_append_array():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.create_node('node')
+        array = np.zeros((16, 0), dtype=np.complex64, order='F')
+        io.write_array('node', 'fortran', array, ('tone_index', 'sample_time'))
+        io.write_array('node', 'c', np.zeros((16, 10)), ('tone_index', 'sample_time'))
+        for n in range(3):
+            block = np.asfortranarray((np.arange(16 * 10) + 1j * n).reshape((16, 10)))
+            array = np.concatenate((array, block), axis=1)
+            assert io.append_array('node', 'fortran', block) == array.shape
+            assert np.all(io.read_array('node', 'fortran') == array)
+        assert np.all(npy.NumpyDirectory(directory.path, memmap=True).read_array('node', 'fortran') == array)
+        try:
+            io.append_array('node', 'c', block)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_append_stream_array():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        original = utilities.fake_stream_array()
+        # Arrays are stored in their own memory order, so an appendable s21_raw must be created Fortran-ordered, as
+        # it is by the stream pipeline.
+        original.s21_raw = np.asfortranarray(original.s21_raw)
+        name = 'stream_array'
+        io.write(original, name)
+        block = original.s21_raw[:, :10]
+        assert io.append_array(name, 's21_raw', block) == (original.s21_raw.shape[0], original.s21_raw.shape[1] + 10)
+        assert np.all(io.read_array(name, 's21_raw') == np.concatenate((original.s21_raw, block), axis=1))
+
+
+def test_write_array_keeps_order():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path, memmap=True)
+        original = utilities.fake_stream_array()
+        original.s21_raw = np.ascontiguousarray(original.s21_raw)
+        io.write(original, 'stream_array')
+        # Each channel of a C-ordered s21_raw stays contiguous on disk.
+        assert io.read_array('stream_array', 's21_raw').flags.c_contiguous
+
+
+def test_lazy_stream_array():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path, lazy=True)
+        original = utilities.fake_stream_array()
+        original.s21_raw[1, 3] = np.nan * (1 + 1j)
+        name = 'stream_array'
+        io.write(original, name)
+        lazy = io.read(name)
+        assert isinstance(lazy.s21_raw, core.LazyArray)
+        assert original == lazy
+        assert np.all(np.asarray(lazy.s21_raw[2, 10:-10:3]) == original.s21_raw[2, 10:-10:3])
+        assert np.all(np.asarray(lazy[3].s21_raw) == original.s21_raw[3])
+        lazy.s21_raw.chunk_bytes = 1000
+        assert np.allclose(lazy.s21_raw_mean, original.s21_raw_mean)
+        assert np.allclose(lazy.s21_raw_mean_error, original.s21_raw_mean_error)
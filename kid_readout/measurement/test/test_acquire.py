@@ -1,8 +1,13 @@
+import os
+
 import numpy as np
+from testfixtures import TempDirectory
 
 from kid_readout.measurement import acquire
+from kid_readout.measurement.io import nc, npy
 from kid_readout.roach.baseband import RoachBaseband
 from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.r2heterodyne import Roach2Heterodyne
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.roach.tests.mock_valon import MockValon
 
@@ -54,3 +59,109 @@ def test_heterodyne_sweep():
     sweep = acquire.run_loaded_sweep(ri=ri, length_seconds=length_seconds, state=state, description="description")
     assert len(sweep.stream_arrays) == num_waveforms
     assert all([stream_array.s21_raw.shape[0] == num_tones for stream_array in sweep.stream_arrays])
+
+
+def test_pipelined_sweep():
+    num_tones = 16
+    num_waveforms = 2**3
+    num_tone_samples = 2**10
+    for ri in [RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon()),
+               Roach2Heterodyne(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())]:
+        center_frequencies = ri.lo_frequency + np.linspace(100, 200, num_tones)
+        tone_banks = [center_frequencies + offset for offset in np.linspace(-20e-3, 20e-3, num_waveforms)]
+        sweep = acquire.run_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=num_tone_samples, pipeline=True)
+        assert len(sweep.stream_arrays) == num_waveforms
+        for stream_array, tone_bank in zip(sweep.stream_arrays, tone_banks):
+            assert np.allclose(stream_array.frequency / 1e6, tone_bank, atol=ri.fs / num_tone_samples)
+        acquire.load_baseband_sweep_tones(ri, tone_banks, num_tone_samples)
+        serial = acquire.run_loaded_sweep(ri=ri, bin_indices=np.arange(0, num_tones, 2))
+        pipelined = acquire.run_loaded_sweep(ri=ri, bin_indices=np.arange(0, num_tones, 2), pipeline=True)
+        assert len(pipelined.stream_arrays) == num_waveforms
+        for serial_stream_array, pipelined_stream_array in zip(serial.stream_arrays, pipelined.stream_arrays):
+            assert np.all(serial_stream_array.tone_bin == pipelined_stream_array.tone_bin)
+            assert np.all(serial_stream_array.tone_index == pipelined_stream_array.tone_index)
+            assert serial_stream_array.s21_raw.shape == pipelined_stream_array.s21_raw.shape
+
+
+def test_run_pipelined():
+    assert acquire.run_pipelined((lambda k=k: k ** 2) for k in range(10)) == [k ** 2 for k in range(10)]
+    called = []
+
+    def fail():
+        raise ValueError()
+
+    def captures():
+        for k in range(10):
+            called.append(k)
+            yield fail if k == 3 else (lambda: None)
+
+    try:
+        acquire.run_pipelined(captures(), max_pending=1)
+    except ValueError:
+        pass
+    else:
+        assert False, "The exception was not raised."
+    assert len(called) < 10
+
+
+def test_interleaved_groups():
+    groups = acquire.interleaved_groups(100, 32)
+    assert len(groups) == 4
+    assert all(group.size <= 32 for group in groups)
+    assert np.all(np.sort(np.concatenate(groups)) == np.arange(100))
+    assert len(acquire.interleaved_groups(16, 32)) == 1
+
+
+def test_dense_revisit_frequencies():
+    offsets = np.linspace(-1, 1, 21)
+    frequency = np.array([100., 200., 300.]) + offsets[:, np.newaxis]
+    s21 = np.ones(frequency.shape, dtype=np.complex)
+    s21[12, 1] = 0.5  # Only the second tone has a dip.
+    revisit = acquire.dense_revisit_frequencies(frequency, s21, depth=0.3, num_waveforms=5)
+    assert revisit.shape == (5, 1)
+    assert np.allclose(revisit[:, 0], frequency[12, 1] + np.linspace(-0.1, 0.1, 5))
+
+
+def test_multipart_sweep():
+    num_tones = 64
+    num_waveforms = 8
+    num_tone_samples = 2**10
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    center_frequencies = np.linspace(100, 200, num_tones)
+    tone_banks = [center_frequencies + offset for offset in np.linspace(-20e-3, 20e-3, num_waveforms)]
+    acquire.load_baseband_sweep_tones(ri, tone_banks, num_tone_samples)
+    bytes_per_second_per_channel = ri.blocks_per_second_per_channel * ri.SAMPLES_PER_CHANNEL_PER_BLOCK * 4
+    assert ri.max_num_channels(20.5 * bytes_per_second_per_channel) == 16
+    assert ri.max_num_channels(0.5 * bytes_per_second_per_channel) == 1
+    sweep = acquire.run_multipart_sweep(ri, link_bytes_per_second=20 * bytes_per_second_per_channel)
+    assert len(sweep.stream_arrays) == 4 * num_waveforms
+    assert sweep.frequency.size == num_tones * num_waveforms
+    assert all([stream_array._parent is sweep.stream_arrays for stream_array in sweep.stream_arrays])
+    # With a depth of zero, every tone that has a minimum below its median is revisited.
+    sweep = acquire.run_multipart_sweep(ri, num_tones_read_at_once=16, revisit_depth=0, revisit_num_waveforms=4,
+                                        pipeline=True)
+    assert ri.tone_bins.shape[0] == 4
+    num_revisited = ri.tone_bins.shape[1]
+    assert 0 < num_revisited <= num_tones
+    assert sweep.frequency.size == num_tones * num_waveforms + 4 * num_revisited
+
+
+def test_sweep_to_disk():
+    num_tones = 16
+    num_waveforms = 4
+    num_tone_samples = 2**10
+    ri = RoachBaseband(roach=MockRoach('roach'), initialize=False, adc_valon=MockValon())
+    tone_banks = [np.linspace(100, 200, num_tones) + offset for offset in np.linspace(-20e-3, 20e-3, num_waveforms)]
+    with TempDirectory() as directory:
+        for io in [npy.NumpyDirectory(os.path.join(directory.path, 'npy')),
+                   nc.NCFile(os.path.join(directory.path, 'test.nc'))]:
+            sweep = acquire.run_sweep(ri=ri, tone_banks=tone_banks, num_tone_samples=num_tone_samples,
+                                      length_seconds=0.1, description="description", io=io, node_path='sweep')
+            assert sweep._io is io
+            assert len(sweep.stream_arrays) == num_waveforms
+            assert sweep == io.read('sweep')
+            acquire.load_baseband_sweep_tones(ri, tone_banks, num_tone_samples)
+            sweep = acquire.run_loaded_sweep(ri=ri, length_seconds=0.1, pipeline=True, io=io)
+            assert len(sweep.stream_arrays) == num_waveforms
+            assert sweep.frequency.size == num_tones * num_waveforms
+            io.close()
@@ -1,8 +1,12 @@
 import numpy as np
 import warnings
+from matplotlib import mlab
 
+from testfixtures import TempDirectory
+
+from kid_readout.measurement.io import memory, npy
 from kid_readout.measurement.test import utilities
-from kid_readout.analysis.timeseries import spectral_masks
+from kid_readout.analysis.timeseries import despike, spectral_masks, welch
 
 
 def test_s21_raw_mean():
@@ -187,3 +191,62 @@ class TestSingleSweepStream(object):
         self.sss.set_S(masking_function=spectral_masks.pulse_tube_mask)
 
 
+
+
+def test_analyze_all():
+    with TempDirectory() as directory:
+        io = npy.NumpyDirectory(directory.path)
+        io.write(utilities.fake_sweep_stream_array(num_tones=3), 'ssa')
+        ssa = io.read('ssa')
+        serial = ssa.to_dataframe()
+        parallel = ssa.analyze_all(processes=2)
+        assert list(parallel.columns) == list(serial.columns)
+        assert len(parallel) == len(serial)
+        for column in serial.columns:
+            if column == 'analysis_epoch':
+                continue
+            for serial_value, parallel_value in zip(serial[column], parallel[column]):
+                np.testing.assert_array_equal(serial_value, parallel_value)
+
+
+def test_analyze_all_without_lazy_io():
+    io = memory.Dictionary(None)
+    io.write(utilities.fake_sweep_stream_array(num_tones=3), 'ssa')
+    ssa = io.read('ssa')
+    assert not io.SUPPORTS_LAZY
+    dataframe = ssa.analyze_all(processes=2)
+    assert len(dataframe) == 3
+
+
+def test_set_S():
+    sss = utilities.fake_single_sweep_stream()
+    NFFT = 256
+    sss.set_S(NFFT=NFFT, binned=False)
+    kwds = dict(Fs=sss.stream.stream_sample_rate, NFFT=NFFT, window=mlab.window_none, detrend=mlab.detrend_none,
+                noverlap=NFFT // 2)
+    np.testing.assert_allclose(sss.S_xx, mlab.psd(sss.x, **kwds)[0][1:-1], rtol=1e-12)
+    np.testing.assert_allclose(sss.S_qq, mlab.psd(sss.q, **kwds)[0][1:-1], rtol=1e-12)
+    np.testing.assert_allclose(sss.S_xq, mlab.csd(sss.x, sss.q, **kwds)[0][1:-1], rtol=1e-12)
+    sss.set_S(NFFT=NFFT)
+    binned = (sss.S_frequency, sss.S_xx, sss.S_qq, sss.S_xq, sss.S_xx_variance, sss.S_counts)
+    accumulator = welch.CrossSpectralDensityAccumulator(NFFT=NFFT, sample_rate=sss.stream.stream_sample_rate)
+    for start in range(0, sss.x.size, 1000):
+        accumulator.update(sss.x[start:start + 1000], sss.q[start:start + 1000])
+    sss.set_S(accumulator=accumulator)
+    for expected, actual in zip(binned, (sss.S_frequency, sss.S_xx, sss.S_qq, sss.S_xq, sss.S_xx_variance,
+                                         sss.S_counts)):
+        np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+
+def test_s21_raw_glitch_mask():
+    stream_array = utilities.fake_stream_array(num_tones=4, length_seconds=0.1)
+    stream_array.s21_raw[2, 100] += 100 * np.abs(stream_array.s21_raw).max()
+    window_samples = int(2 ** np.ceil(np.log2(0.01 * stream_array.stream_sample_rate)))
+    mask = stream_array.s21_raw_glitch_mask(window_in_seconds=0.01, mask_extend_samples=3)
+    assert mask.shape == stream_array.s21_raw.shape
+    assert mask[2, 100]
+    for number in range(stream_array.tone_bin.size):
+        s21_raw = stream_array.s21_raw[number]
+        expected = (despike.deglitch_mask_mad(s21_raw.real, thresh=8, mask_extend=3, window_length=window_samples) |
+                    despike.deglitch_mask_mad(s21_raw.imag, thresh=8, mask_extend=3, window_length=window_samples))
+        assert np.all(mask[number] == expected)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.measurement import catalog
+from kid_readout.measurement.io import nc, npy
+from kid_readout.measurement.test import utilities
+
+
+def test_catalog():
+    with TempDirectory() as directory:
+        sweep_stream_array = utilities.fake_sweep_stream_array(num_tones=4, sweep_num_waveforms=3)
+        directory.makedir('one')
+        io = npy.NumpyDirectory(os.path.join(directory.path, 'one', 'sweep_stream' + npy.NumpyDirectory.EXTENSION),
+                                metadata={'cryostat': 'test'})
+        io.write(sweep_stream_array, 'sweep_stream_array')
+        io.close()
+        stream_array = utilities.fake_stream_array(num_tones=2)
+        stream_array.roach_state['dac_attenuation'] = 10
+        stream_array.state['temperature'] = {'package': 0.1}
+        io = nc.NCFile(os.path.join(directory.path, 'stream' + nc.NCFile.EXTENSION))
+        io.write(stream_array, 'stream_array')
+        io.close()
+        with open(os.path.join(directory.path, 'unreadable' + nc.NCFile.EXTENSION), 'w') as f:
+            f.write('not a netCDF file')
+        c = catalog.Catalog(':memory:')
+        assert c.update([directory.path]) == {'indexed': 2, 'unchanged': 0, 'removed': 0, 'failed': 1}
+        assert list(c.errors()) == [os.path.join(directory.path, 'unreadable' + nc.NCFile.EXTENSION)]
+        assert c.update([directory.path]) == {'indexed': 0, 'unchanged': 3, 'removed': 0, 'failed': 0}
+
+        entries = c.find(class_name='SweepStreamArray')
+        assert len(entries) == 1
+        entry = entries[0]
+        assert entry.node_path == '/sweep_stream_array' and entry.cryostat == 'test' and entry.num_channels == 4
+        assert np.isclose(entry.min_frequency, sweep_stream_array.sweep_array.frequency.min())
+        assert np.isclose(entry.max_frequency, sweep_stream_array.sweep_array.frequency.max())
+        assert entry.start_epoch == min(sa.epoch for sa in sweep_stream_array.sweep_array.stream_arrays)
+        assert entry.read() == sweep_stream_array
+        # Containers are matched by the roach_state values shared by their contents.
+        assert c.find(roach_state={'dac_attenuation': -1}, top_level=True) == entries
+        assert c.find(roach_state={'dac_attenuation': -1, 'heterodyne': False}, cryostat='test', top_level=True,
+                      frequency=entry.min_frequency, start_epoch=entry.start_epoch) == entries
+        assert c.find(class_name='SweepStreamArray', stop_epoch=entry.start_epoch - 1) == []
+        assert len(c.find(class_name='StreamArray', cryostat='test')) == 4
+        assert c.values(entry)['num_tones'] == 4
+
+        entries = c.find(roach_state={'dac_attenuation': 10}, state={'temperature.package': 0.1})
+        assert [(e.class_name, e.node_path) for e in entries] == [('StreamArray', '/stream_array')]
+        assert entries[0].read() == stream_array
+        assert entries[0].stop_epoch > entries[0].start_epoch == stream_array.epoch
+
+        io = npy.NumpyDirectory(os.path.join(directory.path, 'one', 'sweep_stream' + npy.NumpyDirectory.EXTENSION))
+        io.write(stream_array, 'stream_array')
+        io.close()
+        os.remove(os.path.join(directory.path, 'stream' + nc.NCFile.EXTENSION))
+        assert c.update([directory.path]) == {'indexed': 1, 'unchanged': 1, 'removed': 1, 'failed': 0}
+        assert [e.root_path for e in c.find(roach_state={'dac_attenuation': 10})] == [io.root_path]
+
+
+def test_default_database_path():
+    original = (catalog.settings.BASE_DATA_DIR, catalog.settings.MEASUREMENT_CATALOG_PATH)
+    with TempDirectory() as directory:
+        try:
+            # A BASE_DATA_DIR set after the defaults are imported, as in _local.py, is used.
+            catalog.settings.BASE_DATA_DIR = directory.path
+            catalog.settings.MEASUREMENT_CATALOG_PATH = None
+            c = catalog.Catalog()
+            c.close()
+            assert c.database_path == os.path.join(directory.path, catalog.Catalog.DEFAULT_DATABASE_FILENAME)
+            catalog.settings.MEASUREMENT_CATALOG_PATH = os.path.join(directory.path, 'other.sqlite')
+            c = catalog.Catalog()
+            c.close()
+            assert c.database_path == catalog.settings.MEASUREMENT_CATALOG_PATH
+        finally:
+            catalog.settings.BASE_DATA_DIR, catalog.settings.MEASUREMENT_CATALOG_PATH = original
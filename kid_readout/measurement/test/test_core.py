@@ -219,3 +219,45 @@ def test_sweep_stream_array_node_path():
     assert moved.stream_arrays[0].current_node_path == '/moved/stream_arrays/0'
     assert moved.stream_arrays[0].io_node_path == '/ssa/sweep_array/stream_arrays/0'
 
+
+def test_lazy_array():
+    array = np.arange(2 * 3 * 20, dtype=np.complex64).reshape((2, 3, 20))
+    lazy = core.LazyArray(array)
+    assert lazy.shape == array.shape and lazy.dtype == array.dtype and len(lazy) == 2
+    for key in [0, (1, 2), (Ellipsis, 5), (slice(None), -1, slice(2, 17, 4)), (1, slice(None, None, -1), 3),
+                (slice(None), slice(None, None, -2), slice(15, 3, -3)), (Ellipsis, slice(5, 5))]:
+        assert np.all(np.asarray(lazy[key]) == array[key])
+        assert lazy[key].shape == array[key].shape
+    assert lazy[1, 2, 3] == array[1, 2, 3]
+    assert lazy[1][::2][1, 7:].shape == array[1][::2][1, 7:].shape
+    assert np.all(np.asarray(lazy[1][::-1][1, 7:]) == array[1][::-1][1, 7:])
+    assert np.all(lazy[0, 0].real == array[0, 0].real)
+    assert np.all(lazy[:, 1] + 1 == array[:, 1] + 1)
+    assert np.all(np.concatenate(list(lazy[1].iter_chunks(chunk_bytes=50)), axis=-1) == array[1])
+    lazy.chunk_bytes = 3 * 3 * array.itemsize
+    assert [chunk.shape for chunk in lazy[1].iter_chunks()] == [(3, 3)] * 6 + [(3, 2)]
+
+
+def test_lazy_measurement_list():
+    io = memory.Dictionary()
+    original = utilities.fake_sweep_array(num_tones=4, num_waveforms=5)
+    io.write(original, 'sweep_array')
+    io.lazy = True
+    sweep_array = io.read('sweep_array')
+    stream_arrays = sweep_array.stream_arrays
+    assert isinstance(stream_arrays, core.LazyMeasurementList)
+    assert stream_arrays.class_name() == 'MeasurementList'
+    assert len(stream_arrays) == 5
+    assert not any(isinstance(item, core.Node) for item in list.__iter__(stream_arrays))
+    stream_array = stream_arrays[-2]
+    assert stream_array == original.stream_arrays[3]
+    assert stream_array._parent is stream_arrays and stream_arrays[3] is stream_array
+    assert stream_array._io is io and stream_array._io_node_path == '/sweep_array/stream_arrays/3'
+    assert stream_array.current_node_path == '/stream_arrays/3'
+    assert sum(isinstance(item, core.Node) for item in list.__iter__(stream_arrays)) == 1
+    assert stream_arrays[1:3] == original.stream_arrays[1:3]
+    assert sweep_array == original
+    assert all(isinstance(item, core.Node) for item in list.__iter__(stream_arrays))
+    io.write(sweep_array, 'copy')
+    io.lazy = False
+    assert io.read('copy') == original
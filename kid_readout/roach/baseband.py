@@ -10,6 +10,8 @@ import scipy.signal
 
 import udp_catcher
 import tools
+import instrumentation
+import waveform_cache
 from interface import RoachInterface
 from kid_readout.settings import ROACH1_VALON, ROACH1_IP, ROACH1_HOST_IP
 
@@ -132,6 +134,7 @@ class RoachBaseband(RoachInterface):
         self.save_state()
         return actual_freqs
 
+    @instrumentation.timed('set_tone_bins')
     def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
         """
         Set the stimulus tones by specific integer bins
@@ -149,18 +152,36 @@ class RoachBaseband(RoachInterface):
 
         if bins.ndim == 1:
             bins.shape = (1, bins.shape[0])
-        nwaves = bins.shape[0]
-        spec = np.zeros((nwaves, nsamp // 2 + 1), dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
+        phases_are_reproducible = phases is not None or self.reproducible_phases
         if phases is None:
-            phases = np.random.random(bins.shape[1]) * 2 * np.pi
+            phases = self._default_phases(bins, nsamp)
         self.phases = phases.copy()
         if amps is None:
             amps = 1.0
         self.amps = amps
-        for k in range(nwaves):
-            spec[k, bins[k, :]] = amps * np.exp(1j * phases)
+        if self._use_waveform_cache(normfact, preset_norm, phases_are_reproducible):
+            self.wavenorm = tools.calc_wavenorm(bins.shape[1], nsamp, baseband=True)
+            key = waveform_cache.waveform_key('baseband', bins, nsamp, amps, phases, None, self.wavenorm)
+            qwave = self.waveform_cache.get(key)
+            if qwave is None:
+                qwave = self.waveform_cache.put(key, self._calculate_waveform(bins, nsamp, amps, phases, normfact,
+                                                                              preset_norm))
+        else:
+            qwave = self._calculate_waveform(bins, nsamp, amps, phases, normfact, preset_norm)
+        self.qwave = qwave
+        if load:
+            self.load_waveform(qwave)
+        self.save_state()
+
+    def _calculate_waveform(self, bins, nsamp, amps, phases, normfact, preset_norm):
+        """
+        Return the quantized waveform for the given tones as a 1-D array of big-endian 16-bit integers, and set
+        self.wavenorm.
+        """
+        spec = np.zeros((bins.shape[0], nsamp // 2 + 1), dtype='complex')
+        spec[np.arange(bins.shape[0])[:, np.newaxis], bins] = amps * np.exp(1j * phases)
         wave = np.fft.irfft(spec, axis=1)
         if preset_norm and not normfact:
             self.wavenorm = tools.calc_wavenorm(bins.shape[1], nsamp, baseband=True)
@@ -173,10 +194,7 @@ class RoachBaseband(RoachInterface):
                 self.wavenorm = wn
         qwave = np.round((wave / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
         qwave.shape = (qwave.shape[0] * qwave.shape[1],)
-        self.qwave = qwave
-        if load:
-            self.load_waveform(qwave)
-        self.save_state()
+        return qwave
 
     def add_tone_bins(self, bins, amps=None, preset_norm=True):
         nsamp = self.tone_nsamp
@@ -223,6 +241,7 @@ class RoachBaseband(RoachInterface):
         idx[top_half] = self.nfft - bins[top_half] + self.nfft // 2
         return idx
 
+    @instrumentation.timed('select_fft_bins')
     def select_fft_bins(self, readout_selection=None, sync=True):
         """
         Select which subset of the available FFT bins to read out
@@ -255,6 +274,7 @@ class RoachBaseband(RoachInterface):
         if sync:
             self._sync()
 
+    @instrumentation.timed('demodulate')
     def demodulate_data(self, data):
         """
         Demodulate the data from the FFT bin
@@ -299,11 +319,12 @@ class RoachBaseband(RoachInterface):
             self.loopback = False
 
 
+    @instrumentation.timed('get_data')
     def get_data(self, nread=2, demod=True):
         # TODO This is a temporary hack until we get the system simulation code in place
         if self._using_mock_roach:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
-                    1j * np.random.standard_normal((nread * 4096, self.num_tones)))
+                    1j * np.random.standard_normal((nread * 4096, self.num_tones))).astype(np.complex64)
             if self.r.sleep_for_fake_data:
                 time.sleep(nread / self.blocks_per_second)
             seqnos = np.arange(data.shape[0])
@@ -314,8 +335,7 @@ class RoachBaseband(RoachInterface):
     @property
     def blocks_per_second_per_channel(self):
         chan_rate = self.fs * 1e6 / (2 * self.nfft)  # samples per second for one tone_index
-        samples_per_channel_per_block = 4096
-        return chan_rate / samples_per_channel_per_block
+        return chan_rate / self.SAMPLES_PER_CHANNEL_PER_BLOCK
 
 
     def get_data_seconds(self, nseconds, demod=True, pow2=True):
@@ -340,6 +360,7 @@ class RoachBaseband(RoachInterface):
 
         return self.get_data_udp(blocks, demod=demod)
 
+    @instrumentation.timed('get_data_udp')
     def get_data_udp(self, nread=2, demod=True):
         chan_offset = 1
         nch = self.fpga_fft_readout_indexes.shape[0]
@@ -350,6 +371,9 @@ class RoachBaseband(RoachInterface):
             data = self.demodulate_data(data)
         return data, seqnos
 
+    def demodulate_captured_data(self, data, seqnos):
+        return self.demodulate_data(data), seqnos
+
 
     def get_data_seconds_katcp(self, nseconds, demod=True, pow2=True):
         """
@@ -372,6 +396,7 @@ class RoachBaseband(RoachInterface):
             blocks = 2 ** lg2
         return self.get_data_katcp(blocks, demod=demod)
 
+    @instrumentation.timed('get_data_katcp')
     def get_data_katcp(self, nread=10, demod=True):
         """
         Get a chunk of data
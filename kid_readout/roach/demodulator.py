@@ -1,5 +1,6 @@
 from __future__ import division
 import types
+from collections import OrderedDict
 
 import numpy as np
 import scipy.signal
@@ -7,6 +8,63 @@ import scipy.signal
 from kid_readout.roach.calculate import packet_phase, tone_offset_frequency, get_offset_frequencies_period
 
 
+class _LRUCache(object):
+    """
+    A small least-recently-used cache. The values stored here are shared by every instance that uses them, so arrays
+    should be made read-only before they are stored.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+# These caches persist for the life of the process, so that creating a new Demodulator or StreamDemodulator with the
+# same configuration, as happens for every step of a sweep, does not repeat the large FFT of the PFB window or the
+# construction of the demodulation lookup table.
+_window_response_cache = _LRUCache(maxsize=4)
+_demodulation_lookup_cache = _LRUCache(maxsize=32)
+
+
+def clear_demodulator_cache():
+    """
+    Free the memory used by the cached window responses and demodulation lookup tables.
+    """
+    _window_response_cache.clear()
+    _demodulation_lookup_cache.clear()
+
+
+def _array_key(array):
+    array = np.asarray(array)
+    return array.dtype.str, array.shape, array.tostring()
+
+
+def _read_only(*arrays):
+    for array in arrays:
+        array.setflags(write=False)
+    return arrays
+
+
 class Demodulator(object):
     def __init__(self, nfft=2 ** 14, num_taps=2, window=scipy.signal.flattop, interpolation_factor=64,
                  hardware_delay_samples=0, window_frequency_scale=1):
@@ -16,8 +74,13 @@ class Demodulator(object):
         self.interpolation_factor = interpolation_factor
         self.hardware_delay_samples = hardware_delay_samples
         self.window_frequency_scale = window_frequency_scale
-        self._window_frequency, self._window_response = self.compute_window_frequency_response(
-                self.compute_pfb_window(), interpolation_factor=interpolation_factor)
+        self._window_key = (nfft, num_taps, window, interpolation_factor, window_frequency_scale)
+        cached = _window_response_cache.get(self._window_key)
+        if cached is None:
+            cached = _read_only(*self.compute_window_frequency_response(self.compute_pfb_window(),
+                                                                        interpolation_factor=interpolation_factor))
+            _window_response_cache.put(self._window_key, cached)
+        self._window_frequency, self._window_response = cached
 
     def compute_pfb_window(self):
         if type(self.window_function) is types.FunctionType:
@@ -39,19 +102,23 @@ class Demodulator(object):
         return 1 / np.interp(normalized_frequency, self._window_frequency, self._window_response)
 
     def demodulate(self, data, tone_bin, tone_num_samples, tone_phase, fft_bin, nchan, seq_nos=None):
+        """
+        Return the demodulated data from one channel. The phases are calculated in double precision, and the result has
+        the dtype of the data if it is complex64 or complex128.
+        """
         phi0 = tone_phase
         nfft = self.nfft
         ns = tone_num_samples
         offset_frequency = tone_offset_frequency(tone_bin, tone_num_samples, fft_bin, nfft)
         wc = self.compute_pfb_response(offset_frequency)
         t = np.arange(data.shape[0])
-        demod = wc * np.exp(-1j * (2 * np.pi * offset_frequency * t + phi0)) * data
+        wave = wc * np.exp(-1j * (2 * np.pi * offset_frequency * t + phi0))
         if type(seq_nos) is np.ndarray:
             pphase = np.exp(1j * packet_phase(seq_nos[0], offset_frequency, nchan, ns / nfft, nfft))
-            demod *= pphase
+            wave *= pphase
         if self.hardware_delay_samples != 0:
-            demod *= np.exp(2j * np.pi * self.hardware_delay_samples * tone_bin / tone_num_samples)
-        return demod
+            wave *= np.exp(2j * np.pi * self.hardware_delay_samples * tone_bin / tone_num_samples)
+        return wave.astype(np.result_type(data.dtype, np.complex64)) * data
 
 
 # ToDo: making this function work will require adding window_frequency_scale to Roach classes
@@ -85,11 +152,20 @@ class StreamDemodulator(Demodulator):
         self.samples_per_channel_per_packet = self.samples_per_packet // self.num_channels
         self.sequence_number_increment_per_packet = self.samples_per_channel_per_packet * nfft // 2  # The 2 here is
         # because the sequence number increments once per fpga clock and there are nfft // 2 fpga clocks per sample
-        self.offset_frequencies = tone_offset_frequency(self.tone_bins, self.tone_nsamp, self.fft_bins, self.nfft)
-        self.max_period = get_offset_frequencies_period(self.offset_frequencies)
-        self.pfb_response_correction = self.compute_pfb_response(self.offset_frequencies)
-
-        self.demodulation_lookup = self.create_demodulation_lookup()
+        key = (self._window_key, _array_key(tone_bins), _array_key(phases), tone_nsamp, _array_key(fft_bins),
+               hardware_delay_samples)
+        cached = _demodulation_lookup_cache.get(key)
+        if cached is None:
+            self.offset_frequencies = tone_offset_frequency(self.tone_bins, self.tone_nsamp, self.fft_bins, self.nfft)
+            self.max_period = get_offset_frequencies_period(self.offset_frequencies)
+            self.pfb_response_correction = self.compute_pfb_response(self.offset_frequencies)
+            self.demodulation_lookup = self.create_demodulation_lookup()
+            _read_only(self.offset_frequencies, self.pfb_response_correction, self.demodulation_lookup)
+            _demodulation_lookup_cache.put(key, (self.offset_frequencies, self.max_period,
+                                                 self.pfb_response_correction, self.demodulation_lookup))
+        else:
+            (self.offset_frequencies, self.max_period, self.pfb_response_correction,
+             self.demodulation_lookup) = cached
 
     def demodulate_stream(self, data, sequence_numbers):
         """
@@ -108,7 +184,7 @@ class StreamDemodulator(Demodulator):
         demod_wave = self.create_demodulation_waveform(data.shape, sequence_numbers)
         # if (data.shape[0] % wave_period):
         #    data = data[: wave_period*(data.shape[0]//wave_period),:]
-        return demod_wave * data
+        return demod_wave.astype(np.result_type(data.dtype, np.complex64), copy=False) * data
 
     def create_demodulation_waveform(self, data_shape, seq_nos):
         # Handles dropped packets if they are included as NaNs.
@@ -122,7 +198,7 @@ class StreamDemodulator(Demodulator):
                 * np.exp(-1j * (2 * np.pi * (np.outer(t, self.offset_frequencies) + hardware_delay) + self.phases))
                 * pphase)
         # wave_mat = np.lib.stride_tricks.as_strided(wave, shape=data_shape, strides=(0,wave.strides[1]))
-        wave_mat = wave
+        wave_mat = wave.astype(np.complex64)
         return wave_mat
 
     def create_demodulation_lookup(self):
@@ -133,12 +209,17 @@ class StreamDemodulator(Demodulator):
         t = np.arange(num_time_steps)
         wave = (self.pfb_response_correction
                 * np.exp(-1j * (2 * np.pi * (np.outer(t, self.offset_frequencies) + hardware_delay) + self.phases)))
+        # The phases are calculated in double precision and rounded once; the rounding error is far below the int16
+        # quantization of the data.
+        wave = wave.astype(np.complex64)
         wave.shape = (np.prod(wave.shape),)
         return wave
 
     def lookup_index_from_sequence_num(self, sequence_num):
         lut_size = self.demodulation_lookup.shape[0]
-        packet_number = (sequence_num - self.reference_sequence_number) // self.sequence_number_increment_per_packet
+        # The sequence number is a 32-bit counter that wraps every few seconds during continuous streaming.
+        packet_number = (((int(sequence_num) - self.reference_sequence_number) % 2 ** 32)
+                         // self.sequence_number_increment_per_packet)
         offset = (packet_number * self.samples_per_packet) % lut_size
         return offset
 
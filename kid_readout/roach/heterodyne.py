@@ -7,6 +7,8 @@ from scipy import signal
 import kid_readout.roach.udp_catcher
 from kid_readout.roach.demodulator import Demodulator, StreamDemodulator
 from kid_readout.roach.interface import RoachInterface
+from kid_readout.roach import instrumentation
+from kid_readout.roach import waveform_cache
 from kid_readout.roach.tools import calc_wavenorm, find_best_iq_delay_adc
 
 try:
@@ -199,6 +201,7 @@ class RoachHeterodyne(RoachInterface):
         return actual_freqs
 
 
+    @instrumentation.timed('set_tone_bins')
     def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
         """
         Set the stimulus tones by specific integer bins
@@ -216,19 +219,41 @@ class RoachHeterodyne(RoachInterface):
 
         if bins.ndim == 1:
             bins.shape = (1, bins.shape[0])
-        nwaves = bins.shape[0]
-        spec = np.zeros((nwaves, nsamp), dtype='complex')
         self.tone_bins = bins.copy()
         self.tone_nsamp = nsamp
         #this is to make sure phases are correct shape since we are reusing phases
         if phases is None or phases.shape[0] != bins.shape[1]:
-            phases = np.random.random(bins.shape[1]) * 2 * np.pi
+            phases_are_reproducible = self.reproducible_phases
+            phases = self._default_phases(bins, nsamp)
+        else:
+            phases_are_reproducible = True
         self.phases = phases.copy()
         if amps is None:
             amps = 1.0
         self.amps = amps
-        for k in range(nwaves):
-            spec[k, bins[k, :]] = amps * np.exp(1j * phases)
+        if self._use_waveform_cache(normfact, preset_norm, phases_are_reproducible):
+            self.wavenorm = calc_wavenorm(bins.shape[1], nsamp)
+            key = waveform_cache.waveform_key('heterodyne', bins, nsamp, amps, phases, self.iq_delay, self.wavenorm)
+            q_waves = self.waveform_cache.get(key)
+            if q_waves is None:
+                q_waves = self.waveform_cache.put(key, self._calculate_waveforms(bins, nsamp, amps, phases, normfact,
+                                                                                 preset_norm))
+        else:
+            q_waves = self._calculate_waveforms(bins, nsamp, amps, phases, normfact, preset_norm)
+        q_rwave, q_iwave = q_waves
+        self.q_rwave = q_rwave
+        self.q_iwave = q_iwave
+        if load:
+            self.load_waveforms(q_rwave,q_iwave)
+        self.save_state()
+
+    def _calculate_waveforms(self, bins, nsamp, amps, phases, normfact, preset_norm):
+        """
+        Return the quantized I and Q waveforms for the given tones as an array of big-endian 16-bit integers with shape
+        (2, nwaves * nsamp), and set self.wavenorm.
+        """
+        spec = np.zeros((bins.shape[0], nsamp), dtype='complex')
+        spec[np.arange(bins.shape[0])[:, np.newaxis], bins] = amps * np.exp(1j * phases)
         wave = np.fft.ifft(spec, axis=1)
         if preset_norm:
             self.wavenorm = calc_wavenorm(bins.shape[1], nsamp)
@@ -241,13 +266,7 @@ class RoachHeterodyne(RoachInterface):
         q_rwave = np.round((wave.real / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
         q_iwave = np.round((wave.imag / self.wavenorm) * (2 ** 15 - 1024)).astype('>i2')
         q_iwave = np.roll(q_iwave, self.iq_delay, axis=1)
-        q_rwave.shape = (q_rwave.shape[0] * q_rwave.shape[1],)
-        q_iwave.shape = (q_iwave.shape[0] * q_iwave.shape[1],)
-        self.q_rwave = q_rwave
-        self.q_iwave = q_iwave
-        if load:
-            self.load_waveforms(q_rwave,q_iwave)
-        self.save_state()
+        return np.vstack((q_rwave.ravel(), q_iwave.ravel()))
 
     def add_tone_bins(self, bins, amps=None, preset_norm=True):
         nsamp = self.tone_nsamp
@@ -294,6 +313,7 @@ class RoachHeterodyne(RoachInterface):
         idx = bins.copy()
         return idx
 
+    @instrumentation.timed('select_fft_bins')
     def select_fft_bins(self, readout_selection, sync=True):
         """
         Select which subset of the available FFT bins to read out
@@ -332,6 +352,7 @@ class RoachHeterodyne(RoachInterface):
             self._sync()
 
 
+    @instrumentation.timed('demodulate')
     def demodulate_data(self,data,seq_nos=None):
         bank = self.bank
         demod = np.zeros_like(data)
@@ -346,14 +367,20 @@ class RoachHeterodyne(RoachInterface):
         return demod*self.wavenorm
 
     def get_stream_demodulator(self):
-        return StreamDemodulator(tone_bins=self.tone_bins[self.bank,:],
-                                 phases=self.phases,
+        """
+        Return a StreamDemodulator for the channels in readout_selection, in readout order, using phase0 as the
+        reference sequence number. If no data have been read yet, the reference sequence number is None and must be set
+        before demodulating.
+        """
+        return StreamDemodulator(tone_bins=self.tone_bins[self.bank, self.readout_selection],
+                                 phases=self.phases[self.readout_selection],
                                  tone_nsamp=self.tone_nsamp,
-                                 fft_bins=self.fft_bins[self.bank,:],
+                                 fft_bins=self.fft_bins[self.bank, self.readout_selection],
                                  nfft=self.nfft,
                                  num_taps=self.demodulator.num_taps,
                                  window=self.demodulator.window_function,
-                                 hardware_delay_samples=self.demodulator.hardware_delay_samples)
+                                 hardware_delay_samples=self.demodulator.hardware_delay_samples,
+                                 reference_sequence_number=self.phase0)
 
     def demodulate_data_original(self, data):
         """
@@ -389,14 +416,14 @@ class RoachHeterodyne(RoachInterface):
     @property
     def blocks_per_second_per_channel(self):
         chan_rate = self.fs * 1e6 / (self.nfft)  # samples per second for one tone_index
-        samples_per_channel_per_block = 4096
-        return chan_rate / samples_per_channel_per_block
+        return chan_rate / self.SAMPLES_PER_CHANNEL_PER_BLOCK
 
+    @instrumentation.timed('get_data')
     def get_data(self, nread=2, demod=True):
         # TODO This is a temporary hack until we get the system simulation code in place
         if self._using_mock_roach:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
-                    1j * np.random.standard_normal((nread * 4096, self.num_tones)))
+                    1j * np.random.standard_normal((nread * 4096, self.num_tones))).astype(np.complex64)
             if self.r.sleep_for_fake_data:
                 time.sleep(nread / self.blocks_per_second)
             seqnos = np.arange(data.shape[0])
@@ -404,6 +431,7 @@ class RoachHeterodyne(RoachInterface):
         else:
             return self.get_data_udp(nread=nread, demod=demod)
 
+    @instrumentation.timed('get_data_udp')
     def get_data_udp(self, nread=2, demod=True):
         chan_offset = 1
         nch = self.fpga_fft_readout_indexes.shape[0]
@@ -415,6 +443,10 @@ class RoachHeterodyne(RoachInterface):
             data = self.demodulate_data(data)
         return data, seqnos
 
+    def demodulate_captured_data(self, data, seqnos):
+        return self.demodulate_data(data), seqnos
+
+    @instrumentation.timed('get_data_katcp')
     def get_data_katcp(self, nread=10, demod=True):
         """
         Get a chunk of data
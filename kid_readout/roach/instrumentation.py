@@ -0,0 +1,145 @@
+"""
+This module contains opt-in timers and counters for the acquisition code.
+
+A RoachInterface owns a PerformanceStats instance that is disabled by default, in which case each instrumented call
+costs only an attribute lookup. When it is enabled, each call of an instrumented method records a span, and the capture
+and decoding code increments counters of packets, dropped packets, and idle polls. The results are available from
+RoachInterface.perf_stats() and can be recorded in the roach_state of each measurement.
+
+Usage:
+  ri.enable_perf_stats(record_in_roach_state=True)
+  sweep = acquire.run_sweep(ri, ...)
+  print ri.perf_stats()['spans']['load_dram']['total_seconds']
+"""
+import time
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class PerformanceStats(object):
+    """
+    Accumulate the duration of named spans and the values of named counters.
+
+    For each span name the number of calls and the total and maximum durations are kept, along with the start time and
+    duration of the most recent calls. A span that is entered while another span with the same name is active, as
+    happens when an instrumented method calls the instrumented method it overrides, is not recorded separately. Spans
+    and counters can be recorded from several threads.
+    """
+
+    def __init__(self, enabled=False, record_in_roach_state=False, max_recent_calls=1000):
+        """
+        Parameters
+        ----------
+        enabled : bool
+            If False, spans and counters are not recorded.
+        record_in_roach_state : bool
+            If True, the summary is added to the roach_state of each measurement.
+        max_recent_calls : int
+            The number of individual calls to keep.
+        """
+        self.enabled = enabled
+        self.record_in_roach_state = record_in_roach_state
+        self.recent_calls = deque(maxlen=max_recent_calls)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._spans = {}
+        self._counters = {}
+
+    def reset(self):
+        """
+        Discard all recorded spans and counters.
+        """
+        with self._lock:
+            self.recent_calls.clear()
+            self._spans.clear()
+            self._counters.clear()
+
+    @contextmanager
+    def span(self, name):
+        """
+        Record the duration of the enclosed code under the given name, if enabled.
+        """
+        try:
+            active = self._local.active
+        except AttributeError:
+            active = self._local.active = set()
+        if not self.enabled or name in active:
+            yield
+            return
+        active.add(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            active.discard(name)
+            with self._lock:
+                count, total, maximum = self._spans.get(name, (0, 0., 0.))
+                self._spans[name] = (count + 1, total + duration, max(maximum, duration))
+                self.recent_calls.append((name, start, duration))
+
+    def increment(self, name, value=1):
+        """
+        Add the given value to the named counter, if enabled.
+        """
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + int(value)
+
+    def summary(self, include_recent_calls=False):
+        """
+        Return the recorded spans and counters as a dict that obeys the StateDict restrictions, so that it can be
+        stored in a roach_state.
+
+        Parameters
+        ----------
+        include_recent_calls : bool
+            If True, include a list of (name, start epoch, duration) for the most recent calls; this list does not obey
+            the StateDict restrictions.
+
+        Returns
+        -------
+        dict
+            The 'spans' entry maps each name to a dict with the call count, total, mean, and maximum duration in
+            seconds; the 'counters' entry maps each counter name to its value.
+        """
+        with self._lock:
+            spans = {}
+            for name, (count, total, maximum) in self._spans.items():
+                spans[name] = {'count': count, 'total_seconds': total, 'mean_seconds': total / count,
+                               'max_seconds': maximum}
+            summary = {'spans': spans, 'counters': dict(self._counters)}
+            if include_recent_calls:
+                summary['recent_calls'] = list(self.recent_calls)
+        return summary
+
+
+_null_stats = PerformanceStats(enabled=False)
+
+
+def get_stats(ri):
+    """
+    Return the PerformanceStats of the given RoachInterface, or a disabled instance if it has none.
+    """
+    return getattr(ri, '_perf_stats', None) or _null_stats
+
+
+def timed(name):
+    """
+    Return a decorator that records each call of a RoachInterface method as a span with the given name.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            stats = get_stats(self)
+            if not stats.enabled:
+                return method(self, *args, **kwargs)
+            with stats.span(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
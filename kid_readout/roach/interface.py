@@ -1,3 +1,4 @@
+import copy
 import logging
 import os
 import sys
@@ -14,9 +15,13 @@ import borph_utils
 from kid_readout.roach.tests.mock_roach import MockRoach
 from kid_readout.settings import BASE_DATA_DIR
 from kid_readout.roach import tools
+from kid_readout.roach import r2_stream_data
+from kid_readout.roach import waveform_cache
+from kid_readout.roach import instrumentation
 from kid_readout.measurement.core import StateDict
 from kid_readout.measurement.basic import StreamArray
 from kid_readout.measurement.misc import ADCSnap
+from kid_readout.measurement.io import npy
 
 
 CONFIG_FILE_NAME_TEMPLATE = os.path.join(BASE_DATA_DIR,'%s_config.npz')
@@ -34,6 +39,11 @@ class RoachInterface(object):
 
     BYTES_PER_SAMPLE = 4
     DRAM_SIZE_BYTES = None  # Subclasses should give the appropriate value
+    # True if the first capture after a sync discards the packets sent before it, so no delay is needed after a sync.
+    SYNC_FROM_SEQUENCE_NUMBERS = False
+    SAMPLES_PER_CHANNEL_PER_BLOCK = 4096
+    # The rate at which the UDP data can be received from the gigabit Ethernet link, allowing for packet overhead.
+    LINK_BYTES_PER_SECOND = 0.9 * 1e9 / 8
 
     def __init__(self, roach=None, roachip='roach', adc_valon=None, host_ip=None,
                  nfs_root='/srv/roach_boot/etch', lo_valon=None):
@@ -131,6 +141,16 @@ class RoachInterface(object):
         self.modulation_rate = 0
         self.wavenorm = None
         self.phase0 = None
+        self._stream_pipeline = None
+        # Quantized waveforms are stored here by set_tone_bins; this is None, which disables caching, unless
+        # settings.WAVEFORM_CACHE_DIR is set.
+        self.waveform_cache = waveform_cache.get_default_cache()
+        # If True, set_tone_bins uses phases that depend only on the tone bins when none are given, so that the
+        # waveform for a tone bank loaded before is read from the cache; otherwise the phases are random every time.
+        self.reproducible_phases = False
+        self._perf_stats = instrumentation.PerformanceStats()
+        # Set by _sync() and cleared by the next capture, which can then wait for the sync to finish.
+        self._sync_pending = False
 
         self.loopback = None
         self.debug_register = None
@@ -181,6 +201,30 @@ class RoachInterface(object):
     def max_num_waveforms(self, num_tone_samples):
         return self.DRAM_SIZE_BYTES // (self.BYTES_PER_SAMPLE * num_tone_samples)
 
+    def max_num_channels(self, link_bytes_per_second=None):
+        """
+        Return the largest power of two number of channels that can be read out at once without exceeding the rate of
+        the link that carries the data.
+
+        Parameters
+        ----------
+        link_bytes_per_second : float
+            The usable rate of the link; the default is LINK_BYTES_PER_SECOND.
+
+        Returns
+        -------
+        int
+            The number of channels, which is at least 1.
+        """
+        if link_bytes_per_second is None:
+            link_bytes_per_second = self.LINK_BYTES_PER_SECOND
+        bytes_per_second_per_channel = (self.blocks_per_second_per_channel * self.SAMPLES_PER_CHANNEL_PER_BLOCK *
+                                        self.BYTES_PER_SAMPLE)
+        num_channels = int(link_bytes_per_second // bytes_per_second_per_channel)
+        if num_channels < 1:
+            return 1
+        return 2 ** int(np.log2(num_channels))
+
     @property
     def num_tones(self):
         """
@@ -549,6 +593,7 @@ class RoachInterface(object):
         self.r.write_int('dram_rst', 2)
 
     # TODO: This should raise a RoachError if data is too large to fit in memory.
+    @instrumentation.timed('load_dram')
     def _load_dram(self, data, start_offset=0, fast=True):
         if fast:
             load_dram = self._load_dram_ssh
@@ -587,8 +632,28 @@ class RoachInterface(object):
             tries = tries - 1
         raise Exception("Writing to dram failed!")
 
-    def _load_dram_ssh(self, data, offset_bytes=0, datafile='boffiles/dram.bin'):
-        offset_blocks = offset_bytes / 512  #dd uses blocks of 512 bytes by default
+    def _default_phases(self, bins, nsamp):
+        """
+        Return the tone phases that set_tone_bins uses when none are given; see reproducible_phases.
+        """
+        if self.reproducible_phases:
+            return waveform_cache.reproducible_phases(bins, nsamp)
+        return np.random.random(bins.shape[1]) * 2 * np.pi
+
+    def _use_waveform_cache(self, normfact, preset_norm, phases_are_reproducible):
+        """
+        Return True if set_tone_bins should store the waveform in the cache, which is only the case when the waveform is
+        normalized using the preset normalization and its phases can be requested again, because they were given by
+        the caller or are reproducible; a waveform with random phases would never be read from the cache.
+        """
+        return self.waveform_cache is not None and preset_norm and normfact is None and phases_are_reproducible
+
+    def _load_dram_ssh(self, data, offset_bytes=0, datafile='boffiles/dram.bin', block_size=2 ** 20):
+        # dd is much faster with large blocks, but it seeks in units of the block size, so fall back to its default
+        # 512-byte blocks if the offset is not a multiple of the block size.
+        if offset_bytes % block_size:
+            block_size = 512
+        offset_blocks = offset_bytes // block_size
         self._update_bof_pid()
         self._pause_dram()
         if self._using_mock_roach:
@@ -600,11 +665,13 @@ class RoachInterface(object):
             # TODO: Verify that this change is fine.
             # This was using borph_utils.check_output(), which seems to be the same as subprocess.check_output().
             # Capture stderr to stdout because dd prints to stderr.
-            command = 'ssh root@%s "dd seek=%d if=%s of=%s"' % (self.roachip, offset_blocks, datafile, dram_file)
+            command = 'ssh root@%s "dd bs=%d seek=%d if=%s of=%s"' % (self.roachip, block_size, offset_blocks, datafile,
+                                                                     dram_file)
             result = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
             logger.debug(result)
         self._unpause_dram()
 
+    @instrumentation.timed('sync')
     def _sync(self,loopback=None):
         if loopback is not None:
             warnings.warn("loopback parameter to _sync is deprecated, use set_loopback method")
@@ -616,6 +683,7 @@ class RoachInterface(object):
         self.r.write_int('sync', 0+base_value)
         self.r.write_int('sync', 1+base_value)
         self.r.write_int('sync', 0+base_value)
+        self._sync_pending = True
 
     ### Other hardware functions (attenuator, valon)
     def set_attenuator(self, attendb, gpio_reg='gpioa', data_bit=0x08, clk_bit=0x04, le_bit=0x02):
@@ -687,7 +755,62 @@ class RoachInterface(object):
     def blocks_per_second_per_channel(self):
         raise NotImplementedError("blocks_per_second needs to be implemented for this subclass")
 
+    def enable_perf_stats(self, record_in_roach_state=False, reset=True):
+        """
+        Start recording the duration of acquisition calls and counts of packets, dropped packets, and idle polls.
+
+        Parameters
+        ----------
+        record_in_roach_state : bool
+            If True, add the summary returned by perf_stats() to the roach_state of each measurement, under the key
+            'perf_stats'.
+        reset : bool
+            If True, discard anything recorded previously.
+        """
+        if reset:
+            self._perf_stats.reset()
+        self._perf_stats.record_in_roach_state = record_in_roach_state
+        self._perf_stats.enabled = True
+
+    def disable_perf_stats(self):
+        """
+        Stop recording; the values recorded so far are still available from perf_stats().
+        """
+        self._perf_stats.enabled = False
+        self._perf_stats.record_in_roach_state = False
+
+    def perf_stats(self, reset=False, include_recent_calls=False):
+        """
+        Return a summary of the recorded spans and counters; see instrumentation.PerformanceStats.summary().
+
+        Parameters
+        ----------
+        reset : bool
+            If True, discard the recorded values after summarizing them.
+        include_recent_calls : bool
+            If True, include the start time and duration of each recent call.
+
+        Returns
+        -------
+        dict
+            The summary.
+        """
+        summary = self._perf_stats.summary(include_recent_calls=include_recent_calls)
+        if reset:
+            self._perf_stats.reset()
+        return summary
+
     def get_measurement(self, num_seconds, power_of_two=True, demod=True, **kwargs):
+        return self.get_measurement_blocks(self._num_blocks(num_seconds, power_of_two), demod=demod, **kwargs)
+
+    def capture_measurement(self, num_seconds, power_of_two=True, demod=True, **kwargs):
+        """
+        Capture the data for a StreamArray like get_measurement() and return a function that returns the StreamArray;
+        see capture_measurement_blocks().
+        """
+        return self.capture_measurement_blocks(self._num_blocks(num_seconds, power_of_two), demod=demod, **kwargs)
+
+    def _num_blocks(self, num_seconds, power_of_two):
         num_blocks = self.blocks_per_second*num_seconds
         if num_blocks == 0:
             num_blocks = 1 # we have to get at least one block
@@ -696,32 +819,165 @@ class RoachInterface(object):
             if log2 < 0:
                 log2 = 0
             num_blocks = 2 ** log2
-        return self.get_measurement_blocks(num_blocks, demod=demod, **kwargs)
+        return num_blocks
 
+    @instrumentation.timed('get_measurement_blocks')
     def get_measurement_blocks(self, num_blocks, demod=True, **kwargs):
         epoch = time.time()  # This will be improved
         data, seqnos = self.get_data(num_blocks, demod=demod)
         sequence_start_number = int(seqnos[0])  # The numpy datatype causes IO problems.
-        if np.isscalar(self.amps):
-            tone_amplitude = self.amps * np.ones(self.tone_bins.shape[1], dtype='float')
-        else:
-            tone_amplitude = self.amps.copy()
-        output_order = self.readout_selection.argsort()
-        measurement = StreamArray(tone_bin=self.tone_bins[self.bank, :].copy(),
-                                  tone_amplitude=tone_amplitude,  # already copied
-                                  tone_phase=self.phases.copy(),
-                                  tone_index=self.readout_selection.copy()[output_order],
-                                  filterbank_bin=self.fft_bins[self.bank, self.readout_selection].copy()[output_order],
-                                  epoch=epoch,
+        stream_array_kwargs, output_order = self._get_stream_array_kwargs()
+        if self._perf_stats.enabled and self._perf_stats.record_in_roach_state:
+            stream_array_kwargs['roach_state']['perf_stats'] = self.perf_stats()
+        stream_array_kwargs.update(kwargs)
+        measurement = StreamArray(epoch=epoch,
                                   sequence_start_number=sequence_start_number,
                                   s21_raw=data[:,output_order].T,  # transpose for now, because measurements are
                                           # organized channel,time
                                   data_demodulated=demod,
-                                  roach_state=self.get_state(),
-                                  **kwargs)
+                                  **stream_array_kwargs)
         return measurement
 
+    @instrumentation.timed('capture_measurement_blocks')
+    def capture_measurement_blocks(self, num_blocks, demod=True, **kwargs):
+        """
+        Capture the data for a StreamArray and return a function that demodulates the data and returns the StreamArray.
+
+        The returned function uses the tones and channels that were selected during the capture, so it can be called
+        from another thread while the next bank is selected and captured; see acquire.run_loaded_sweep().
+
+        Parameters
+        ----------
+        num_blocks : int
+            The number of blocks to capture.
+        demod : bool
+            If True, the returned function demodulates the data.
+        kwargs
+            Passed to the StreamArray.
+
+        Returns
+        -------
+        callable
+            A function with no arguments that returns the StreamArray; the result is the same as that of
+            get_measurement_blocks(num_blocks, demod, **kwargs).
+        """
+        epoch = time.time()
+        data, seqnos = self.get_data(num_blocks, demod=False)
+        stream_array_kwargs, output_order = self._get_stream_array_kwargs()
+        if self._perf_stats.enabled and self._perf_stats.record_in_roach_state:
+            stream_array_kwargs['roach_state']['perf_stats'] = self.perf_stats()
+        stream_array_kwargs.update(kwargs)
+        # The data are demodulated using a shallow copy so that later changes to the tones and channels, which replace
+        # the attributes instead of modifying them, do not affect it.
+        demodulator = copy.copy(self)
+
+        def finish():
+            if demod and not self._using_mock_roach:
+                demodulated, sequence_numbers = demodulator.demodulate_captured_data(data, seqnos)
+            else:
+                demodulated, sequence_numbers = data, seqnos
+            return StreamArray(epoch=epoch,
+                               sequence_start_number=int(sequence_numbers[0]),
+                               s21_raw=demodulated[:, output_order].T,
+                               data_demodulated=demod,
+                               **stream_array_kwargs)
+
+        return finish
+
+    def demodulate_captured_data(self, data, seqnos):
+        """
+        Demodulate data returned by get_data(demod=False) and return the data and sequence numbers that get_data()
+        would have returned with demod=True.
+        """
+        raise NotImplementedError("Subclasses must implement this.")
+
+    def _get_stream_array_kwargs(self):
+        """
+        Return a dict of the StreamArray arguments that describe the current tones and channels, and the array that
+        sorts the data channels, which are in readout order, into tone_index order.
+        """
+        if np.isscalar(self.amps):
+            tone_amplitude = self.amps * np.ones(self.tone_bins.shape[1], dtype='float')
+        else:
+            tone_amplitude = self.amps.copy()
+        output_order = self.readout_selection.argsort()
+        stream_array_kwargs = dict(tone_bin=self.tone_bins[self.bank, :].copy(),
+                                   tone_amplitude=tone_amplitude,  # already copied
+                                   tone_phase=self.phases.copy(),
+                                   tone_index=self.readout_selection.copy()[output_order],
+                                   filterbank_bin=self.fft_bins[self.bank, self.readout_selection].copy()[output_order],
+                                   roach_state=self.get_state())
+        return stream_array_kwargs, output_order
+
+    def get_stream_demodulator(self):
+        raise NotImplementedError("Stream demodulation is implemented only for heterodyne readouts.")
+
+    def start_stream(self, io, node_path=None, num_packets_per_buffer=2 ** 12, num_data_buffers=4, **kwargs):
+        """
+        Start writing the demodulated data from the selected channels to a StreamArray on disk until stop_stream() is
+        called. The packets are captured, demodulated, and written by separate processes, so this method returns
+        immediately and the data rate is limited only by the link and the disk.
+
+        Parameters
+        ----------
+        io : NumpyDirectory or str
+            The IO to which the StreamArray is written; if this is a string, it is the root path of a NumpyDirectory,
+            which is created if it does not exist.
+        node_path : str
+            The node path of the new StreamArray; the default is the next default name in the IO.
+        num_packets_per_buffer : int
+            The number of packets in each shared memory buffer; the data from a buffer are written at once.
+        num_data_buffers : int
+            The number of buffers in each stage of the pipeline.
+        kwargs
+            Passed to the StreamArray; these can include state and description.
+
+        Returns
+        -------
+        str
+            The node path of the StreamArray.
+        """
+        if self._stream_pipeline is not None:
+            raise RoachError("A stream is already running; call stop_stream() first.")
+        if not self.is_roach2:
+            raise RoachError("Streaming to disk requires the ROACH2 UDP packet stream.")
+        if isinstance(io, basestring):
+            io = npy.NumpyDirectory(io)
+        if not hasattr(io, 'append_array'):
+            raise ValueError("Streaming to disk requires an IO that supports appending to arrays.")
+        if node_path is None:
+            node_path = io.default_name(StreamArray)
+        stream_demodulator = self.get_stream_demodulator()
+        stream_array_kwargs, output_order = self._get_stream_array_kwargs()
+        stream_array_kwargs.update(kwargs)
+        stream_array_kwargs['data_demodulated'] = True
+        self.r.write_int('txrst', 2)
+        self._stream_pipeline = r2_stream_data.ReadoutPipeline(stream_demodulator=stream_demodulator,
+                                                               io_class=io.__class__, root_path=io.root_path,
+                                                               node_path=node_path,
+                                                               stream_array_kwargs=stream_array_kwargs,
+                                                               output_order=output_order, scale=self.wavenorm,
+                                                               num_data_buffers=num_data_buffers,
+                                                               num_packets_per_buffer=num_packets_per_buffer,
+                                                               host_address=(self.host_ip, 55555))
+        self._stream_pipeline.wait_until_ready()
+        self.r.write_int('txrst', 0)
+        return node_path
+
+    def stop_stream(self):
+        """
+        Stop the stream started by start_stream(), wait for all captured data to be written, and return a dict of
+        statistics that includes the number of packets captured and dropped.
+        """
+        if self._stream_pipeline is None:
+            raise RoachError("No stream is running.")
+        try:
+            return self._stream_pipeline.close()
+        finally:
+            self._stream_pipeline = None
+
     ### Tried and true readout function
+    @instrumentation.timed('katcp_read')
     def _read_data(self, nread, bufname, verbose=False):
         """
         Low level data reading loop, common to both readouts
@@ -764,7 +1020,10 @@ class RoachInterface(object):
         tot = time.time() - tic
         logger.debug("read %d in %.1f seconds, %.2f samples per second, idle %.2f per read" % (
                         nread, tot, (nread * 2 ** 12 / tot), idle / (nread * 1.0)))
-        dout = np.concatenate(([np.fromstring(x, dtype='>i2').astype('float').view('complex') for x in data]))
+        stats = self._perf_stats
+        stats.increment('katcp_reads', len(data))
+        stats.increment('idle_polls', idle)
+        dout = np.concatenate(([np.fromstring(x, dtype='>i2').astype(np.float32).view(np.complex64) for x in data]))
         addrs = np.array(addrs)
         chans = np.array(chans)
         return dout, addrs, chans
@@ -5,23 +5,34 @@ Processing pipeline:
   * Decode int16 -> float32, recover packet sequence number
   * Demodulate
     * (Buffer)
-  * Filter
   * Write to disk
-  
+
+Each stage runs in its own process. The packet and demodulated buffers live in shared memory and are handed from one
+stage to the next through queues of buffer indices, so at any time each buffer is owned by exactly one process and no
+locks are needed. If the writer falls behind, the capture process blocks waiting for a free buffer and the kernel drops
+packets; dropped packets are recorded as NaN samples on disk so that the time axis stays uniform.
+
 Usage:
   * Do sweeps of resonators
   * Set tones to resonant frequencies
-  * Start streaming processing pipeline for as long as desired
+  * Start streaming processing pipeline for as long as desired using RoachInterface.start_stream()
+  * Stop it using RoachInterface.stop_stream(); the data are in a StreamArray on disk
 """
 
-import numpy as np
+import logging
 import socket
 from contextlib import closing
 import multiprocessing as mp
 import time
 import ctypes
 from Queue import Empty as EmptyException
-from kid_readout.roach import demodulator
+
+import numpy as np
+
+from kid_readout.measurement import basic
+from kid_readout.roach import udp_catcher
+
+logger = logging.getLogger(__name__)
 
 pkt_size = 4100
 data_ctype = ctypes.c_uint8
@@ -30,31 +41,70 @@ sequence_num_ctype = ctypes.c_uint32
 counter_dtype = np.uint32
 chns_per_pkt = 1024
 samples_per_packet = 1024
+sequence_number_modulus = 2 ** 32
+packets_per_stop_check = 64
 
-class ReadoutPipeline:
-    def __init__(self, nchans, num_data_buffers=4, num_packets_per_buffer=2 ** 12, output_size=2 ** 20,
-                 host_address=('10.0.0.1',55555)):
-        packet_buffer_size = pkt_size * num_packets_per_buffer
-        self.num_data_buffers = num_data_buffers
-        self.packet_data_buffers = [mp.Array(data_ctype, packet_buffer_size) for b in range(num_data_buffers)]
 
-        demodulated_buffer_size = num_packets_per_buffer*samples_per_packet*np.dtype(np.complex64).size
-        self.demodulated_data_buffers = [mp.Array(ctypes.c_uint8, demodulated_buffer_size) for b in range(num_data_buffers)]
+class ReadoutPipeline:
+    """
+    Capture, demodulate, and write to disk the packet stream from a ROACH2.
 
-        self.real_time_data_buffer = mp.Array(ctypes.c_uint8, output_size*np.dtype(np.complex64).size)
+    The demodulated data are written to a StreamArray at node_path in the IO at root_path: the node is created when the
+    first buffer is written, and its s21_raw array is appended to as each buffer is demodulated. Because the writer
+    process opens its own instance of io_class, this must be an IO class whose files can be opened for writing by a
+    second process, such as NumpyDirectory.
+    """
 
-        # im not sure we are using this correctly. should there be a lock somewhere?
-        # or does it not matter because only one process gets it
-        self._sequence_num_buffer = mp.Array(sequence_num_ctype, output_size)
-        self.sequence_num = np.frombuffer(self._sequence_num_buffer.get_obj(), dtype=counter_dtype)
-        self.sequence_num[:] = 0
+    def __init__(self, stream_demodulator, io_class, root_path, node_path, stream_array_kwargs, output_order=None,
+                 scale=1, num_data_buffers=4, num_packets_per_buffer=2 ** 12, host_address=('10.0.0.1', 55555)):
+        """
+        Parameters
+        ----------
+        stream_demodulator : StreamDemodulator
+            The demodulator for the selected channels, in readout order. If its reference_sequence_number is None, it
+            is set to the sequence number of the first packet.
+        io_class : subclass of core.IO
+            The IO class used to write the data.
+        root_path : str
+            The root path of the IO.
+        node_path : str
+            The node path of the StreamArray to create.
+        stream_array_kwargs : dict
+            Keyword arguments for the StreamArray, except for s21_raw, epoch, and sequence_start_number.
+        output_order : array of int
+            The order in which to write the demodulated channels; the default is readout order.
+        scale : float
+            The demodulated data are multiplied by this value before they are written.
+        num_data_buffers : int
+            The number of packet buffers and demodulated buffers.
+        num_packets_per_buffer : int
+            The number of packets in each buffer.
+        host_address : tuple
+            The (address, port) on which to listen for packets.
+        """
+        self.num_data_buffers = num_data_buffers
+        self.num_packets_per_buffer = num_packets_per_buffer
+        self.node_path = node_path
+        self.packet_data_buffers = [mp.RawArray(data_ctype, pkt_size * num_packets_per_buffer)
+                                    for b in range(num_data_buffers)]
+        self.sequence_number_buffers = [mp.RawArray(sequence_num_ctype, num_packets_per_buffer)
+                                        for b in range(num_data_buffers)]
+        demodulated_buffer_size = num_packets_per_buffer * samples_per_packet * np.dtype(np.complex64).itemsize
+        self.demodulated_data_buffers = [mp.RawArray(ctypes.c_uint8, demodulated_buffer_size)
+                                         for b in range(num_data_buffers)]
 
         self.capture_status = mp.Array(ctypes.c_char, 32)
         self.demodulate_status = mp.Array(ctypes.c_char, 32)
+        self.write_status = mp.Array(ctypes.c_char, 32)
 
-        self._num_bad_packets = mp.Value(ctypes.c_uint)
-        self.num_bad_packets = self._num_bad_packets.get_obj()
-        self.num_bad_packets.value = 0
+        self._num_bad_packets = mp.Value(ctypes.c_uint64, 0)
+        self._num_packets_captured = mp.Value(ctypes.c_uint64, 0)
+        self._num_packets_dropped = mp.Value(ctypes.c_uint64, 0)
+        self._num_samples_written = mp.Value(ctypes.c_uint64, 0)
+        self._epoch = mp.Value(ctypes.c_double, np.nan)
+        self._reference_sequence_number = mp.Value(ctypes.c_int64, -1)
+        self._stop = mp.RawValue(ctypes.c_bool, False)
+        self._ready = mp.Event()
 
         self.packet_input_queue = mp.Queue()
         self.packet_output_queue = mp.Queue()
@@ -65,144 +115,292 @@ class ReadoutPipeline:
             self.packet_input_queue.put(i)
             self.demodulated_input_queue.put(i)
 
+        self.write_data = WriteStreamArrayProcess(demodulated_data_buffers=self.demodulated_data_buffers,
+                                                  sequence_number_buffers=self.sequence_number_buffers,
+                                                  demodulated_input_queue=self.demodulated_input_queue,
+                                                  demodulated_output_queue=self.demodulated_output_queue,
+                                                  num_channels=stream_demodulator.num_channels,
+                                                  sequence_number_increment=(
+                                                      stream_demodulator.sequence_number_increment_per_packet),
+                                                  io_class=io_class, root_path=root_path, node_path=node_path,
+                                                  stream_array_kwargs=stream_array_kwargs, output_order=output_order,
+                                                  scale=scale, epoch=self._epoch,
+                                                  reference_sequence_number=self._reference_sequence_number,
+                                                  dropped_packets_counter=self._num_packets_dropped,
+                                                  samples_counter=self._num_samples_written,
+                                                  status=self.write_status)
+
         self.process_data = DecodePacketsAndDemodulateProcess(packet_data_buffers=self.packet_data_buffers,
-                                                              num_packets_per_buffer=num_packets_per_buffer,
-                                                              packet_output_queue=self.packet_output_queue,
-                                                              packet_input_queue=self.packet_input_queue,
+                                                              sequence_number_buffers=self.sequence_number_buffers,
                                                               demodulated_data_buffers=self.demodulated_data_buffers,
+                                                              packet_input_queue=self.packet_input_queue,
+                                                              packet_output_queue=self.packet_output_queue,
                                                               demodulated_input_queue=self.demodulated_input_queue,
-                                                              sequence_num_buffer=self._sequence_num_buffer,
-                                                              output_size=output_size,
-                                                              nchans=nchans, status = self.demodulate_status)
+                                                              demodulated_output_queue=self.demodulated_output_queue,
+                                                              stream_demodulator=stream_demodulator,
+                                                              reference_sequence_number=(
+                                                                  self._reference_sequence_number),
+                                                              status=self.demodulate_status)
 
         self.read_data = CapturePacketsProcess(packet_data_buffers=self.packet_data_buffers,
                                                num_packets_per_buffer=num_packets_per_buffer,
                                                packet_input_queue=self.packet_input_queue,
                                                packet_output_queue=self.packet_output_queue,
                                                bad_packets_counter=self._num_bad_packets,
-                                               host_address=host_address, status = self.capture_status)
+                                               packets_counter=self._num_packets_captured,
+                                               host_address=host_address, epoch=self._epoch, stop=self._stop,
+                                               ready=self._ready, status=self.capture_status)
+
+    def wait_until_ready(self, timeout=10):
+        """
+        Block until the capture process is listening for packets.
+        """
+        if not self._ready.wait(timeout):
+            raise RuntimeError("Capture process did not start within {} seconds.".format(timeout))
+
+    @property
+    def running(self):
+        return any(process.child.is_alive() for process in (self.read_data, self.process_data, self.write_data))
+
+    def get_stats(self):
+        return {'epoch': self._epoch.value,
+                'num_packets_captured': self._num_packets_captured.value,
+                'num_bad_packets': self._num_bad_packets.value,
+                'num_packets_dropped': self._num_packets_dropped.value,
+                'num_samples_written': self._num_samples_written.value,
+                'capture_status': self.capture_status.value,
+                'demodulate_status': self.demodulate_status.value,
+                'write_status': self.write_status.value}
 
-    def close(self):
-        self.packet_input_queue.put(None)
+    def close(self, timeout=10):
+        """
+        Stop capturing packets, wait for the captured data to be demodulated and written, and return the statistics.
+        """
+        self._stop.value = True
+        for process in (self.read_data, self.process_data, self.write_data):
+            process.child.join(timeout)
+            if process.child.is_alive():
+                logger.error("{} did not exit; terminating it.".format(process.__class__.__name__))
+                process.child.terminate()
+        return self.get_stats()
+
+
+class CapturePacketsProcess:
+    def __init__(self, packet_data_buffers, num_packets_per_buffer, packet_input_queue, packet_output_queue,
+                 bad_packets_counter, packets_counter, host_address, epoch, stop, ready, status):
+        self.packet_data_buffers = packet_data_buffers
+        self.num_packets_per_buffer = num_packets_per_buffer
+        self.packet_input_queue = packet_input_queue
+        self.packet_output_queue = packet_output_queue
+        self.bad_packets_counter = bad_packets_counter
+        self.packets_counter = packets_counter
+        self.host_address = host_address
+        self.epoch = epoch
+        self.stop = stop
+        self.ready = ready
+        self.status = status
+        self.status.value = "starting"
+        self.child = mp.Process(target=self.run)
+        self.child.start()
+
+    def run(self):
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            # A large kernel buffer absorbs bursts while this process waits for a free packet buffer; the kernel limits
+            # the size to net.core.rmem_max.
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 26)
+            s.bind(self.host_address)
+            s.settimeout(0.1)
+            self.ready.set()
+            first_packet = True
+            while not self.stop.value:
+                try:
+                    process_me = self.packet_input_queue.get(timeout=0.1)
+                except EmptyException:
+                    self.status.value = "blocked"
+                    continue
+                self.status.value = "processing"
+                packet_buffer = np.frombuffer(self.packet_data_buffers[process_me], dtype=data_dtype)
+                packet_buffer.shape = (self.num_packets_per_buffer, pkt_size)
+                i = 0
+                while i < self.num_packets_per_buffer and not self.stop.value:
+                    # Receive straight into the shared buffer, a few packets at a time so that a stop request is
+                    # noticed promptly even when the packet rate is low.
+                    if first_packet:
+                        stop_row = 1
+                    else:
+                        stop_row = min(i + packets_per_stop_check, self.num_packets_per_buffer)
+                    i, num_bad, timed_out = udp_catcher.recv_packets_into(s, packet_buffer[:stop_row], start=i)
+                    if num_bad:
+                        self.bad_packets_counter.value += num_bad
+                    if first_packet and i:
+                        self.epoch.value = time.time()
+                        first_packet = False
+                if i:
+                    self.packets_counter.value += i
+                    self.packet_output_queue.put((process_me, i))
+                else:
+                    self.packet_input_queue.put(process_me)
         self.packet_output_queue.put(None)
-        self.read_data.child.join()
-        self.process_data.child.join()
+        self.status.value = "exiting"
+        return None
 
 
 class DecodePacketsAndDemodulateProcess:
-    def __init__(self, packet_data_buffers, demodulated_data_buffers, num_packets_per_buffer,
-                 packet_input_queue, packet_output_queue,
-                 demodulated_input_queue, sequence_num_buffer, output_size,
-                 nchans, status):
-        self.output_index = 0
+    def __init__(self, packet_data_buffers, sequence_number_buffers, demodulated_data_buffers, packet_input_queue,
+                 packet_output_queue, demodulated_input_queue, demodulated_output_queue, stream_demodulator,
+                 reference_sequence_number, status):
         self.packet_data_buffers = packet_data_buffers
+        self.sequence_number_buffers = sequence_number_buffers
         self.demodulated_data_buffers = demodulated_data_buffers
-        self.num_packets_per_buffer = num_packets_per_buffer
         self.packet_input_queue = packet_input_queue
         self.packet_output_queue = packet_output_queue
         self.demodulated_input_queue = demodulated_input_queue
-        self.sequence_num_buffer = sequence_num_buffer
-        self.output_size = output_size
-        self.nchans = nchans
+        self.demodulated_output_queue = demodulated_output_queue
+        self.demodulator = stream_demodulator
+        self.reference_sequence_number = reference_sequence_number
         self.status = status
         self.status.value = "not started"
         self.child = mp.Process(target=self.run)
         self.child.start()
 
     def run(self):
-        self.demodulator = demodulator.StreamDemodulator(tone_bins=self.tone_bins,phases=self.phases,
-                                                         tone_nsamp=self.tone_nsamp, fft_bins=self.fft_bins,
-                                                         nfft=self.nfft, )
         while True:
-            try:
-                process_me = self.packet_output_queue.get_nowait()
-            except EmptyException:
-                self.status.value = "waiting"
-                time.sleep(0.01)
-                continue
+            self.status.value = "waiting"
+            process_me = self.packet_output_queue.get()
             if process_me is None:
                 break
-            else:
-                self.status.value = "blocked"
-                output_to = self.demodulated_input_queue.get()
-
-                with self.packet_data_buffers[process_me].get_lock(), self.demodulated_data_buffers[output_to].get_lock():
-                    self.status.value = "processing"
-                    packets = np.frombuffer(self.packet_data_buffers[process_me].get_obj(), dtype=data_dtype)
-                    packets.shape=(self.num_packets_per_buffer, pkt_size)
-                    pkt_counter = packets.view(counter_dtype)[:,-1]
-
-#                    contiguous = np.all(np.diff(pkt_counter)==1)
-
-                    demod_data = np.frombuffer(self.demodulated_data_buffers[output_to].get_obj(), dtype=np.complex64)
-
-                    raw_data = packets[:,:-4].view('<i2').astype(np.float32).view(np.complex64)
-                    raw_data = raw_data.reshape((-1,self.nchans))
-
-
-                    demod_data = np.transpose(demod_data.reshape((-1,self.nchans,2)),axes=(2,0,1))
-
-                    # Decode packets
-                    for k in range(self.num_packets_per_buffer):
-                        si = k * chns_per_pkt
-                        sf = (k + 1) * chns_per_pkt
-                        demod_data[si:sf] = packets[k,:-4].view('<i2').astype('float32').view('complex64')
-                        self.sequence_num_buffer[self.output_index] = pkt_counter[k]
-                        self.output_index += 1
-                        self.output_index %= self.output_size
-                    demod_data = demod_data.reshape((-1,self.nchans))
-
-#                    data = r2.demodulate_stream(data, pkt_counter)
-                    #print "decode ", timeit.default_timer() - t0
-                self.demodulated_output_queue.put(output_to)
-                self.packet_input_queue.put(process_me)
+            packet_index, num_packets = process_me
+            self.status.value = "blocked"
+            output_to = self.demodulated_input_queue.get()
+            self.status.value = "processing"
+            packets = np.frombuffer(self.packet_data_buffers[packet_index], dtype=data_dtype)
+            packets = packets.reshape((-1, pkt_size))[:num_packets]
+            sequence_numbers = np.frombuffer(self.sequence_number_buffers[output_to], dtype=counter_dtype)
+            demodulated = np.frombuffer(self.demodulated_data_buffers[output_to], dtype=np.complex64)
+            demodulated = demodulated.reshape((-1, samples_per_packet))[:num_packets]
+            if self.demodulator.reference_sequence_number is None:
+                self.demodulator.reference_sequence_number = int(packets[0, -4:].view('<u4')[0])
+            self.reference_sequence_number.value = self.demodulator.reference_sequence_number
+            self.demodulator.decode_and_demodulate_packet_buffer(packets, sequence_numbers[:num_packets], demodulated)
+            self.packet_input_queue.put(packet_index)
+            self.demodulated_output_queue.put((output_to, num_packets))
+        self.demodulated_output_queue.put(None)
         self.status.value = "exiting"
         return None
 
 
-class CapturePacketsProcess:
-    def __init__(self, packet_data_buffers, num_packets_per_buffer, packet_input_queue, packet_output_queue,
-                 bad_packets_counter, host_address,status):
-        self.packet_data_buffers = packet_data_buffers
-        self.num_packets_per_buffer = num_packets_per_buffer
-        self.packet_input_queue = packet_input_queue
-        self.packet_output_queue = packet_output_queue
-        self.bad_packets_counter = bad_packets_counter
-        self.host_address = host_address
+class WriteStreamArrayProcess:
+    def __init__(self, demodulated_data_buffers, sequence_number_buffers, demodulated_input_queue,
+                 demodulated_output_queue, num_channels, sequence_number_increment, io_class, root_path, node_path,
+                 stream_array_kwargs, output_order, scale, epoch, reference_sequence_number, dropped_packets_counter,
+                 samples_counter, status):
+        self.demodulated_data_buffers = demodulated_data_buffers
+        self.sequence_number_buffers = sequence_number_buffers
+        self.demodulated_input_queue = demodulated_input_queue
+        self.demodulated_output_queue = demodulated_output_queue
+        self.num_channels = num_channels
+        self.sequence_number_increment = sequence_number_increment
+        self.io_class = io_class
+        self.root_path = root_path
+        self.node_path = node_path
+        self.stream_array_kwargs = stream_array_kwargs
+        if output_order is None:
+            output_order = np.arange(num_channels)
+        self.output_order = output_order
+        self.scale = scale
+        self.epoch = epoch
+        self.reference_sequence_number = reference_sequence_number
+        self.dropped_packets_counter = dropped_packets_counter
+        self.samples_counter = samples_counter
         self.status = status
-        self.status.value = "starting"
+        self.status.value = "not started"
         self.child = mp.Process(target=self.run)
         self.child.start()
 
     def run(self):
-        with closing(socket.socket(socket.AF_INET,socket.SOCK_DGRAM)) as s:
-            s.bind(self.host_address)
-            s.settimeout(1)
+        io = self.io_class(self.root_path)
+        previous_sequence_number = None
+        stream_array_created = False
+        try:
             while True:
-                try:
-                    process_me = self.packet_input_queue.get_nowait()
-                except EmptyException:
-                    self.status.value = "blocked"
-                    time.sleep(0.005)
-                    continue
+                self.status.value = "waiting"
+                process_me = self.demodulated_output_queue.get()
                 if process_me is None:
                     break
+                output_index, num_packets = process_me
+                self.status.value = "processing"
+                sequence_numbers = np.frombuffer(self.sequence_number_buffers[output_index],
+                                                 dtype=counter_dtype)[:num_packets]
+                demodulated = np.frombuffer(self.demodulated_data_buffers[output_index], dtype=np.complex64)
+                demodulated = demodulated.reshape((-1, samples_per_packet))[:num_packets]
+                if previous_sequence_number is None:
+                    sequence_start_number = int(sequence_numbers[0])
+                    previous_sequence_number = (sequence_start_number -
+                                                self.sequence_number_increment) % sequence_number_modulus
+                packets, num_dropped = fill_dropped_packets(demodulated, sequence_numbers, previous_sequence_number,
+                                                            self.sequence_number_increment)
+                previous_sequence_number = ((previous_sequence_number +
+                                             packets.shape[0] * self.sequence_number_increment) %
+                                            sequence_number_modulus)
+                # Indexing copies the data, so the buffer can be released immediately. The transposed array must be
+                # Fortran-ordered so that it can be appended to on disk.
+                s21_raw = np.asfortranarray(packets.reshape((-1, self.num_channels))[:, self.output_order].T)
+                self.demodulated_input_queue.put(output_index)
+                s21_raw *= self.scale
+                self.status.value = "writing"
+                if not stream_array_created:
+                    self._create_stream_array(io, s21_raw, sequence_start_number)
+                    stream_array_created = True
                 else:
-                    with self.packet_data_buffers[process_me].get_lock():
-                        self.status.value = "processing"
-                        #t0 = timeit.default_timer()
-                        packet_buffer = np.frombuffer(self.packet_data_buffers[process_me].get_obj(), dtype=data_dtype)
-                        packet_buffer.shape=(self.num_packets_per_buffer, pkt_size)
-                        i = 0
-                        while i < self.num_packets_per_buffer:
-                            pkt = s.recv(5000)
-                            if len(pkt) == pkt_size:
-                                packet_buffer[i,:] = np.frombuffer(pkt, dtype=data_dtype)
-                                i += 1
-                            else:
-                                print "got a bad packet"
-                                self.bad_packets_counter.value += 1
-                        #print "read: ", timeit.default_timer() - t0
-                    self.packet_output_queue.put(process_me)
+                    io.append_array(self.node_path, 's21_raw', s21_raw)
+                self.samples_counter.value += s21_raw.shape[1]
+                if num_dropped:
+                    self.dropped_packets_counter.value += num_dropped
+                    logger.warning("Filled {} dropped packets with NaN.".format(num_dropped))
+        finally:
+            io.close()
         self.status.value = "exiting"
         return None
+
+    def _create_stream_array(self, io, s21_raw, sequence_start_number):
+        kwargs = dict(self.stream_array_kwargs)
+        roach_state = kwargs.pop('roach_state')
+        roach_state['reference_sequence_number'] = self.reference_sequence_number.value
+        stream_array = basic.StreamArray(s21_raw=s21_raw, roach_state=roach_state, epoch=self.epoch.value,
+                                         sequence_start_number=sequence_start_number, **kwargs)
+        io.write(stream_array, self.node_path)
+
+
+def fill_dropped_packets(data, sequence_numbers, previous_sequence_number, sequence_number_increment):
+    """
+    Place each packet of data according to its sequence number, filling the places of missing packets with NaN.
+
+    Parameters
+    ----------
+    data : array of complex (num_packets, samples_per_packet)
+        The packet data.
+    sequence_numbers : array of uint32 (num_packets,)
+        The sequence number of each packet.
+    previous_sequence_number : int
+        The sequence number of the packet before the first packet; the counter may wrap between packets.
+    sequence_number_increment : int
+        The increase in sequence number from one packet to the next.
+
+    Returns
+    -------
+    array of complex (num_places, samples_per_packet)
+        The data, with a row of NaN for each missing packet up to the last packet with a valid sequence number.
+    int
+        The number of missing packets.
+    """
+    offsets = (sequence_numbers.astype(np.int64) - previous_sequence_number) % sequence_number_modulus
+    # Discard packets that are repeated or that arrive after a later packet has already been written.
+    valid = (offsets > 0) & (offsets < sequence_number_modulus // 2) & (offsets % sequence_number_increment == 0)
+    places = offsets // sequence_number_increment - 1
+    num_places = int(places[valid].max()) + 1 if np.any(valid) else 0
+    if np.all(valid) and num_places == data.shape[0] and np.all(places == np.arange(num_places)):
+        return data, 0
+    filled = np.empty((num_places, data.shape[1]), dtype=data.dtype)
+    filled.fill(np.nan)
+    filled[places[valid]] = data[valid]
+    return filled, num_places - np.unique(places[valid]).size
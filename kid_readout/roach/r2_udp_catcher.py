@@ -1,10 +1,17 @@
+import time
 import numpy as np
 import socket
 from contextlib import closing
 
+from kid_readout.roach import instrumentation, udp_catcher
+
 import logging
 logger = logging.getLogger(__name__)
 
+packet_size = 4100
+chns_per_pkt = 1024
+cntr_total = 2**32
+
 try:
     # must compile cython code by running: python setup.py build_ext --inplace
     import decode
@@ -52,12 +59,83 @@ def get_udp_packets(ri,npkts,addr=('10.0.0.1',55555)):
     return pkts
 
 
-def get_udp_data(ri,npkts,nchans,addr=('10.0.0.1',55555), verbose=False, fast=False):
-    pkts = get_udp_packets(ri, npkts, addr=addr)
-    if fast:
-        darray, seqnos, num_bad_pkts, num_dropped_pkts = decode.decode_packets_fast(pkts,nchans)
+def get_udp_packet_buffer(ri, npkts, addr=('10.0.0.1', 55555), packet_buffer=None, sync_increment=None,
+                          sync_timeout=0.1):
+    """
+    Capture npkts packets directly into the rows of a uint8 array with shape (npkts, 4100) and return the rows that
+    were filled; the packets are not copied again, so the array can be passed straight to decode_packet_buffer() or
+    StreamDemodulator.decode_and_demodulate_packet_buffer(). As in get_udp_packets(), the first packet received after
+    the transmitter is reset is discarded. If packet_buffer is given, it must be a C-contiguous array with this shape,
+    and it is reused.
+
+    If sync_increment is not None, it is the sequence number increment per packet, and the capture waits for a sync
+    that was just requested: packets are discarded until the sync is confirmed by keep_packets_after_sync(), and are
+    then replaced by later packets. If the sync is not confirmed within sync_timeout seconds, all packets received so
+    far are discarded, so the data are captured after at least that delay, as they were when the caller slept
+    instead.
+    """
+    if packet_buffer is None:
+        packet_buffer = np.empty((npkts, packet_size), dtype=np.uint8)
+    ri.r.write_int('txrst',2)
+    with closing(socket.socket(socket.AF_INET,socket.SOCK_DGRAM)) as s:
+        s.bind(addr)
+        udp_catcher.flush_socket(s)
+        s.settimeout(1)
+        ri.r.write_int('txrst',0)
+        if sync_increment is not None:
+            synced = False
+            sync_deadline = time.time() + sync_timeout
+            # A packet counter smaller than this must have restarted after the sync.
+            max_sequence_number = sync_increment * int(np.ceil(sync_timeout * ri.blocks_per_second))
+        else:
+            synced = True
+        num_received, num_bad, timed_out = udp_catcher.recv_packets_into(s, packet_buffer[:1])
+        num_packets = 0
+        retries = 0
+        while num_packets < npkts and retries < 5:
+            num_packets, bad, timed_out = udp_catcher.recv_packets_into(s, packet_buffer, start=num_packets)
+            num_bad += bad
+            if not synced:
+                num_packets, synced = keep_packets_after_sync(packet_buffer, num_packets, sync_increment,
+                                                              max_sequence_number)
+                if not synced and time.time() > sync_deadline:
+                    logger.warning("The packet counter restart was not observed within %.3f s of the sync; discarding "
+                                   "the packets received so far" % sync_timeout)
+                    num_packets = 0
+                    synced = True
+            if timed_out:
+                logger.error("Socket timeout waiting for packets from ROACH. This probably means the GbE is jammed. "
+                             "Attempting to restart GbE")
+                ri.r.write_int('txrst',1)
+                ri.r.write_int('txrst',0)
+                retries += 1
+            else:
+                retries = 0
+    if num_bad:
+        logger.warning("Discarded %d packets with size not equal to %d" % (num_bad, packet_size))
+    return packet_buffer[:num_packets]
+
+
+def get_udp_data(ri,npkts,nchans,addr=('10.0.0.1',55555), verbose=False, wait_for_sync=False):
+    """
+    Capture and decode npkts packets. The packets are received directly into an array and decoded with array
+    operations by decode_packet_buffer(). If wait_for_sync is True, packets sent before a sync that was just requested are discarded, as described in
+    get_udp_packet_buffer().
+    """
+    if wait_for_sync:
+        sync_increment = ri.fpga_cycles_per_filterbank_frame * chns_per_pkt // nchans
     else:
-        darray, seqnos, num_bad_pkts, num_dropped_pkts = decode_packets(pkts,nchans,ri.fpga_cycles_per_filterbank_frame)
+        sync_increment = None
+    stats = instrumentation.get_stats(ri)
+    with stats.span('capture'):
+        packet_buffer = get_udp_packet_buffer(ri, npkts, addr=addr, sync_increment=sync_increment)
+    with stats.span('decode'):
+        darray, seqnos, num_bad_pkts, num_dropped_pkts = decode_packet_buffer(packet_buffer, nchans,
+                                                                              ri.fpga_cycles_per_filterbank_frame,
+                                                                              num_packets=npkts)
+    stats.increment('packets_captured', packet_buffer.shape[0])
+    stats.increment('packets_bad', num_bad_pkts)
+    stats.increment('packets_dropped', num_dropped_pkts)
     if num_bad_pkts or num_dropped_pkts:
         logger.warning("Detected %d bad and %d dropped packets. Something is likely misconfigured" % (num_bad_pkts,num_dropped_pkts))
     if verbose:
@@ -66,6 +144,131 @@ def get_udp_data(ri,npkts,nchans,addr=('10.0.0.1',55555), verbose=False, fast=Fa
     return darray,seqnos
 
 
+def find_sync(sequence_numbers, increment, max_reorder=16):
+    """
+    Return the index of the first packet sent after the last restart of the packet counter, or 0 if the counter did
+    not restart.
+
+    A sync restarts the packet counter, so the sequence numbers of the packets sent after it are smaller than those of
+    the packets sent before it. A step backward by more than max_reorder packets is taken to be a restart, so that
+    packets that arrive slightly out of order are not mistaken for one; wrapping of the 32-bit counter is a step
+    forward.
+
+    Parameters
+    ----------
+    sequence_numbers : ndarray(uint32)
+        The sequence numbers of the packets, in the order they were received.
+    increment : int
+        The sequence number increment per packet.
+    max_reorder : int
+        The largest number of packets by which a packet can arrive out of order.
+
+    Returns
+    -------
+    int
+        The index of the first packet after the sync.
+    """
+    steps = np.diff(np.asarray(sequence_numbers).astype(np.int64)) % cntr_total
+    steps[steps >= cntr_total // 2] -= cntr_total
+    restarts = np.flatnonzero(steps < -max_reorder * increment)
+    if not restarts.size:
+        return 0
+    return restarts[-1] + 1
+
+
+def discard_packets_before_sync(packet_buffer, num_packets, increment):
+    """
+    Discard the packets in the first num_packets rows of packet_buffer that were sent before the last restart of the
+    packet counter, as found by find_sync(), by moving the following packets to the start of the buffer.
+
+    Returns the number of packets that remain, so the caller can fill the rest of the buffer with later packets.
+    """
+    if num_packets < 2:
+        return num_packets
+    first = find_sync(packet_buffer[:num_packets, -4:].copy().view('<u4')[:, 0], increment)
+    if first:
+        logger.debug("Discarded %d packets sent before the sync" % first)
+        packet_buffer[:num_packets - first] = packet_buffer[first:num_packets]
+    return num_packets - first
+
+
+def keep_packets_after_sync(packet_buffer, num_packets, increment, max_sequence_number):
+    """
+    Discard the packets in the first num_packets rows of packet_buffer that may have been sent before a sync that was
+    just requested, and return whether the sync has been confirmed.
+
+    The sync is confirmed if the packet counter restarted within these packets, as found by find_sync(), in which case
+    the earlier packets are discarded, or if the sequence number of the first packet is at most max_sequence_number,
+    in which case the counter must have restarted before it was sent. Otherwise, every packet may have been sent before
+    the sync, so only the last one is kept, at the start of the buffer, so that a restart between it and the next
+    packet received can be found.
+
+    Parameters
+    ----------
+    packet_buffer : ndarray(uint8)
+        The packets, with shape (npkts, 4100).
+    num_packets : int
+        The number of rows that contain packets.
+    increment : int
+        The sequence number increment per packet.
+    max_sequence_number : int
+        The largest sequence number of a packet that is taken to have been sent after the counter restarted.
+
+    Returns
+    -------
+    int
+        The number of packets that remain at the start of the buffer.
+    bool
+        True if the sync has been confirmed.
+    """
+    if num_packets == 0:
+        return 0, False
+    remaining = discard_packets_before_sync(packet_buffer, num_packets, increment)
+    if remaining < num_packets:
+        return remaining, True
+    if packet_buffer[0, -4:].copy().view('<u4')[0] <= max_sequence_number:
+        return num_packets, True
+    packet_buffer[0] = packet_buffer[num_packets - 1]
+    return 1, False
+
+
+def decode_packet_buffer(packet_buffer, nchans, clocks_per_filterbank_frame, num_packets=None):
+    """
+    Decode an array of packets with shape (npkts, 4100), such as that returned by get_udp_packet_buffer().
+
+    The packets are placed according to their sequence numbers relative to the first packet, accounting for wrapping of
+    the 32-bit counter, and the places of missing packets are filled with NaN. Packets that would be placed before the
+    first packet or after the last place are discarded.
+
+    Returns the data with shape (-1, nchans), the sequence number of each packet place (zero for missing packets), the
+    number of missing packets at the end of the data, and the number of missing packets within the data; this matches
+    the output of decode_packets().
+    """
+    assert(nchans>0)
+    if num_packets is None:
+        num_packets = packet_buffer.shape[0]
+    pkt_counter_step = clocks_per_filterbank_frame * chns_per_pkt // nchans
+    packet_counter = np.zeros(num_packets, dtype='uint32')
+    data = np.empty((num_packets, chns_per_pkt), dtype='complex64')
+    data.fill(np.nan+1j*np.nan)
+    if packet_buffer.shape[0] == 0:
+        return data.reshape((-1,nchans)), packet_counter, num_packets, 0
+    sequence_numbers = packet_buffer[:, -4:].copy().view('<u4')[:, 0]
+    # Unwrap the counter using the step between consecutive packets; reordered packets appear as very large steps.
+    steps = np.diff(sequence_numbers.astype(np.int64)) % cntr_total
+    steps[steps >= cntr_total // 2] -= cntr_total
+    offsets = np.concatenate(([0], np.cumsum(steps)))
+    k = offsets // pkt_counter_step
+    valid = (offsets % pkt_counter_step == 0) & (k >= 0) & (k < num_packets)
+    data[k[valid]] = packet_buffer[valid, :-4].view('<i2').astype('float32').view('complex64')
+    packet_counter[k[valid]] = sequence_numbers[valid]
+    num_filled = np.unique(k[valid]).size
+    last = k[valid].max()
+    num_bad_pkts = num_packets - 1 - last
+    num_dropped_pkts = last + 1 - num_filled
+    return data.reshape((-1,nchans)), packet_counter, num_bad_pkts, num_dropped_pkts
+
+
 def decode_packets(plist,nchans,clocks_per_filterbank_frame):
     assert(nchans>0)
     plist = plist[1:]
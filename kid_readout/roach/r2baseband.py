@@ -12,6 +12,7 @@ import logging
 
 import udp_catcher
 import tools
+import instrumentation
 from interface import RoachInterface
 from baseband import RoachBaseband
 import kid_readout.roach.r2_udp_catcher
@@ -29,6 +30,9 @@ except ImportError:
 
 
 class Roach2Baseband(RoachBaseband):
+    SYNC_FROM_SEQUENCE_NUMBERS = True
+    SAMPLES_PER_CHANNEL_PER_BLOCK = 1024  # 1024 samples per packet
+
     def __init__(self,roach=None, wafer=0, roachip='r2kid', adc_valon=settings.ROACH2_VALON, host_ip=settings.ROACH2_GBE_HOST_IP,
                  initialize=True, nfs_root='/srv/roach_boot/etch'):
         super(Roach2Baseband,self).__init__(roach=roach,wafer=wafer,roachip=roachip, adc_valon=adc_valon,
@@ -77,6 +81,7 @@ class Roach2Baseband(RoachBaseband):
             q.qdr_cal()
             logger.info("Succesfully recalibrated QDR")
 
+    @instrumentation.timed('load_dram')
     def load_waveform(self, wave, start_offset=0, fast=True):
         """
         Load waveform
@@ -100,11 +105,12 @@ class Roach2Baseband(RoachBaseband):
     def _unpause_dram(self):
         self.r.write_int('qdr_en',1)
 
+    @instrumentation.timed('get_data')
     def get_data(self, nread=2, demod=True):
         # TODO This is a temporary hack until we get the system simulation code in place
         if self._using_mock_roach:
             data = (np.random.standard_normal((nread * 4096, self.num_tones)) +
-                    1j * np.random.standard_normal((nread * 4096, self.num_tones)))
+                    1j * np.random.standard_normal((nread * 4096, self.num_tones))).astype(np.complex64)
             if self.r.sleep_for_fake_data:
                 time.sleep(nread / self.blocks_per_second)
             seqnos = np.arange(data.shape[0])
@@ -112,11 +118,13 @@ class Roach2Baseband(RoachBaseband):
         else:
             return self.get_data_udp(nread=nread, demod=demod)
 
+    @instrumentation.timed('get_data_udp')
     def get_data_udp(self, nread=2, demod=True, fast=False):
         data, seq_nos = kid_readout.roach.r2_udp_catcher.get_udp_data(self, npkts=nread,
                                                                      nchans=self.readout_selection.shape[0],
-                                                                     addr=(self.host_ip, 55555), fast=fast)
-
+                                                                     addr=(self.host_ip, 55555),
+                                                                     wait_for_sync=self._sync_pending)
+        self._sync_pending = False
         if self.phase0 is None:
             self.phase0 = seq_nos[0]
         if demod:
@@ -127,6 +135,10 @@ class Roach2Baseband(RoachBaseband):
                 data = self.demodulate_data(data)
         return data, seq_nos
 
+    def demodulate_captured_data(self, data, seqnos):
+        return self.demodulate_data(data), seqnos - self.phase0
+
+    @instrumentation.timed('select_fft_bins')
     def select_fft_bins(self, readout_selection=None, sync=True):
         """
         Select which subset of the available FFT bins to read out
@@ -163,6 +175,7 @@ class Roach2Baseband(RoachBaseband):
         if sync:
             self._sync()
 
+    @instrumentation.timed('demodulate')
     def demodulate_data(self, data):
         """
         Demodulate the data from the FFT bin
@@ -201,5 +214,4 @@ class Roach2Baseband(RoachBaseband):
     @property
     def blocks_per_second_per_channel(self):
         chan_rate = self.fs * 1e6 / (2 * self.nfft)  # samples per second for one tone_index
-        samples_per_channel_per_block = 1024 #1024 samples per packet
-        return chan_rate / samples_per_channel_per_block
+        return chan_rate / self.SAMPLES_PER_CHANNEL_PER_BLOCK
@@ -9,6 +9,8 @@ import socket
 import numpy as np
 import scipy.signal
 import kid_readout.roach.r2_udp_catcher
+from kid_readout.roach import r2_stream_data
+from kid_readout.roach import instrumentation
 from heterodyne import RoachHeterodyne
 from kid_readout.roach.demodulator import Demodulator
 
@@ -22,6 +24,9 @@ except ImportError:
 
 
 class Roach2Heterodyne(RoachHeterodyne):
+    SYNC_FROM_SEQUENCE_NUMBERS = True
+    SAMPLES_PER_CHANNEL_PER_BLOCK = 1024  # 1024 samples per packet
+
     def __init__(self, roach=None, wafer=0, roachip='r2kid', adc_valon=None, host_ip=None, initialize=True,
                  nfs_root='/srv/roach_boot/etch', lo_valon=None, attenuator=None):
         super(Roach2Heterodyne, self).__init__(roach=roach, wafer=wafer, roachip=roachip, adc_valon=adc_valon,
@@ -74,9 +79,11 @@ class Roach2Heterodyne(RoachHeterodyne):
             q.qdr_cal()
             logger.info("Succesfully recalibrated QDR")
 
+    @instrumentation.timed('set_tone_bins')
     def set_tone_bins(self, bins, nsamp, amps=None, load=True, normfact=None, phases=None, preset_norm=True):
         super(Roach2Heterodyne,self).set_tone_bins(bins=bins, nsamp=nsamp, amps=amps, load=load, normfact=normfact, phases=phases, preset_norm=preset_norm)
 
+    @instrumentation.timed('load_dram')
     def load_waveforms(self, i_wave, q_wave, fast=True, start_offset=0):
         """
         Load waveforms for the two DACs
@@ -101,27 +108,61 @@ class Roach2Heterodyne(RoachHeterodyne):
     def _unpause_dram(self):
         self.r.write_int('qdr_en',1)
 
+    @instrumentation.timed('get_data_udp')
     def get_data_udp(self, nread=2, demod=True, fast=False):
+        if fast and demod:
+            return self._get_stream_demodulated_data_udp(nread)
         data, seq_nos = kid_readout.roach.r2_udp_catcher.get_udp_data(self, npkts=nread,
                                                                      nchans=self.readout_selection.shape[0],
-                                                                     addr=(self.host_ip, 55555), fast=fast)
-
+                                                                     addr=(self.host_ip, 55555),
+                                                                     wait_for_sync=self._sync_pending)
+        self._sync_pending = False
         if self.phase0 is None:
             self.phase0 = seq_nos[0]
         if demod:
             seq_nos -= self.phase0
-            if fast:
-                data = self.demodulate_stream(data, seq_nos)
-            else:
-                data = self.demodulate_data(data, seq_nos)
+            data = self.demodulate_data(data, seq_nos)
             data = data*self.wavenorm
         return data, seq_nos
 
+    def demodulate_captured_data(self, data, seqnos):
+        seqnos = seqnos - self.phase0
+        return self.demodulate_data(data, seqnos) * self.wavenorm, seqnos
+
+    def _get_stream_demodulated_data_udp(self, nread):
+        """
+        Capture nread packets into an array and demodulate them directly from that array using a StreamDemodulator;
+        missing packets are filled with NaN. The returned sequence numbers are relative to phase0.
+        """
+        stats = instrumentation.get_stats(self)
+        stream_demodulator = self.get_stream_demodulator()
+        increment = stream_demodulator.sequence_number_increment_per_packet
+        with stats.span('capture'):
+            packet_buffer = kid_readout.roach.r2_udp_catcher.get_udp_packet_buffer(
+                self, npkts=nread, addr=(self.host_ip, 55555), sync_increment=increment if self._sync_pending else None)
+        self._sync_pending = False
+        if self.phase0 is None:
+            self.phase0 = int(packet_buffer[0, -4:].view('<u4')[0])
+            stream_demodulator.reference_sequence_number = self.phase0
+        sequence_numbers = np.empty(packet_buffer.shape[0], dtype=np.uint32)
+        demodulated = np.empty((packet_buffer.shape[0], stream_demodulator.samples_per_packet), dtype=np.complex64)
+        with stats.span('decode_and_demodulate'):
+            stream_demodulator.decode_and_demodulate_packet_buffer(packet_buffer, sequence_numbers, demodulated)
+            first = int(sequence_numbers[0])
+            data, num_dropped = r2_stream_data.fill_dropped_packets(demodulated, sequence_numbers,
+                                                                    (first - increment) % 2 ** 32, increment)
+        stats.increment('packets_captured', packet_buffer.shape[0])
+        stats.increment('packets_dropped', num_dropped)
+        if num_dropped:
+            logger.warning("Filled %d dropped packets with NaN" % num_dropped)
+        seq_nos = ((first - int(self.phase0) + increment * np.arange(data.shape[0])) % 2 ** 32).astype(np.uint32)
+        data = data.reshape((-1, self.readout_selection.shape[0]))*self.wavenorm
+        return data, seq_nos
+
     @property
     def blocks_per_second_per_channel(self):
         chan_rate = self.fs * 1e6 / (self.nfft)  # samples per second for one tone_index
-        samples_per_channel_per_block = 1024
-        return chan_rate / samples_per_channel_per_block
+        return chan_rate / self.SAMPLES_PER_CHANNEL_PER_BLOCK
 
 
 class Roach2Heterodyne11(Roach2Heterodyne):
@@ -1 +1,22 @@
 __author__ = 'gjones'
+
+import shutil
+import tempfile
+
+from kid_readout import settings
+from kid_readout.roach import waveform_cache
+
+_original_waveform_cache_dir = None
+
+
+def setup_package():
+    # Cache waveforms in a private directory instead of any directory set in the local settings.
+    global _original_waveform_cache_dir
+    _original_waveform_cache_dir = settings.WAVEFORM_CACHE_DIR
+    settings.WAVEFORM_CACHE_DIR = tempfile.mkdtemp(prefix='kid_readout_waveforms_')
+
+
+def teardown_package():
+    shutil.rmtree(settings.WAVEFORM_CACHE_DIR, ignore_errors=True)
+    settings.WAVEFORM_CACHE_DIR = _original_waveform_cache_dir
+    waveform_cache._default_cache = None
@@ -0,0 +1,326 @@
+"""
+Benchmark the readout path: packet decoding, demodulation, waveform generation, and writing streams to and reading
+them from disk.
+
+Each run is appended to a JSON history file so that the throughput of one commit can be compared to that of another.
+
+Usage:
+  python -m kid_readout.roach.tests.benchmark_readout --history benchmark_history.json
+  python -m kid_readout.roach.tests.benchmark_readout --quick --compare
+
+The history file contains a list of runs. Each run is a dict with the commit, the time, and information about the host,
+plus a list of results; each result is a dict with the benchmark name, its parameters, the best time in seconds for one
+call, and the throughput in the given unit per second.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.roach import demodulator, r2_stream_data, r2_udp_catcher, udp_catcher, waveform_cache
+from kid_readout.roach.baseband import RoachBaseband
+from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.tests.mock_roach import MockRoach
+from kid_readout.roach.tests.mock_valon import MockValon
+from kid_readout.roach.tests.system_simulator import ResonatorModel, SystemSimulator
+from kid_readout.roach.tests.test_udp_catcher import make_roach1_packets
+from kid_readout.measurement import basic
+from kid_readout.measurement.io import nc, npy
+from kid_readout.measurement.test import utilities
+
+try:
+    from kid_readout.roach import decode
+    have_decode = True
+except ImportError:
+    have_decode = False
+
+NUM_CHANNELS = (1, 4, 16, 64, 256, 1024)
+NFFT = (2 ** 11, 2 ** 12, 2 ** 13, 2 ** 14)
+QUICK_NUM_CHANNELS = (1, 16, 1024)
+QUICK_NFFT = (2 ** 11, 2 ** 14)
+NUM_PACKETS = 256
+TONE_NSAMP = 2 ** 18
+
+
+def best_time(function, repeat=3, minimum_seconds=0.05):
+    """
+    Return the shortest time in seconds for one call of the given function, taken over repeat trials of enough calls
+    to last at least minimum_seconds.
+    """
+    function()  # Exclude one-time costs such as filling caches.
+    number = 1
+    while True:
+        start = time.time()
+        for n in xrange(number):
+            function()
+        elapsed = time.time() - start
+        if elapsed >= minimum_seconds:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for k in range(repeat - 1):
+        start = time.time()
+        for n in xrange(number):
+            function()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+
+def result(name, parameters, seconds, count, unit):
+    return {'benchmark': name, 'parameters': parameters, 'seconds': seconds, 'throughput': count / seconds,
+            'unit': unit + '/s'}
+
+
+def make_stream_demodulator(num_channels, nfft):
+    step = nfft // 2 // num_channels
+    fft_bins = np.arange(num_channels) * step + step // 2
+    tone_bins = fft_bins * (TONE_NSAMP // nfft) + np.arange(num_channels) % 7
+    phases = np.linspace(0, 2 * np.pi, num_channels, endpoint=False)
+    return demodulator.StreamDemodulator(tone_bins=tone_bins, phases=phases, tone_nsamp=TONE_NSAMP, fft_bins=fft_bins,
+                                         nfft=nfft, reference_sequence_number=0)
+
+
+def make_r2_packets(num_channels, nfft):
+    stream_demodulator = make_stream_demodulator(num_channels, nfft)
+    tone_frequency = np.linspace(100e6, 200e6, num_channels)
+    simulator = SystemSimulator(ResonatorModel(f_0=tone_frequency, noise=1e-3), stream_demodulator, tone_frequency,
+                                seed=0)
+    return stream_demodulator, simulator.packets(NUM_PACKETS)
+
+
+def benchmark_r2_decode(num_channels_list, nfft_list):
+    results = []
+    for nfft in nfft_list:
+        for num_channels in num_channels_list:
+            stream_demodulator, packets = make_r2_packets(num_channels, nfft)
+            plist = [''] + [packet.tostring() for packet in packets]  # decode_packets() discards the first packet
+            parameters = {'num_channels': num_channels, 'nfft': nfft}
+            count = packets.shape[0] * r2_stream_data.samples_per_packet
+            seconds = best_time(lambda: r2_udp_catcher.decode_packets(plist, num_channels, nfft // 2))
+            results.append(result('r2_udp_catcher.decode_packets', parameters, seconds, count, 'samples'))
+            seconds = best_time(lambda: r2_udp_catcher.decode_packet_buffer(packets, num_channels, nfft // 2))
+            results.append(result('r2_udp_catcher.decode_packet_buffer', parameters, seconds, count, 'samples'))
+            if have_decode and nfft == 2 ** 14:  # decode_packets_fast() assumes this nfft.
+                seconds = best_time(lambda: decode.decode_packets_fast(plist, num_channels))
+                results.append(result('decode.decode_packets_fast', parameters, seconds, count, 'samples'))
+    return results
+
+
+def benchmark_roach1_decode(num_channels_list, nfft_list):
+    results = []
+    for nfft in nfft_list:
+        for num_channels in num_channels_list:
+            packets = make_roach1_packets(NUM_PACKETS, num_channels, nfft, streamid=1, chan0=0, mcnt0=0)
+            chans = np.arange(num_channels)
+            seconds = best_time(lambda: udp_catcher.decode_packets(packets, 1, chans, nfft))
+            results.append(result('udp_catcher.decode_packets', {'num_channels': num_channels, 'nfft': nfft}, seconds,
+                                  packets.shape[0] * (udp_catcher.pkt_size - udp_catcher.hdr_size) // 4, 'samples'))
+    return results
+
+
+def benchmark_demodulation(num_channels_list, nfft_list):
+    results = []
+    for nfft in nfft_list:
+        for num_channels in num_channels_list:
+            stream_demodulator, packets = make_r2_packets(num_channels, nfft)
+            parameters = {'num_channels': num_channels, 'nfft': nfft}
+            count = packets.shape[0] * r2_stream_data.samples_per_packet
+            sequence_numbers = np.empty(packets.shape[0], dtype=np.uint32)
+            output = np.empty((packets.shape[0], r2_stream_data.samples_per_packet), dtype=np.complex64)
+            seconds = best_time(lambda: stream_demodulator.decode_and_demodulate_packet_buffer(packets,
+                                                                                              sequence_numbers, output))
+            results.append(result('StreamDemodulator.decode_and_demodulate_packet_buffer', parameters, seconds, count,
+                                  'samples'))
+            data = output.reshape((-1, num_channels))
+            demod = demodulator.Demodulator(nfft=nfft)
+
+            def demodulate_all():
+                for n in range(num_channels):
+                    demod.demodulate(data[:, n], tone_bin=stream_demodulator.tone_bins[n], tone_num_samples=TONE_NSAMP,
+                                     tone_phase=stream_demodulator.phases[n], fft_bin=stream_demodulator.fft_bins[n],
+                                     nchan=num_channels, seq_nos=sequence_numbers)
+
+            seconds = best_time(demodulate_all)
+            results.append(result('Demodulator.demodulate', parameters, seconds, count, 'samples'))
+    return results
+
+
+def benchmark_waveforms(num_channels_list, nsamp=TONE_NSAMP):
+    results = []
+    with TempDirectory() as directory:
+        for ri in [RoachBaseband(roach=MockRoach('roach'), adc_valon=MockValon(), initialize=False),
+                   RoachHeterodyne(roach=MockRoach('roach'), adc_valon=MockValon(), lo_valon=MockValon(),
+                                   initialize=False)]:
+            name = ri.__class__.__name__ + '.set_tone_bins'
+            for num_channels in num_channels_list:
+                bins = np.arange(1, num_channels + 1) * (nsamp // (4 * num_channels))
+                parameters = {'num_channels': num_channels, 'nsamp': nsamp}
+                ri.waveform_cache = None
+                seconds = best_time(lambda: ri.set_tone_bins(bins.copy(), nsamp, load=False))
+                results.append(result(name, dict(parameters, cached=False), seconds, nsamp, 'samples'))
+                ri.waveform_cache = waveform_cache.WaveformCache(directory.path)
+                ri.reproducible_phases = True
+                seconds = best_time(lambda: ri.set_tone_bins(bins.copy(), nsamp, load=False))
+                ri.reproducible_phases = False
+                results.append(result(name, dict(parameters, cached=True), seconds, nsamp, 'samples'))
+    return results
+
+
+def make_stream_array(num_channels, num_samples):
+    template = utilities.fake_stream_array(num_tones=1)
+    s21_raw = (np.random.standard_normal((num_channels, num_samples)) +
+               1j * np.random.standard_normal((num_channels, num_samples))).astype(np.complex64)
+    return basic.StreamArray(tone_bin=np.arange(num_channels), tone_amplitude=np.ones(num_channels),
+                             tone_phase=np.zeros(num_channels), tone_index=np.arange(num_channels),
+                             filterbank_bin=np.arange(num_channels), epoch=template.epoch,
+                             sequence_start_number=template.sequence_start_number, s21_raw=s21_raw,
+                             data_demodulated=True, roach_state=template.roach_state)
+
+
+# Each entry is (IO class, keyword arguments, parameters added to the results).
+IO_CONFIGURATIONS = [(npy.NumpyDirectory, {}, {}),
+                     (nc.NCFile, {}, {}),
+                     (nc.NCFile, {'compression': 1}, {'compression': 1})]
+
+
+def benchmark_writes(num_channels_list, total_samples=2 ** 21):
+    results = []
+    for io_class, kwargs, extra_parameters in IO_CONFIGURATIONS:
+        name = io_class.__name__ + '.write'
+        for num_channels in num_channels_list:
+            stream_array = make_stream_array(num_channels, total_samples // num_channels)
+            with TempDirectory() as directory:
+                paths = ('stream{}'.format(n) for n in xrange(sys.maxint))
+
+                def write():
+                    io = io_class(os.path.join(directory.path, next(paths)), **kwargs)
+                    io.write(stream_array, 'stream_array')
+                    io.close()
+
+                seconds = best_time(write)
+            parameters = dict(extra_parameters, num_channels=num_channels, num_samples=stream_array.s21_raw.shape[-1])
+            results.append(result(name, parameters, seconds, stream_array.s21_raw.nbytes, 'bytes'))
+    return results
+
+
+def benchmark_channel_reads(num_channels_list, total_samples=2 ** 21):
+    """
+    Measure the time to read s21_raw for one channel from a lazily-read StreamArray, as in single-channel analysis.
+    """
+    results = []
+    for io_class, kwargs, extra_parameters in IO_CONFIGURATIONS:
+        name = io_class.__name__ + '.read_channel'
+        for num_channels in num_channels_list:
+            stream_array = make_stream_array(num_channels, total_samples // num_channels)
+            # Quantize the data as if it came from integer ADC samples so that it compresses realistically.
+            stream_array.s21_raw[:] = np.round(2 ** 8 * stream_array.s21_raw) / 2 ** 8
+            with TempDirectory() as directory:
+                path = os.path.join(directory.path, 'stream')
+                io = io_class(path, **kwargs)
+                io.write(stream_array, 'stream_array')
+                io.close()
+                io = io_class(path, lazy=True)
+                s21_raw = io.read('stream_array').s21_raw
+                channel = num_channels // 2
+                seconds = best_time(lambda: np.array(s21_raw[channel]))
+                io.close()
+            parameters = dict(extra_parameters, num_channels=num_channels, num_samples=stream_array.s21_raw.shape[-1])
+            results.append(result(name, parameters, seconds, stream_array.s21_raw[channel].nbytes, 'bytes'))
+    return results
+
+
+def run(num_channels_list=NUM_CHANNELS, nfft_list=NFFT):
+    """
+    Run all of the benchmarks and return the results as a dict that can be appended to a history file.
+    """
+    results = (benchmark_r2_decode(num_channels_list, nfft_list) +
+               benchmark_roach1_decode(num_channels_list, nfft_list) +
+               benchmark_demodulation(num_channels_list, nfft_list) +
+               benchmark_waveforms(num_channels_list) +
+               benchmark_writes(num_channels_list) +
+               benchmark_channel_reads(num_channels_list))
+    return {'commit': get_commit(), 'epoch': time.time(), 'hostname': socket.gethostname(),
+            'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'results': results}
+
+
+def get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def append_to_history(filename, run_result):
+    history = load_history(filename)
+    history.append(run_result)
+    with open(filename, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+    return history
+
+
+def compare(previous, current, tolerance=0.2):
+    """
+    Return a list of (benchmark, parameters, previous throughput, current throughput) for each benchmark in both runs
+    whose throughput has dropped by more than the given fraction.
+    """
+
+    def key(r):
+        return r['benchmark'], json.dumps(r['parameters'], sort_keys=True)
+
+    previous_throughput = dict((key(r), r['throughput']) for r in previous['results'])
+    regressions = []
+    for r in current['results']:
+        before = previous_throughput.get(key(r))
+        if before is not None and r['throughput'] < (1 - tolerance) * before:
+            regressions.append((r['benchmark'], r['parameters'], before, r['throughput']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--history', default='benchmark_readout_history.json',
+                        help="The JSON file to which the results are appended.")
+    parser.add_argument('--quick', action='store_true', help="Run a reduced set of cases.")
+    parser.add_argument('--compare', action='store_true',
+                        help="Compare to the previous run in the history and exit with status 1 if any benchmark "
+                             "regressed.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="The fractional drop in throughput that counts as a regression.")
+    args = parser.parse_args(argv)
+    if args.quick:
+        run_result = run(QUICK_NUM_CHANNELS, QUICK_NFFT)
+    else:
+        run_result = run()
+    for r in run_result['results']:
+        print "{:55s} {:55s} {:12.4g} {}".format(r['benchmark'], json.dumps(r['parameters'], sort_keys=True),
+                                                 r['throughput'], r['unit'])
+    history = append_to_history(args.history, run_result)
+    if args.compare and len(history) > 1:
+        regressions = compare(history[-2], history[-1], tolerance=args.tolerance)
+        for benchmark, parameters, before, after in regressions:
+            print "Regression: {} {} {:.4g} -> {:.4g}".format(benchmark, json.dumps(parameters, sort_keys=True),
+                                                             before, after)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -52,6 +52,12 @@ class RoachMixin(object):
         self.ri.select_fft_bins(range(num_tones))
         _ = self.ri.get_measurement_blocks(2)
 
+    def test_single_precision(self):
+        num_tones = 4
+        self.ri.set_tone_baseband_freqs(np.linspace(100, 120, num_tones), nsamp=2 ** 16)
+        self.ri.select_fft_bins(range(num_tones))
+        assert self.ri.get_measurement_blocks(2).s21_raw.dtype == np.complex64
+
     def test_get_current_bank(self):
         assert self.ri.get_current_bank() is not None
 
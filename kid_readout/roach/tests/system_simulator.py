@@ -1,5 +1,225 @@
+"""
+This module simulates the UDP packet stream from a ROACH2 so that the capture, decoding, and demodulation code can be
+tested and benchmarked without hardware.
+
+The simulator does not synthesize the ADC samples and run them through a polyphase filterbank, which would be far slower
+than the hardware. Instead, it uses the same model of the filterbank as the StreamDemodulator: each readout channel
+contains the tone at its offset frequency, with the phase of the loaded waveform, scaled by the filterbank response at
+that offset. The tone is multiplied by the transmission of a resonator model, so demodulating the packets recovers the
+model transmission, up to quantization.
+
+Usage:
+  simulator = SystemSimulator(ResonatorModel(f_0=tone_frequency), stream_demodulator, tone_frequency)
+  process = simulator.start(('127.0.0.1', 55555), num_packets=2 ** 16, packets_per_second=10000)
+  ... capture and demodulate the packets, e.g. with r2_stream_data.ReadoutPipeline ...
+  process.join()
+"""
+import time
+import socket
+import logging
+import multiprocessing as mp
+from contextlib import closing
+
 import numpy as np
 
+from kid_readout.analysis.resonator import equations
+from kid_readout.roach import r2_stream_data
+
+logger = logging.getLogger(__name__)
+
+
+class ResonatorModel(object):
+    """
+    A linear resonator with loss, as in equations.linear_loss_resonator, plus white noise in the transmission and
+    Gaussian fluctuations of the resonance frequency.
+    """
+
+    def __init__(self, f_0, loss_i=1e-5, loss_c=1e-5, asymmetry=0, noise=0, frequency_noise=0):
+        """
+        Parameters
+        ----------
+        f_0 : float or ndarray(float)
+            The resonance frequency of the resonator in each channel, in the same units as the tone frequencies.
+        loss_i : float or ndarray(float)
+            The internal loss, 1 / Q_i.
+        loss_c : float or ndarray(float)
+            The coupling loss, 1 / Q_c.
+        asymmetry : float or ndarray(float)
+            The asymmetry parameter.
+        noise : float
+            The standard deviation of the real and imaginary parts of the white noise added to the transmission.
+        frequency_noise : float
+            The standard deviation of the fractional fluctuations of the resonance frequency, sampled independently for
+            each sample.
+        """
+        self.f_0 = f_0
+        self.loss_i = loss_i
+        self.loss_c = loss_c
+        self.asymmetry = asymmetry
+        self.noise = noise
+        self.frequency_noise = frequency_noise
+
+    def s21(self, frequency, num_samples, random_state=np.random):
+        """
+        Return the transmission at the given frequencies.
+
+        Parameters
+        ----------
+        frequency : ndarray(float)
+            The tone frequency in each channel.
+        num_samples : int
+            The number of samples per channel.
+        random_state : RandomState
+            The source of the noise.
+
+        Returns
+        -------
+        ndarray(complex)
+            The transmission, with shape (num_samples, num_channels).
+        """
+        f_0 = np.broadcast_to(self.f_0, np.shape(frequency)) * np.ones((num_samples, 1))
+        if self.frequency_noise:
+            f_0 = f_0 * (1 + self.frequency_noise * random_state.standard_normal(f_0.shape))
+        s21 = equations.linear_loss_resonator(frequency, f_0, self.loss_i, self.loss_c, self.asymmetry)
+        if self.noise:
+            s21 = s21 + self.noise * (random_state.standard_normal(s21.shape) +
+                                      1j * random_state.standard_normal(s21.shape))
+        return s21
+
+
 class SystemSimulator(object):
-    def __init__(self, model, input_loss, parent,):
-        pass
\ No newline at end of file
+    """
+    Generate the packets that a ROACH2 would send for the tones and channels of a StreamDemodulator, and send them to a
+    UDP address.
+
+    The packets are modulated relative to first_sequence_number, so they are demodulated correctly by a
+    StreamDemodulator with the same tones and channels whose reference_sequence_number is first_sequence_number. A
+    ReadoutPipeline sets this automatically if the first packet is not dropped.
+    """
+
+    def __init__(self, model, stream_demodulator, tone_frequency, amplitude=2 ** 13, input_loss=1,
+                 first_sequence_number=0, seed=None):
+        """
+        Parameters
+        ----------
+        model : ResonatorModel
+            The model for the transmission in each channel.
+        stream_demodulator : StreamDemodulator
+            The demodulator for the simulated channels, in readout order; it is not modified.
+        tone_frequency : ndarray(float)
+            The frequency of the tone in each channel, at which the model is evaluated.
+        amplitude : float
+            The demodulated amplitude, in ADC counts, of a channel with unit transmission.
+        input_loss : float
+            All transmissions are multiplied by this value.
+        first_sequence_number : int
+            The sequence number of the first packet.
+        seed : int or None
+            The seed for the noise and for the random packet drops and reordering.
+        """
+        self.model = model
+        self.stream_demodulator = stream_demodulator
+        self.tone_frequency = np.asarray(tone_frequency)
+        self.amplitude = amplitude
+        self.input_loss = input_loss
+        self.first_sequence_number = first_sequence_number
+        self.seed = seed
+        self.random_state = np.random.RandomState(seed)
+        self.num_channels = stream_demodulator.num_channels
+        self.samples_per_channel_per_packet = r2_stream_data.samples_per_packet // self.num_channels
+        self.sequence_number_increment = stream_demodulator.sequence_number_increment_per_packet
+        self.num_packets_generated = 0
+
+    def packets(self, num_packets):
+        """
+        Return the next num_packets packets, with consecutive sequence numbers.
+
+        Returns
+        -------
+        ndarray(uint8)
+            The packets, with shape (num_packets, r2_stream_data.pkt_size).
+        """
+        packet_number = self.num_packets_generated + np.arange(num_packets)
+        self.num_packets_generated += num_packets
+        s21 = self.model.s21(self.tone_frequency, num_packets * self.samples_per_channel_per_packet,
+                             random_state=self.random_state)
+        s21 = self.amplitude * self.input_loss * s21.reshape((num_packets, r2_stream_data.samples_per_packet))
+        # Invert the demodulation, which multiplies the data in each packet by a section of the lookup table.
+        lookup = self.stream_demodulator.demodulation_lookup
+        offset = (packet_number * r2_stream_data.samples_per_packet) % lookup.size
+        data = s21 / lookup[(offset[:, np.newaxis] + np.arange(r2_stream_data.samples_per_packet)) % lookup.size]
+        samples = np.empty((num_packets, 2 * r2_stream_data.samples_per_packet))
+        samples[:, 0::2] = data.real
+        samples[:, 1::2] = data.imag
+        packets = np.empty((num_packets, r2_stream_data.pkt_size), dtype=np.uint8)
+        packets[:, :-4] = np.clip(np.round(samples), -2 ** 15, 2 ** 15 - 1).astype('<i2').view(np.uint8)
+        sequence_number = ((self.first_sequence_number + self.sequence_number_increment * packet_number) %
+                           r2_stream_data.sequence_number_modulus)
+        packets[:, -4:] = sequence_number.astype('<u4').view(np.uint8).reshape((num_packets, 4))
+        return packets
+
+    def send(self, host_address, num_packets, packets_per_second=None, drop_probability=0, reorder_probability=0,
+             packets_per_chunk=2 ** 10):
+        """
+        Generate and send packets to the given address.
+
+        Parameters
+        ----------
+        host_address : tuple
+            The (address, port) to which the packets are sent.
+        num_packets : int
+            The number of packets to generate, including those that are dropped.
+        packets_per_second : float or None
+            The average packet rate; if None, send as fast as possible.
+        drop_probability : float
+            The probability that each packet is not sent.
+        reorder_probability : float
+            The probability that each packet is swapped with the following packet.
+        packets_per_chunk : int
+            The number of packets generated at a time.
+
+        Returns
+        -------
+        dict
+            The number of packets sent, dropped, and reordered, and the elapsed time in seconds.
+        """
+        stats = {'num_packets_sent': 0, 'num_packets_dropped': 0, 'num_packets_reordered': 0}
+        start = time.time()
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            while self.num_packets_generated < num_packets:
+                packets = self.packets(min(packets_per_chunk, num_packets - self.num_packets_generated))
+                order = np.arange(packets.shape[0])
+                if reorder_probability:
+                    for k in np.flatnonzero(self.random_state.random_sample(order.size - 1) < reorder_probability):
+                        if order[k] == k:  # Do not move a packet that has already been swapped.
+                            order[k], order[k + 1] = k + 1, k
+                            stats['num_packets_reordered'] += 2
+                if drop_probability:
+                    keep = self.random_state.random_sample(order.size) >= drop_probability
+                    stats['num_packets_dropped'] += order.size - keep.sum()
+                    order = order[keep]
+                for k in order:
+                    if packets_per_second:
+                        delay = start + stats['num_packets_sent'] / float(packets_per_second) - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                    s.sendto(packets[k].data, host_address)
+                    stats['num_packets_sent'] += 1
+        stats['elapsed'] = time.time() - start
+        logger.debug("Sent {num_packets_sent} packets in {elapsed:.3f} s".format(**stats))
+        return stats
+
+    def start(self, host_address, num_packets, **kwargs):
+        """
+        Send packets from a separate process, so that the process that receives them does not compete with the
+        simulator for the interpreter lock. The arguments are the same as for send().
+
+        Returns
+        -------
+        multiprocessing.Process
+            The started process.
+        """
+        process = mp.Process(target=self.send, args=(host_address, num_packets), kwargs=kwargs)
+        process.daemon = True
+        process.start()
+        return process
@@ -0,0 +1,31 @@
+import os
+import copy
+
+from testfixtures import TempDirectory
+
+from kid_readout.roach.tests import benchmark_readout
+
+
+def test_history():
+    results = benchmark_readout.benchmark_r2_decode(num_channels_list=[4], nfft_list=[2 ** 11])
+    assert set(r['benchmark'] for r in results) >= {'r2_udp_catcher.decode_packets',
+                                                    'r2_udp_catcher.decode_packet_buffer'}
+    assert all(r['throughput'] > 0 and r['parameters'] == {'num_channels': 4, 'nfft': 2 ** 11} for r in results)
+    first = {'commit': None, 'results': results}
+    second = copy.deepcopy(first)
+    second['results'][0]['throughput'] *= 0.5
+    second['results'][1]['throughput'] *= 0.9
+    with TempDirectory() as directory:
+        filename = os.path.join(directory.path, 'history.json')
+        benchmark_readout.append_to_history(filename, first)
+        history = benchmark_readout.append_to_history(filename, second)
+        assert benchmark_readout.load_history(filename) == history
+    assert len(history) == 2
+    regressions = benchmark_readout.compare(history[0], history[1], tolerance=0.2)
+    assert [regression[0] for regression in regressions] == [results[0]['benchmark']]
+
+
+def test_channel_reads():
+    results = benchmark_readout.benchmark_channel_reads(num_channels_list=[4], total_samples=2 ** 12)
+    assert len(results) == len(benchmark_readout.IO_CONFIGURATIONS)
+    assert all(r['throughput'] > 0 for r in results)
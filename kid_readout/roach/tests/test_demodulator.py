@@ -4,4 +4,80 @@ import kid_readout.roach.calculate
 from kid_readout.roach import demodulator
 
 def test_wave_period_zero():
-    assert(kid_readout.roach.calculate.get_offset_frequencies_period(np.zeros((1,))) == 1)
\ No newline at end of file
+    assert(kid_readout.roach.calculate.get_offset_frequencies_period(np.zeros((1,))) == 1)
+
+def test_demodulator_cache():
+    demodulator.clear_demodulator_cache()
+    first = demodulator.Demodulator(nfft=2 ** 11, num_taps=8)
+    second = demodulator.Demodulator(nfft=2 ** 11, num_taps=8)
+    assert second._window_response is first._window_response
+    assert demodulator.Demodulator(nfft=2 ** 11, num_taps=4)._window_response is not first._window_response
+    kwargs = dict(tone_bins=np.array([100, 200]), phases=np.array([0, 1.]), tone_nsamp=2 ** 16,
+                  fft_bins=np.array([0, 1]), nfft=2 ** 11, num_taps=8)
+    first = demodulator.StreamDemodulator(reference_sequence_number=1, **kwargs)
+    second = demodulator.StreamDemodulator(reference_sequence_number=2, **kwargs)
+    assert second.demodulation_lookup is first.demodulation_lookup
+    assert (first.reference_sequence_number, second.reference_sequence_number) == (1, 2)
+    kwargs['phases'] = np.array([0, 2.])
+    third = demodulator.StreamDemodulator(**kwargs)
+    assert not np.all(third.demodulation_lookup == first.demodulation_lookup)
+    demodulator.clear_demodulator_cache()
+    fourth = demodulator.StreamDemodulator(**kwargs)
+    assert fourth.demodulation_lookup is not third.demodulation_lookup
+    assert np.all(fourth.demodulation_lookup == third.demodulation_lookup)
+
+
+def _int16_data(shape):
+    # Raw data decoded from big-endian int16 pairs as in RoachInterface._read_data.
+    raw = np.random.randint(-2 ** 15, 2 ** 15, size=shape + (2,)).astype('>i2')
+    return raw.astype(np.float32).view(np.complex64)[..., 0]
+
+
+def test_demodulate_precision():
+    # Demodulating complex64 data should lose nothing beyond a small fraction of the int16 quantization step.
+    demod = demodulator.Demodulator(nfft=2 ** 11, num_taps=8, hardware_delay_samples=10)
+    data = _int16_data((2 ** 14,))
+    kwargs = dict(tone_bin=1234, tone_num_samples=2 ** 16, tone_phase=0.5, fft_bin=37, nchan=4,
+                  seq_nos=np.arange(10, 20))
+    single = demod.demodulate(data, **kwargs)
+    double = demod.demodulate(data.astype(np.complex128), **kwargs)
+    assert single.dtype == np.complex64 and double.dtype == np.complex128
+    step = np.abs(double / data.astype(np.complex128)).max()
+    assert np.abs(single - double).max() < 0.01 * step
+
+
+def _double_precision_waveform(stream_demod, num_samples, first_sequence_number):
+    # The demodulation waveform computed in the test, in double precision, as a reference for the StreamDemodulator.
+    pphase = np.exp(1j * demodulator.packet_phase(first_sequence_number, stream_demod.offset_frequencies,
+                                                  stream_demod.num_channels,
+                                                  stream_demod.tone_nsamp // stream_demod.nfft, stream_demod.nfft))
+    hardware_delay = -stream_demod.hardware_delay_samples * stream_demod.tone_bins / float(stream_demod.tone_nsamp)
+    t = np.arange(num_samples)
+    return (stream_demod.pfb_response_correction *
+            np.exp(-1j * (2 * np.pi * (np.outer(t, stream_demod.offset_frequencies) + hardware_delay) +
+                          stream_demod.phases)) * pphase)
+
+
+def test_stream_demodulator_precision():
+    # Demodulating with the complex64 waveforms should lose nothing beyond a small fraction of the int16 quantization
+    # step, compared to a waveform that is never rounded to single precision.
+    stream_demod = demodulator.StreamDemodulator(tone_bins=np.array([100, 2001, 3002, 4003]),
+                                                 phases=np.array([0, 1., 2., 3.]), tone_nsamp=2 ** 16,
+                                                 fft_bins=np.array([3, 62, 93, 125]), nfft=2 ** 11, num_taps=8,
+                                                 hardware_delay_samples=10)
+    assert stream_demod.demodulation_lookup.dtype == np.complex64
+    data = _int16_data((1024, 4))
+    sequence_numbers = np.arange(4) * stream_demod.sequence_number_increment_per_packet
+    wave = _double_precision_waveform(stream_demod, data.shape[0], sequence_numbers[0])
+    assert wave.dtype == np.complex128
+    double = wave * data.astype(np.complex128)
+    step = np.abs(wave).max()
+    single = stream_demod.demodulate_stream(data, sequence_numbers)
+    assert single.dtype == np.complex64
+    assert np.abs(single - double).max() < 0.01 * step
+    # The lookup table used to demodulate packets starts at sequence number zero.
+    lookup = stream_demod.demodulation_lookup
+    reference = _double_precision_waveform(stream_demod, lookup.size // stream_demod.num_channels, 0).reshape(-1)
+    lookup_data = _int16_data((lookup.size,))
+    assert (np.abs(lookup * lookup_data - reference * lookup_data.astype(np.complex128)).max() <
+            0.01 * np.abs(reference).max())
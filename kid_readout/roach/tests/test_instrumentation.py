@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.measurement.io import nc, npy
+from kid_readout.roach import instrumentation
+from kid_readout.roach.baseband import RoachBaseband
+from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.tests.mock_roach import MockRoach
+from kid_readout.roach.tests.mock_valon import MockValon
+
+
+def test_performance_stats():
+    stats = instrumentation.PerformanceStats(max_recent_calls=2)
+    with stats.span('disabled'):
+        stats.increment('disabled')
+    assert stats.summary() == {'spans': {}, 'counters': {}}
+    stats.enabled = True
+    for k in range(3):
+        with stats.span('outer'):
+            with stats.span('outer'):  # A nested span with the same name is not recorded separately.
+                with stats.span('inner'):
+                    stats.increment('counter', 2)
+    summary = stats.summary(include_recent_calls=True)
+    assert summary['spans']['outer']['count'] == 3
+    assert summary['spans']['inner']['count'] == 3
+    assert summary['spans']['outer']['total_seconds'] >= summary['spans']['inner']['total_seconds']
+    assert summary['counters'] == {'counter': 6}
+    assert len(summary['recent_calls']) == 2
+    stats.reset()
+    assert stats.summary() == {'spans': {}, 'counters': {}}
+
+
+def test_span_exception():
+    stats = instrumentation.PerformanceStats(enabled=True)
+    try:
+        with stats.span('failure'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert stats.summary()['spans']['failure']['count'] == 1
+    with stats.span('failure'):
+        pass
+    assert stats.summary()['spans']['failure']['count'] == 2
+
+
+def _acquire(ri):
+    ri.set_tone_baseband_freqs(np.linspace(100, 120, 4), nsamp=2 ** 16)
+    ri.select_fft_bins(range(4))
+    return ri.get_measurement(num_seconds=0.1)
+
+
+def test_disabled():
+    ri = RoachBaseband(roach=MockRoach('roach'), adc_valon=MockValon(), initialize=False)
+    stream_array = _acquire(ri)
+    assert ri.perf_stats() == {'spans': {}, 'counters': {}}
+    assert 'perf_stats' not in stream_array.roach_state
+
+
+def test_roach_state():
+    for ri in [RoachBaseband(roach=MockRoach('roach'), adc_valon=MockValon(), initialize=False),
+               RoachHeterodyne(roach=MockRoach('roach'), adc_valon=MockValon(), lo_valon=MockValon(),
+                               initialize=False)]:
+        ri.enable_perf_stats(record_in_roach_state=True)
+        stream_array = _acquire(ri)
+        spans = stream_array.roach_state['perf_stats']['spans']
+        for name in ['set_tone_bins', 'load_dram', 'get_data']:
+            assert spans[name]['count'] == 1, name
+        assert spans['select_fft_bins']['count'] == 2  # It is also called by set_tone_baseband_freqs().
+        # The summary is recorded before get_measurement_blocks returns, so that span is not yet complete.
+        assert 'get_measurement_blocks' not in spans
+        assert ri.perf_stats()['spans']['get_measurement_blocks']['count'] == 1
+        ri.disable_perf_stats()
+        assert 'perf_stats' not in _acquire(ri).roach_state
+        with TempDirectory() as directory:
+            for io in [npy.NumpyDirectory(directory.path), nc.NCFile(os.path.join(directory.path, 'test.nc'))]:
+                io.write(stream_array, 'stream_array')
+                assert io.read('stream_array') == stream_array
+                io.close()
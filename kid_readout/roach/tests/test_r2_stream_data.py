@@ -0,0 +1,77 @@
+import socket
+import time
+from contextlib import closing
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.roach import demodulator, r2_stream_data
+from kid_readout.measurement.io import npy
+from kid_readout.measurement.test import utilities
+
+
+def make_packets(num_packets, num_channels, sequence_number_increment, first_sequence_number):
+    samples = np.random.randint(-2 ** 15, 2 ** 15, size=(num_packets, 2 * r2_stream_data.samples_per_packet))
+    packets = np.empty((num_packets, r2_stream_data.pkt_size), dtype=np.uint8)
+    packets[:, :-4] = samples.astype('<i2').view(np.uint8)
+    sequence_numbers = (first_sequence_number +
+                        sequence_number_increment * np.arange(num_packets)) % r2_stream_data.sequence_number_modulus
+    packets[:, -4:] = sequence_numbers.astype('<u4').view(np.uint8).reshape((num_packets, 4))
+    return packets
+
+
+def test_fill_dropped_packets():
+    increment = 16
+    data = np.arange(4, dtype=np.complex64)[:, np.newaxis] * np.ones((1, 8))
+    sequence_numbers = np.array([2 ** 32 - 16, 0, 32, 32], dtype=np.uint32)  # wraps, then skips one, then repeats
+    filled, num_dropped = r2_stream_data.fill_dropped_packets(data, sequence_numbers, 2 ** 32 - 32, increment)
+    assert filled.shape == (4, 8)
+    assert num_dropped == 1
+    assert np.all(filled[0] == 0) and np.all(filled[1] == 1) and np.all(np.isnan(filled[2])) and np.all(filled[3] == 3)
+    contiguous = np.array([2 ** 32 - 16, 0, 16, 32], dtype=np.uint32)
+    filled, num_dropped = r2_stream_data.fill_dropped_packets(data, contiguous, 2 ** 32 - 32, increment)
+    assert filled is data and num_dropped == 0
+
+
+def test_readout_pipeline():
+    num_channels = 4
+    stream_demodulator = demodulator.StreamDemodulator(tone_bins=np.array([100, 200, 300, 400]),
+                                                       phases=np.zeros(num_channels), tone_nsamp=2 ** 16,
+                                                       fft_bins=np.array([0, 1, 2, 3]), reference_sequence_number=None)
+    increment = stream_demodulator.sequence_number_increment_per_packet
+    packets = make_packets(20, num_channels, increment, first_sequence_number=2 ** 32 - 5 * increment)
+    sent = np.delete(np.arange(packets.shape[0]), [7, 8])
+    stream_array = utilities.fake_stream_array(num_tones=num_channels)
+    stream_array_kwargs = dict(tone_bin=stream_array.tone_bin, tone_amplitude=stream_array.tone_amplitude,
+                               tone_phase=stream_array.tone_phase, tone_index=stream_array.tone_index,
+                               filterbank_bin=stream_array.filterbank_bin, data_demodulated=True,
+                               roach_state=stream_array.roach_state)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.bind(('127.0.0.1', 0))
+        host_address = s.getsockname()
+    with TempDirectory() as directory:
+        pipeline = r2_stream_data.ReadoutPipeline(stream_demodulator=stream_demodulator, io_class=npy.NumpyDirectory,
+                                                  root_path=directory.path, node_path='stream',
+                                                  stream_array_kwargs=stream_array_kwargs, num_data_buffers=2,
+                                                  num_packets_per_buffer=4, host_address=host_address)
+        pipeline.wait_until_ready()
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            for k in sent:
+                s.sendto(packets[k].tobytes(), host_address)
+                time.sleep(0.001)
+        time.sleep(0.5)
+        stats = pipeline.close()
+        assert stats['num_packets_captured'] == sent.size
+        assert stats['num_packets_dropped'] == 2
+        result = npy.NumpyDirectory(directory.path).read('stream')
+        assert result.sequence_start_number == 2 ** 32 - 5 * increment
+        assert result.roach_state.reference_sequence_number == 2 ** 32 - 5 * increment
+
+        stream_demodulator.reference_sequence_number = result.roach_state.reference_sequence_number
+        expected = np.empty((packets.shape[0], r2_stream_data.samples_per_packet), dtype=np.complex64)
+        stream_demodulator.decode_and_demodulate_packet_buffer(packets, np.empty(packets.shape[0], dtype=np.uint32),
+                                                               expected, assume_not_contiguous=True)
+        expected[[7, 8]] = np.nan
+        expected = expected.reshape((-1, num_channels)).T
+        assert result.s21_raw.shape == expected.shape
+        assert np.allclose(result.s21_raw, expected, equal_nan=True)
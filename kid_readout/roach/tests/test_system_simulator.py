@@ -0,0 +1,63 @@
+import socket
+from contextlib import closing
+
+import numpy as np
+
+from kid_readout.roach import demodulator, r2_stream_data, udp_catcher
+from kid_readout.roach.tests.system_simulator import ResonatorModel, SystemSimulator
+
+
+def make_simulator(num_channels=8, **kwargs):
+    stream_demodulator = demodulator.StreamDemodulator(tone_bins=np.arange(1, num_channels + 1) * 2 ** 10 + 3,
+                                                       phases=np.linspace(0, 2 * np.pi, num_channels, endpoint=False),
+                                                       tone_nsamp=2 ** 16,
+                                                       fft_bins=np.arange(1, num_channels + 1) * 256,
+                                                       reference_sequence_number=2 ** 32 - 1000)
+    tone_frequency = np.linspace(100e6, 200e6, num_channels)
+    model = ResonatorModel(f_0=tone_frequency * (1 + np.linspace(-2e-5, 2e-5, num_channels)))
+    return SystemSimulator(model, stream_demodulator, tone_frequency, input_loss=0.5,
+                           first_sequence_number=2 ** 32 - 1000, seed=0, **kwargs)
+
+
+def test_packets():
+    simulator = make_simulator()
+    stream_demodulator = simulator.stream_demodulator
+    num_packets = 20
+    packets = np.vstack((simulator.packets(7), simulator.packets(num_packets - 7)))
+    sequence_numbers = np.empty(num_packets, dtype=np.uint32)
+    demodulated = np.empty((num_packets, r2_stream_data.samples_per_packet), dtype=np.complex64)
+    stream_demodulator.decode_and_demodulate_packet_buffer(packets, sequence_numbers, demodulated)
+    assert np.all(np.diff(sequence_numbers.astype(np.int64)) % 2 ** 32 ==
+                  stream_demodulator.sequence_number_increment_per_packet)
+    s21 = demodulated.reshape((-1, simulator.num_channels)) / (simulator.amplitude * simulator.input_loss)
+    expected = simulator.model.s21(simulator.tone_frequency, 1)
+    assert np.allclose(s21, expected, atol=1e-3)
+
+
+def test_send():
+    simulator = make_simulator()
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.bind(('127.0.0.1', 0))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 22)
+        process = simulator.start(s.getsockname(), num_packets=200, packets_per_second=20000)
+        s.settimeout(2)
+        packet_buffer = np.empty((200, r2_stream_data.pkt_size), dtype=np.uint8)
+        num_received, num_bad, timed_out = udp_catcher.recv_packets_into(s, packet_buffer)
+        process.join()
+    assert num_received == 200 and num_bad == 0
+    assert np.all(packet_buffer == simulator.packets(200))
+
+    simulator = make_simulator()
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.bind(('127.0.0.1', 0))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 22)
+        stats = simulator.send(s.getsockname(), num_packets=200, drop_probability=0.1, reorder_probability=0.1)
+        s.settimeout(0.5)
+        num_received, num_bad, timed_out = udp_catcher.recv_packets_into(s, packet_buffer)
+    assert stats['num_packets_sent'] == num_received == 200 - stats['num_packets_dropped']
+    assert stats['num_packets_dropped'] > 0 and stats['num_packets_reordered'] > 0
+    sequence_numbers = packet_buffer[:num_received].view('<u4')[:, -1].astype(np.int64)
+    packet_numbers = ((sequence_numbers - simulator.first_sequence_number) % 2 ** 32 //
+                      simulator.sequence_number_increment)
+    assert np.any(np.diff(packet_numbers) < 0)
+    assert np.all(np.sort(packet_numbers) == np.unique(packet_numbers))
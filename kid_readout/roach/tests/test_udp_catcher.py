@@ -0,0 +1,164 @@
+import socket
+import threading
+import time
+from contextlib import closing
+
+import numpy as np
+
+from kid_readout.roach import r2_udp_catcher, udp_catcher
+from kid_readout.roach.tests.test_r2_stream_data import make_packets
+
+
+def test_recv_packets_into():
+    packets = make_packets(8, 4, 2 ** 13, 0)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as receiver, \
+            closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sender:
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(0.5)
+        address = receiver.getsockname()
+        for k, packet in enumerate(packets):
+            sender.sendto(packet.tobytes(), address)
+            if k == 2:
+                sender.sendto(packet[:100].tobytes(), address)
+        packet_buffer = np.zeros((6, r2_udp_catcher.packet_size), dtype=np.uint8)
+        num_packets, num_bad, timed_out = udp_catcher.recv_packets_into(receiver, packet_buffer[:1])
+        assert (num_packets, num_bad, timed_out) == (1, 0, False)
+        num_packets, num_bad, timed_out = udp_catcher.recv_packets_into(receiver, packet_buffer, start=num_packets)
+        assert (num_packets, num_bad, timed_out) == (6, 1, False)
+        assert np.all(packet_buffer == packets[:6])
+        num_packets, num_bad, timed_out = udp_catcher.recv_packets_into(receiver, np.zeros_like(packet_buffer))
+        assert (num_packets, num_bad, timed_out) == (2, 0, True)
+
+
+def test_decode_packet_buffer():
+    nchans = 16
+    clocks_per_filterbank_frame = 2 ** 13
+    step = clocks_per_filterbank_frame * r2_udp_catcher.chns_per_pkt // nchans
+    packets = make_packets(10, nchans, step, 2 ** 32 - 3 * step)
+    packets = packets[[0, 1, 2, 3, 5, 6, 7, 8]]  # drop one packet
+    plist = [''] + [packet.tobytes() for packet in packets]  # decode_packets() discards the first packet
+    expected = r2_udp_catcher.decode_packets(plist, nchans, clocks_per_filterbank_frame)
+    result = r2_udp_catcher.decode_packet_buffer(packets, nchans, clocks_per_filterbank_frame)
+    assert np.array_equal(np.isnan(expected[0]), np.isnan(result[0]))
+    assert np.all(expected[0][~np.isnan(expected[0])] == result[0][~np.isnan(result[0])])
+    assert np.all(expected[1] == result[1])
+    assert result[2:] == (0, 1)  # the last packet does not fit and one is missing
+
+
+def make_roach1_packets(num_packets, nchan, nfft, streamid, chan0, mcnt0, pkts_per_chunk=16):
+    mcnt_inc = nfft * 2 ** 12 // nchan
+    header = np.zeros(num_packets, dtype=udp_catcher.ptype)
+    k = np.arange(num_packets)
+    header['idx'] = k % pkts_per_chunk
+    header['stream'] = streamid
+    header['chan'] = chan0
+    header['mcntr'] = ((mcnt0 + (k // pkts_per_chunk) * mcnt_inc) % 2 ** 32).astype(np.uint32).view(np.int32)
+    payload = np.random.randint(-2 ** 15, 2 ** 15, size=(num_packets, 512)).astype('>i2')
+    return np.concatenate((header.view(np.uint8).reshape((num_packets, udp_catcher.hdr_size)),
+                           payload.view(np.uint8)), axis=1)
+
+
+def test_decode_packets_roach1():
+    nfft = 2 ** 9
+    chans = np.arange(4) + 1
+    mcnt_inc = nfft * 2 ** 12 // chans.size
+    packets = make_roach1_packets(200, chans.size, nfft, streamid=7, chan0=1, mcnt0=2 ** 32 - 3 * mcnt_inc)
+    data, seqnos = udp_catcher.decode_packets(packets, 7, chans, nfft)
+    samples_per_packet = 256
+    assert data.shape == (200 * samples_per_packet // chans.size, chans.size)
+    assert np.all(np.diff(seqnos) == 1)  # the mcnt overflow is unwrapped
+    assert not np.any(np.isnan(data))
+    # Drop packet 50, repeat packet 10 after packet 20, and add a packet from another stream.
+    other = make_roach1_packets(1, chans.size, nfft, streamid=8, chan0=1, mcnt0=0)
+    order = np.concatenate((np.arange(21), [10], np.arange(21, 50), np.arange(51, 200)))
+    damaged = np.concatenate((packets[order], other))
+    plist = [packet.tostring() for packet in damaged] + ['short']
+    damaged_data, damaged_seqnos = udp_catcher.decode_packets(plist, 7, chans, nfft)
+    assert damaged_data.shape == data.shape
+    assert damaged_seqnos.size == order.size
+    rows_per_packet = samples_per_packet // chans.size
+    missing = np.zeros(data.shape[0], dtype=bool)
+    missing[50 * rows_per_packet:51 * rows_per_packet] = True
+    assert np.all(np.isnan(damaged_data[missing]))
+    assert np.all(damaged_data[~missing] == data[~missing])
+
+
+def test_find_sync():
+    step = 2 ** 10
+    before = make_packets(40, 16, step, 2 ** 32 - 2 * step)  # wraps, which is not a sync
+    after = make_packets(6, 16, step, 100)
+    sequence_numbers = lambda packets: packets[:, -4:].copy().view('<u4')[:, 0]
+    assert r2_udp_catcher.find_sync(sequence_numbers(before), step) == 0
+    reordered = after[[0, 2, 1, 3, 4, 5]]
+    assert r2_udp_catcher.find_sync(sequence_numbers(reordered), step) == 0
+    packet_buffer = np.vstack((before, after))
+    assert r2_udp_catcher.find_sync(sequence_numbers(packet_buffer), step) == before.shape[0]
+    num_packets = r2_udp_catcher.discard_packets_before_sync(packet_buffer, packet_buffer.shape[0] - 1, step)
+    assert num_packets == after.shape[0] - 1
+    assert np.all(packet_buffer[:num_packets] == after[:-1])
+
+
+def test_keep_packets_after_sync():
+    step = 2 ** 10
+    max_sequence_number = 8 * step
+    before = make_packets(4, 16, step, 2 ** 20)
+    after = make_packets(4, 16, step, 0)
+    # A capture that contains only packets sent before the sync keeps only the last one.
+    packet_buffer = before.copy()
+    num_packets, synced = r2_udp_catcher.keep_packets_after_sync(packet_buffer, 4, step, max_sequence_number)
+    assert (num_packets, synced) == (1, False)
+    assert np.all(packet_buffer[0] == before[-1])
+    # A restart between that packet and the next ones confirms the sync.
+    packet_buffer[1:] = after[:3]
+    num_packets, synced = r2_udp_catcher.keep_packets_after_sync(packet_buffer, 4, step, max_sequence_number)
+    assert (num_packets, synced) == (3, True)
+    assert np.all(packet_buffer[:3] == after[:3])
+    # So does a small first sequence number.
+    packet_buffer = after.copy()
+    num_packets, synced = r2_udp_catcher.keep_packets_after_sync(packet_buffer, 4, step, max_sequence_number)
+    assert (num_packets, synced) == (4, True)
+
+
+class _FakeFPGA(object):
+
+    def __init__(self, address, bursts):
+        self.address = address
+        self.bursts = bursts
+        self.sender = None
+
+    def write_int(self, name, value):
+        if name == 'txrst' and value == 0 and self.sender is None:
+            self.sender = threading.Thread(target=self.send)
+            self.sender.start()
+
+    def send(self):
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sender:
+            for delay, packets in self.bursts:
+                time.sleep(delay)
+                for packet in packets:
+                    sender.sendto(packet.tobytes(), self.address)
+
+
+class _FakeRoach(object):
+
+    def __init__(self, address, bursts):
+        self.r = _FakeFPGA(address, bursts)
+        self.blocks_per_second = 100
+
+
+def test_get_udp_packet_buffer_without_observed_sync():
+    step = 2 ** 10
+    # Every packet in the first burst was sent before the sync and no restart is observed, so the capture must wait
+    # for the timeout and return only packets received after it.
+    before = make_packets(8, 16, step, 2 ** 20)
+    later = make_packets(8, 16, step, 2 ** 20 + 8 * step)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as probe:
+        probe.bind(('127.0.0.1', 0))
+        address = probe.getsockname()
+    ri = _FakeRoach(address, [(0.05, before), (0.3, later)])
+    packet_buffer = r2_udp_catcher.get_udp_packet_buffer(ri, 4, addr=address, sync_increment=step, sync_timeout=0.1)
+    ri.r.sender.join()
+    assert packet_buffer.shape[0] == 4
+    first = np.flatnonzero(np.all(later == packet_buffer[0], axis=1))
+    assert first.size == 1
+    assert np.all(packet_buffer == later[first[0]:first[0] + 4])
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+from testfixtures import TempDirectory
+
+from kid_readout.roach import waveform_cache
+from kid_readout.roach.baseband import RoachBaseband
+from kid_readout.roach.heterodyne import RoachHeterodyne
+from kid_readout.roach.tests.mock_roach import MockRoach
+from kid_readout.roach.tests.mock_valon import MockValon
+
+
+def test_waveform_cache():
+    with TempDirectory() as directory:
+        cache = waveform_cache.WaveformCache(os.path.join(directory.path, 'cache'), max_bytes=3000)
+        assert cache.get('a') is None
+        waveform = np.arange(500, dtype='>i2')
+        cached = cache.put('a', waveform)
+        assert isinstance(cached, np.memmap) and not cached.flags.writeable
+        assert np.all(cached == waveform) and cached.dtype == waveform.dtype
+        assert np.all(cache.get('a') == waveform)
+        os.utime(cache.path('a'), (0, 0))
+        cache.put('b', waveform)
+        cache.put('c', waveform)  # The total size now exceeds max_bytes, so the oldest file is removed.
+        assert cache.get('a') is None
+        assert cache.get('b') is not None and cache.get('c') is not None
+        with open(cache.path('b'), 'w') as f:
+            f.write('not a waveform')
+        assert cache.get('b') is None and not os.path.exists(cache.path('b'))
+        cache.clear()
+        assert cache.get('c') is None
+
+
+def test_waveform_key():
+    bins = np.array([[1, 2, 3]])
+    phases = np.array([0.1, 0.2, 0.3])
+    key = waveform_cache.waveform_key('baseband', bins, 2 ** 10, 1.0, phases, None, 1.5)
+    assert key == waveform_cache.waveform_key('baseband', bins.copy(), 2 ** 10, 1.0, phases.copy(), None, 1.5)
+    assert key != waveform_cache.waveform_key('baseband', bins, 2 ** 11, 1.0, phases, None, 1.5)
+    assert key != waveform_cache.waveform_key('baseband', bins, 2 ** 10, 1.0, phases, None, 1.6)
+    assert key != waveform_cache.waveform_key('baseband', bins + 1, 2 ** 10, 1.0, phases, None, 1.5)
+    assert key != waveform_cache.waveform_key('heterodyne', bins, 2 ** 10, 1.0, phases, 0, 1.5)
+    assert np.all(waveform_cache.reproducible_phases(bins, 2 ** 10) ==
+                  waveform_cache.reproducible_phases(bins.copy(), 2 ** 10))
+    assert np.any(waveform_cache.reproducible_phases(bins, 2 ** 10) !=
+                  waveform_cache.reproducible_phases(bins + 1, 2 ** 10))
+
+
+def check_cached_waveforms(ri, attributes):
+    bins = np.array([[10, 200, 3000], [11, 201, 3001]])
+    phases = np.array([0.1, 2, 4])
+    nsamp = 2 ** 14
+    with TempDirectory() as directory:
+        ri.waveform_cache = None
+        ri.set_tone_bins(bins.copy(), nsamp, phases=phases)
+        expected = [getattr(ri, attribute).copy() for attribute in attributes]
+        ri.waveform_cache = waveform_cache.WaveformCache(directory.path)
+        for k in range(2):
+            ri.set_tone_bins(bins.copy(), nsamp, phases=phases)
+            for attribute, waveform in zip(attributes, expected):
+                assert isinstance(getattr(ri, attribute), np.memmap)
+                assert np.all(getattr(ri, attribute) == waveform)
+        assert len(os.listdir(directory.path)) == 1
+        # By default, reloading the same bins without phases chooses new random phases, which are not cached.
+        ri.set_tone_bins(bins.copy(), nsamp)
+        first_phases = ri.phases
+        ri.set_tone_bins(bins.copy(), nsamp)
+        assert np.all(ri.phases != first_phases)
+        assert len(os.listdir(directory.path)) == 1
+        ri.reproducible_phases = True
+        ri.set_tone_bins(bins.copy(), nsamp)
+        first_phases = ri.phases
+        ri.set_tone_bins(bins.copy(), nsamp)
+        assert np.all(ri.phases == first_phases)
+        assert len(os.listdir(directory.path)) == 2
+        # A user-provided normalization is never cached.
+        ri.set_tone_bins(bins.copy(), nsamp, phases=phases, normfact=1.)
+        assert len(os.listdir(directory.path)) == 2
+
+
+def test_baseband_cached_waveform():
+    ri = RoachBaseband(roach=MockRoach('roach'), adc_valon=MockValon(), initialize=False)
+    check_cached_waveforms(ri, ['qwave'])
+
+
+def test_heterodyne_cached_waveforms():
+    ri = RoachHeterodyne(roach=MockRoach('roach'), adc_valon=MockValon(), lo_valon=MockValon(), initialize=False)
+    ri.iq_delay = 1
+    check_cached_waveforms(ri, ['q_rwave', 'q_iwave'])
+
+
+def test_default_cache_setting():
+    original = waveform_cache.settings.WAVEFORM_CACHE_DIR
+    with TempDirectory() as directory:
+        try:
+            waveform_cache.settings.WAVEFORM_CACHE_DIR = None
+            assert waveform_cache.get_default_cache() is None
+            waveform_cache.settings.WAVEFORM_CACHE_DIR = directory.path
+            assert waveform_cache.get_default_cache().directory == directory.path
+        finally:
+            waveform_cache.settings.WAVEFORM_CACHE_DIR = original
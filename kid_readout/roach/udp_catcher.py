@@ -7,23 +7,20 @@ import cPickle
 
 import numpy as np
 
+from kid_readout.roach import instrumentation
+
 # TODO: verify that the log levels are correct here.
 logger = logging.getLogger(__name__)
 
+# On Linux, this flag makes recv_into() return the full size of a packet that is too large for the buffer.
+_msg_trunc = getattr(socket, 'MSG_TRUNC', 0)
+
 
 def get_udp_packets(ri, npkts, streamid, stream_reg='streamid', addr=('192.168.1.1', 12345)):
     ri.r.write_int(stream_reg, 0)
     with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
         s.bind(addr)
-        s.settimeout(0)
-        nstale = 0
-        try:
-            while s.recv(2000):
-                nstale += 1
-            if nstale:
-                logger.info("Flushed {} packets.".format(nstale))
-        except socket.error:
-            pass
+        flush_socket(s)
         s.settimeout(1)
         ri.r.write_int(stream_reg, streamid)
         pkts = []
@@ -38,9 +35,92 @@ def get_udp_packets(ri, npkts, streamid, stream_reg='streamid', addr=('192.168.1
     return pkts
 
 
+def get_udp_packet_buffer(ri, npkts, streamid, stream_reg='streamid', addr=('192.168.1.1', 12345),
+                          packet_buffer=None):
+    """
+    Capture npkts packets directly into the rows of a uint8 array with shape (npkts, pkt_size) and return the rows
+    that were filled. If packet_buffer is given, it must be a C-contiguous array with this shape, and it is reused.
+    """
+    if packet_buffer is None:
+        packet_buffer = np.empty((npkts, pkt_size), dtype=np.uint8)
+    ri.r.write_int(stream_reg, 0)
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.bind(addr)
+        flush_socket(s)
+        s.settimeout(1)
+        ri.r.write_int(stream_reg, streamid)
+        num_packets, num_bad, timed_out = recv_packets_into(s, packet_buffer)
+        ri.r.write_int(stream_reg, 0)
+    if num_bad:
+        logger.warning("Discarded {} packets with size not equal to {}.".format(num_bad, pkt_size))
+    if timed_out:
+        logger.warning("Did not receive UDP data.")
+    return packet_buffer[:num_packets]
+
+
+def flush_socket(s, bufsize=5000):
+    """
+    Discard any stale packets waiting in the receive buffer of socket s.
+    """
+    s.settimeout(0)
+    nstale = 0
+    try:
+        while s.recv(bufsize):
+            nstale += 1
+    except socket.error:
+        pass
+    if nstale:
+        logger.info("Flushed {} packets.".format(nstale))
+
+
+def recv_packets_into(s, packet_buffer, start=0):
+    """
+    Receive packets from socket s directly into the rows of packet_buffer, starting at row start, until the buffer is
+    full or the socket times out. Each packet is written into the array without creating an intermediate string.
+    A packet with size different from the row size is counted as bad and overwritten by the next packet.
+
+    Parameters
+    ----------
+    s : socket.socket
+        A bound UDP socket.
+    packet_buffer : numpy.ndarray
+        A C-contiguous uint8 array with shape (num_packets, packet_size).
+    start : int
+        The first row to fill.
+
+    Returns
+    -------
+    int
+        The number of filled rows, including those before start.
+    int
+        The number of packets with the wrong size.
+    bool
+        True if the socket timed out before the buffer was full.
+    """
+    num_packets, packet_size = packet_buffer.shape
+    view = memoryview(packet_buffer.reshape(-1))
+    recv_into = s.recv_into
+    n = start
+    num_bad = 0
+    try:
+        while n < num_packets:
+            offset = n * packet_size
+            if recv_into(view[offset:offset + packet_size], packet_size, _msg_trunc) == packet_size:
+                n += 1
+            else:
+                num_bad += 1
+    except socket.timeout:
+        return n, num_bad, True
+    return n, num_bad, False
+
+
 def get_udp_data(ri, npkts, streamid, chans, nfft, stream_reg='streamid', addr=('192.168.1.1', 12345)):
-    pkts = get_udp_packets(ri, npkts, streamid, stream_reg=stream_reg, addr=addr)
-    darray, seqnos = decode_packets(pkts, streamid, chans, nfft)
+    stats = instrumentation.get_stats(ri)
+    with stats.span('capture'):
+        packet_buffer = get_udp_packet_buffer(ri, npkts, streamid, stream_reg=stream_reg, addr=addr)
+    with stats.span('decode'):
+        darray, seqnos = decode_packets(packet_buffer, streamid, chans, nfft)
+    stats.increment('packets_captured', packet_buffer.shape[0])
     return darray, seqnos
 
 
@@ -53,85 +133,102 @@ ptype = np.dtype([('idle', '>i2'),
 hdr_fmt = ">4HI"
 hdr_size = struct.calcsize(hdr_fmt)
 pkt_size = hdr_size + 1024
-null_pkt = "\x00" * 1024
 
 
 def decode_packets(plist, streamid, chans, nfft, pkts_per_chunk=16, capture_failures=False):
+    """
+    Decode ROACH1 UDP packets into an array of complex samples with shape (num_samples, chans.size).
+
+    The packets may be a list of strings, as returned by get_udp_packets(), or a uint8 array with shape
+    (num_packets, pkt_size), as returned by get_udp_packet_buffer(). The headers are viewed as a structured array, the
+    mcnt counter is unwrapped by accumulating its overflows, and the payload of each packet is scattered to the place
+    given by its sequence number, so missing packets are filled with NaN.
+
+    Returns the data and the sequence numbers of all packets with the correct size and stream id.
+    """
     nchan = chans.shape[0]
     mcnt_inc = nfft * 2 ** 12 / nchan
-    next_seqno = None
-    mcnt_top = 0
-    dset = []
-    mcntoff = None
-    last_mcnt_ovf = None
-    seqnos = []
-    nextseqnos = []
-    chan0 = None
-    for pnum, pkt in enumerate(plist):
-        if len(pkt) != pkt_size:
-            logger.warning("Packet size is {} but expected {}.".format(len(pkt), pkt_size))
-            continue
-        pidle, pidx, pstream, pchan, pmcnt = struct.unpack(hdr_fmt, pkt[:hdr_size])
-        if pstream != streamid:
-            logger.warning("Stream id is {} but expected {}".format(pstream, streamid))
-            continue
-        if next_seqno is None:
-            mcnt_top = 0
-            last_mcnt_ovf = pmcnt
-        else:
-            if pmcnt < mcnt_inc:
-                if last_mcnt_ovf != pmcnt:
-                    message = "Detected mcnt overflow {} {} {} {} {} {} {}"
-                    logger.info(message.format(last_mcnt_ovf, pmcnt, pidx, next_seqno, mcnt_top / 2 ** 32, pnum, mcntoff))
-                    mcnt_top += 2 ** 32
-                    last_mcnt_ovf = pmcnt
-                else:
-                    #                    print "continuation of previous mcnt overflow",pidx
-                    pass
-            else:
-                last_mcnt_ovf = None
-        chunkno, pmcntoff = divmod(pmcnt + mcnt_top, mcnt_inc)
-        # print chunkno,pmcnt,pmcntoff,pidx
-        seqno = (chunkno) * pkts_per_chunk + pidx
-        # print seqno
-        seqnos.append(seqno)
-        nextseqnos.append(next_seqno)
-        if next_seqno is None:
-            chan0 = pchan
-            #            print "found first packet",seqno,pidx
-            next_seqno = seqno
-            mcntoff = pmcntoff
-        #            print pchan
-        if mcntoff != pmcntoff:
-            logger.warning("mcnt offset jumped: was {} and is now {} ... dropping ...".format(mcntoff, pmcntoff))
-            continue
-        if pchan != chan0:
-            logger.warning("warning: channel id changed from {} to {}.".format(chan0, pchan))
-        if seqno - next_seqno < 0:
-            logger.warning("seqno diff: {} {} {}".format(seqno - next_seqno, seqno, next_seqno))
-            continue  # trying to go backwards
-        if seqno == next_seqno:
-            dset.append(pkt[hdr_size:])
-            next_seqno += 1
-        else:
-            message = "sequence number skip: expected {} and got {}; inserting {} null packets; {} {}"
-            logger.warning(message.format(next_seqno, seqno, seqno - next_seqno, pnum, pidx))
-            if capture_failures:  # seqno-next_seqno == 32768:
-                fname = time.strftime("udp_skip_%Y-%m-%d_%H%M%S.pkl")
-                logger.warning("caught special case, writing to disk: {}".format(fname))
-                fh = open(fname, 'w')
-                cPickle.dump(
-                    dict(plist=plist, dset=dset, pnum=pnum, pkt=pkt, streamid=streamid, chans=chans, nfft=nfft),
-                    fh, cPickle.HIGHEST_PROTOCOL)
-                fh.close()
-            for k in range(seqno - next_seqno + 1):
-                dset.append(null_pkt)
-                next_seqno += 1
-    dset = ''.join(dset)
-    ns = (len(dset) // (4 * nchan))
-    dset = dset[:ns * (4 * nchan)]
-    darray = np.fromstring(dset, dtype='>i2').astype('float32').view('complex64')
-    darray.shape = (ns, nchan)
+    if isinstance(plist, np.ndarray):
+        packets = plist
+        pnums = np.arange(packets.shape[0])
+    else:
+        good = []
+        for pnum, pkt in enumerate(plist):
+            if len(pkt) != pkt_size:
+                logger.warning("Packet size is {} but expected {}.".format(len(pkt), pkt_size))
+                continue
+            good.append(pnum)
+        pnums = np.array(good, dtype=int)
+        packets = np.frombuffer(''.join([plist[pnum] for pnum in good]), dtype=np.uint8).reshape((-1, pkt_size))
+    header = np.ascontiguousarray(packets[:, :hdr_size]).view(ptype)[:, 0]
+    pstream = header['stream'].astype(np.uint16)
+    in_stream = pstream == streamid
+    if not np.all(in_stream):
+        wrong = np.flatnonzero(~in_stream)
+        logger.warning("{} packets have the wrong stream id; the first, packet {}, has stream id {} but expected "
+                       "{}".format(wrong.size, pnums[wrong[0]], pstream[wrong[0]], streamid))
+        packets = packets[in_stream]
+        header = header[in_stream]
+        pnums = pnums[in_stream]
+    if not packets.shape[0]:
+        logger.warning("No packets from stream {}.".format(streamid))
+        return np.zeros((0, nchan), dtype='complex64'), np.zeros(0, dtype=np.int64)
+    pidx = header['idx'].astype(np.int64)
+    pchan = header['chan'].astype(np.uint16)
+    pmcnt = header['mcntr'].astype(np.int64) % 2 ** 32
+
+    # A packet with mcnt < mcnt_inc follows an overflow unless the previous packet has the same small mcnt.
+    small = pmcnt < mcnt_inc
+    continuation = np.zeros_like(small)
+    continuation[1:] = (small[:-1] | (np.arange(1, small.size) == 1)) & (pmcnt[:-1] == pmcnt[1:])
+    overflow = small & ~continuation
+    overflow[0] = False
+    for i in np.flatnonzero(overflow):
+        message = "Detected mcnt overflow {} {} {} {}"
+        logger.info(message.format(pmcnt[i - 1], pmcnt[i], pidx[i], pnums[i]))
+    mcnt_top = 2 ** 32 * np.cumsum(overflow)
+    chunkno, pmcntoff = np.divmod(pmcnt + mcnt_top, mcnt_inc)
+    seqnos = chunkno * pkts_per_chunk + pidx
+
+    chan0 = pchan[0]
+    for i in np.flatnonzero(pmcntoff != pmcntoff[0]):
+        logger.warning("mcnt offset jumped: was {} and is now {} ... dropping ...".format(pmcntoff[0], pmcntoff[i]))
+    for i in np.flatnonzero(pchan != chan0):
+        logger.warning("warning: channel id changed from {} to {}.".format(chan0, pchan[i]))
+    # A packet is used if its sequence number is larger than that of every earlier packet.
+    candidate = pmcntoff == pmcntoff[0]
+    running_max = np.maximum.accumulate(np.where(candidate, seqnos, seqnos[0] - 1))
+    previous_max = np.concatenate(([seqnos[0] - 1], running_max[:-1]))
+    used = candidate & (seqnos > previous_max)
+    for i in np.flatnonzero(candidate & ~used):
+        logger.warning("seqno diff: {} {} {}".format(seqnos[i] - previous_max[i] - 1, seqnos[i], previous_max[i] + 1))
+    skipped = used & (seqnos > previous_max + 1)
+    skipped[0] = False
+    for i in np.flatnonzero(skipped):
+        message = "sequence number skip: expected {} and got {}; inserting {} null packets; {} {}"
+        logger.warning(message.format(previous_max[i] + 1, seqnos[i], seqnos[i] - previous_max[i] - 1, pnums[i],
+                                      pidx[i]))
+        if capture_failures:
+            fname = time.strftime("udp_skip_%Y-%m-%d_%H%M%S.pkl")
+            logger.warning("caught special case, writing to disk: {}".format(fname))
+            with open(fname, 'w') as fh:
+                cPickle.dump(dict(plist=plist, pnum=pnums[i], pkt=packets[i].tostring(), streamid=streamid,
+                                  chans=chans, nfft=nfft), fh, cPickle.HIGHEST_PROTOCOL)
+
+    places = seqnos[used] - seqnos[0]
+    samples_per_packet = (pkt_size - hdr_size) // 4
+    dset = np.empty((places[-1] + 1, samples_per_packet), dtype='complex64')
+    if dset.shape[0] == packets.shape[0] and np.all(used):  # No packets are missing, so convert in place.
+        packets = np.ascontiguousarray(packets)
+        payload = np.ndarray(shape=(packets.shape[0], 2 * samples_per_packet), dtype='>i2', buffer=packets,
+                             offset=hdr_size, strides=(pkt_size, 2))
+        dset.view('float32')[:] = payload
+    else:
+        dset.fill(np.nan)
+        dset[places] = packets[used, hdr_size:].view('>i2').astype('float32').view('complex64')
+    ns = dset.size // nchan
+    darray = dset.reshape(-1)[:ns * nchan].reshape((ns, nchan))
     shift = np.flatnonzero(chans == (chan0))[0] - (nchan - 1)
-    darray = np.roll(darray, shift, axis=1)
-    return darray, np.array(seqnos)
+    if shift % nchan:
+        darray = np.roll(darray, shift, axis=1)
+    return darray, seqnos
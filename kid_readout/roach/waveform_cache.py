@@ -0,0 +1,185 @@
+"""
+This module contains a disk cache for the quantized waveforms that are loaded into the ROACH DRAM or QDR.
+
+Calculating the waveform for a bank of tones requires an inverse FFT over the whole playback buffer followed by
+quantization to 16 bits, and for a large comb with many waveforms this dominates the time spent setting up each step of
+a sweep. Because the result depends only on the tone bins, the number of samples, the amplitudes and phases, the IQ
+delay, and the normalization, it can be stored on disk the first time it is calculated and memory-mapped on every later
+use.
+
+The cache is used only if settings.WAVEFORM_CACHE_DIR is set, and only for waveforms that can be requested again:
+those with phases given by the caller, or with reproducible phases (see RoachInterface.reproducible_phases).
+"""
+import os
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from kid_readout import settings
+from kid_readout.settings import WAVEFORM_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+
+class WaveformCache(object):
+    """
+    Store quantized waveforms as .npy files in a directory and return them as read-only memory-mapped arrays.
+
+    When the total size of the cached files exceeds max_bytes, the least recently used files are deleted. It is safe to
+    delete the directory, or any of the files in it, at any time.
+    """
+
+    extension = '.npy'
+
+    def __init__(self, directory, max_bytes=WAVEFORM_CACHE_MAX_BYTES):
+        """
+        Parameters
+        ----------
+        directory : str
+            The directory in which to store the waveforms; it is created if it does not exist.
+        max_bytes : int
+            The maximum total size of the cached waveforms.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.extension)
+
+    def get(self, key):
+        """
+        Return the waveform stored under the given key as a read-only memory-mapped array, or None if it is not cached.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            waveform = np.load(path, mmap_mode='r')
+            os.utime(path, None)  # Record the use for least-recently-used eviction.
+        except (IOError, OSError, ValueError):
+            logger.warning("Removing unreadable cached waveform {}".format(path))
+            self._remove(path)
+            return None
+        logger.debug("Loaded cached waveform {}".format(key))
+        return waveform
+
+    def put(self, key, waveform):
+        """
+        Store the given waveform under the given key and return it as a read-only memory-mapped array.
+
+        If the waveform cannot be written, it is returned unchanged.
+        """
+        path = self.path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file and rename it so that a partially-written file is never read.
+            handle, temporary_path = tempfile.mkstemp(suffix=self.extension, dir=self.directory)
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, waveform)
+            os.rename(temporary_path, path)
+            self._evict(keep=path)
+            return np.load(path, mmap_mode='r')
+        except (IOError, OSError):
+            logger.warning("Could not cache waveform in {}".format(self.directory), exc_info=True)
+            return waveform
+
+    def clear(self):
+        """
+        Delete all cached waveforms.
+        """
+        for path, size, mtime in self._entries():
+            self._remove(path)
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.extension):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self, keep):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+                total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """
+    Return the WaveformCache in settings.WAVEFORM_CACHE_DIR, or None if that setting is None.
+    """
+    global _default_cache
+    if settings.WAVEFORM_CACHE_DIR is None:
+        return None
+    if _default_cache is None or _default_cache.directory != settings.WAVEFORM_CACHE_DIR:
+        _default_cache = WaveformCache(settings.WAVEFORM_CACHE_DIR)
+    return _default_cache
+
+
+def waveform_key(kind, bins, nsamp, amps, phases, iq_delay, wavenorm):
+    """
+    Return a string that identifies the quantized waveform calculated from the given parameters.
+
+    Parameters
+    ----------
+    kind : str
+        Identifies the calculation, e.g. 'baseband' for a real waveform or 'heterodyne' for a complex waveform.
+    bins : ndarray(int)
+        The tone bins, with shape (nwaves, ntones).
+    nsamp : int
+        The number of samples in each waveform.
+    amps : float or ndarray(float)
+        The tone amplitudes.
+    phases : ndarray(float)
+        The tone phases.
+    iq_delay : int or None
+        The number of samples by which the Q waveform is rolled, or None for a real waveform.
+    wavenorm : float
+        The waveform normalization.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest of a hash of the parameters.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((kind, int(nsamp), iq_delay, float(wavenorm))))
+    for array in (bins, amps, phases):
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)))
+        digest.update(array.tostring())
+    return digest.hexdigest()
+
+
+def reproducible_phases(bins, nsamp):
+    """
+    Return pseudo-random tone phases in [0, 2 pi) that are always the same for the same bins and nsamp, so that the
+    waveform for a given tone bank can be reused from the cache.
+    """
+    bins = np.ascontiguousarray(bins)
+    seed = int(hashlib.sha1(repr((int(nsamp), bins.shape)) + bins.astype('<i8').tostring()).hexdigest()[:8], 16)
+    return np.random.RandomState(seed).random_sample(bins.shape[-1]) * 2 * np.pi
@@ -36,6 +36,21 @@ LOG_DIR = '/tmp'
 # The path of the directory containing temperature log files.
 TEMPERATURE_LOG_DIR = None
 
+# The directory in which quantized DAC waveforms are cached, and the maximum total size of the cache in bytes. The
+# default of None disables the cache; see kid_readout.roach.waveform_cache.
+WAVEFORM_CACHE_DIR = None
+WAVEFORM_CACHE_MAX_BYTES = 2 ** 32
+
+# The SQLite database that contains the catalog of measurements in data files; see kid_readout.measurement.catalog.
+# The default of None means measurement_catalog.sqlite in BASE_DATA_DIR, which is resolved when the catalog is opened so
+# that it follows a BASE_DATA_DIR set in _local.py.
+MEASUREMENT_CATALOG_PATH = None
+
+# The file in which the interpolation table of Mattis-Bardeen conductivities is cached; see
+# kid_readout.analysis.physics.mbint. The default of None means that the table is calculated in each process that uses
+# it and is not saved.
+MATTIS_BARDEEN_TABLE_PATH = None
+
 # ROACH1
 ROACH1_IP = None
 ROACH1_VALON = None